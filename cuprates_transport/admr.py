@@ -1,3 +1,4 @@
+import inspect
 import numpy as np
 from numpy import cos, sin, pi, sqrt, ones
 from tqdm import tqdm
@@ -5,11 +6,18 @@ import matplotlib as mpl
 import matplotlib.pyplot as plt
 from matplotlib.ticker import MultipleLocator, FormatStrFormatter
 from matplotlib.backends.backend_pdf import PdfPages
+
+from cuprates_transport.admr_store import ADMRStore
+from cuprates_transport.transport_observables import resistivity
 ##<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<#
 
+## Tensors which runADMR can compute for each angle, with their units in fileADMR
+observables_units_dict = {"sigma": "(Ohm.m)^-1", "alpha": "A/(K.m)", "beta": "W/(K.m)", "rho": "Ohm.m"}
+
 class ADMR:
     def __init__(self, initialcondObjectList, Btheta_min=0, Btheta_max=110,
-                 Btheta_step=5, Bphi_array=[0, 15, 30, 45], **trash):
+                 Btheta_step=5, Bphi_array=[0, 15, 30, 45], full_tensor=False,
+                 observables=None, observables_ij=None, **trash):
 
         # Band dictionary
         self.initialCondObjectDict = {} # will contain the condObject for each band, with key their bandname
@@ -34,41 +42,244 @@ class ADMR:
         self.vftDict = {}
         self.vproductDict = {}
 
+        # Conductivity tensor sigma[phi, theta, i, j] summed over bands
+        self.sigma_array = None
+        # If True, all the components of sigma are computed on the same trajectories
+        # and rho_zz is the zz component of the inverse of sigma, instead of 1 / sigma_zz
+        self.full_tensor = full_tensor
+        # Tensors computed at each angle on the same trajectories as sigma_zz,
+        # a list of names of observables_units_dict or "all", and the list of
+        # their components (i, j), default all of them
+        if observables == "all":
+            observables = list(observables_units_dict.keys())
+        self.observables = []
+        for name in ([] if observables is None else observables):
+            if name in observables_units_dict.keys():
+                self.observables.append(name)
+            else:
+                print("Warning! " + str(name) + " is not an observable of ADMR, it is ignored")
+        if observables_ij is None:
+            observables_ij = [(i, j) for i in range(3) for j in range(3)]
+        self.observables_ij = [tuple(ij) for ij in observables_ij]
+        # Resistivity tensor rho[phi, theta, i, j], if full_tensor or "rho" in observables
+        self.rho_array = None
+        # Thermoelectric tensors alpha[phi, theta, i, j] & beta[phi, theta, i, j],
+        # if "alpha" or "beta" in observables
+        self.alpha_array = None
+        self.beta_array = None
+
         # Resistivity array rho_zz
         self.rhozz_array = None
         # Resistivity array rho_zz / rho_zz(0)
         self.rzz_array = None
 
+        # Derivatives [phi, theta, n] with respect to the scattering parameters jacobian_params[n]
+        self.jacobian_params = None
+        self.sigmazz_jacobian_array = None
+        self.rhozz_jacobian_array = None
+        self.rzz_jacobian_array = None
 
-    ## Methods >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>#
-    def runADMR(self):
+        # Arrays [n, phi, theta] for the scattering sets of runADMRBatch
+        self.sigmazz_batch_array = None
+        self.rhozz_batch_array = None
+        self.rzz_batch_array = None
 
+
+    ## Methods >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>#
+    def runADMR(self, store=None, resume=False, jacobian_params=None):
+        """store: an ADMRStore, if given the results are written on disk at each
+        angle and the trajectories are not kept in kftDict, vftDict, vproductDict
+        The trajectories of a band with memory_budget are never kept nor written,
+        as only its last block of points is in memory
+        resume: if True, the angles already in the store are not recomputed
+        jacobian_params: list of scattering parameters, if given the derivatives
+        of sigma_zz, rho_zz and rzz with respect to them are computed as well,
+        a parameter is shared by all the bands
+        If full_tensor is True, rho_zz is exact for tilted fields, it comes from
+        the inverse of the whole sigma tensor instead of 1 / sigma_zz
+        The components observables_ij of the tensors of observables are filled
+        in sigma_array, alpha_array, beta_array and rho_array
+        """
+        names, ij_list = self.observablesFunc()
+        if len(names) != 0 and jacobian_params is not None:
+            print("Warning! The jacobian is only computed for sigma_zz, rho_zz = 1 / sigma_zz is used")
+            names, ij_list = [], [(2, 2)]
+        full_tensor = "rho" in names
+        thermo = "alpha" in names or "beta" in names
+        ij_index = tuple(np.array(ij_list).T)
         rhozz_array = np.empty((self.Bphi_array.size, self.Btheta_array.size), dtype= np.float64)
+        ## sigma_array, alpha_array, beta_array
+        tensors_array = np.full((3, self.Bphi_array.size, self.Btheta_array.size, 3, 3), np.nan, dtype= np.float64)
+        sigma_array = tensors_array[0]
+        if jacobian_params is not None:
+            sigmazz_jacobian_array = np.zeros((self.Bphi_array.size, self.Btheta_array.size,
+                                               len(jacobian_params)), dtype= np.float64)
+
+        if store is not None:
+            store.open(self, resume=resume)
 
         for l, phi in enumerate(tqdm(self.Bphi_array, ncols=80, unit="phi", desc="ADMR")):
             for m, theta in enumerate(self.Btheta_array):
 
+                if (store is not None and jacobian_params is None and not thermo and
+                    store.is_done(l, m, ij_list)):
+                    rhozz_array[l, m], sigma_array[l, m] = store.read_point(l, m)
+                    continue
+
                 sigma_zz = 0
+                tensors = np.zeros((3, 3, 3), dtype=np.float64) # sigma, alpha, beta
                 for (band_name, iniCondObject) in list(self.initialCondObjectDict.items()):
 
                     iniCondObject.Bphi = phi
                     iniCondObject.Btheta = theta
 
                     iniCondObject.runTransport()
-                    sigma_zz += iniCondObject.chambersFunc(i=2, j=2)
+                    if len(names) != 0:
+                        tensors += np.array(iniCondObject.chambersTensorsFunc(ij_list))
+                    elif jacobian_params is None:
+                        sigma_zz += iniCondObject.chambersFunc(i=2, j=2)
+                    else:
+                        sigma_zz_band, dsigma_zz_band = iniCondObject.chambersJacobianFunc(2, 2, jacobian_params)
+                        sigma_zz += sigma_zz_band
+                        sigmazz_jacobian_array[l, m, :] += dsigma_zz_band
 
                     # Store in dictionaries
                     self.condObjectDict[band_name, phi, theta] = iniCondObject
-                    self.kftDict[band_name, phi, theta] = iniCondObject.kft
-                    self.vftDict[band_name, phi, theta] = iniCondObject.vft
-                    self.vproductDict[band_name, phi, theta] = iniCondObject.v_product
-
-                rhozz_array[l, m] = 1 / sigma_zz
+                    if iniCondObject.memory_budget is not None:
+                        pass # kft & vft are only the last block of points
+                    elif store is None:
+                        self.kftDict[band_name, phi, theta] = iniCondObject.kft
+                        self.vftDict[band_name, phi, theta] = iniCondObject.vft
+                        self.vproductDict[band_name, phi, theta] = iniCondObject.v_product
+                    elif store.trajectories == True:
+                        store.write_trajectories(band_name, l, m,
+                                                 iniCondObject.kft, iniCondObject.vft,
+                                                 rhozz_array.shape)
+
+                if len(names) != 0:
+                    tensors_array[(slice(None), l, m) + ij_index] = tensors[(slice(None),) + ij_index]
+                    if full_tensor:
+                        rhozz_array[l, m] = resistivity(tensors[0])[2, 2]
+                    else:
+                        rhozz_array[l, m] = 1 / tensors[0, 2, 2]
+                else:
+                    sigma_array[l, m, 2, 2] = sigma_zz
+                    rhozz_array[l, m] = 1 / sigma_zz
+
+                if store is not None:
+                    store.write_point(l, m, rhozz_array[l, m], sigma_array[l, m])
+
+            if store is not None:
+                store.flush() # checkpoint at the end of each phi
+
+        if store is not None:
+            store.close()
+
+        if full_tensor:
+            ## all the angles inverted at once
+            self.rho_array = resistivity(sigma_array)
+            rhozz_array = self.rho_array[:, :, 2, 2]
+
+        if "alpha" in names:
+            self.alpha_array = tensors_array[1]
+        if "beta" in names:
+            self.beta_array = tensors_array[2]
 
         rhozz_0_array = np.outer(rhozz_array[:, 0], np.ones(self.Btheta_array.shape[0]))
+        self.sigma_array = sigma_array
         self.rhozz_array = rhozz_array
         self.rzz_array = rhozz_array / rhozz_0_array
 
+        if jacobian_params is not None:
+            self.jacobian_params = list(jacobian_params)
+            self.sigmazz_jacobian_array = sigmazz_jacobian_array
+            self.rhozz_jacobian_array = - sigmazz_jacobian_array / sigma_array[:, :, 2, 2, None]**2
+            ## d(rho / rho_0) = (d rho * rho_0 - rho * d rho_0) / rho_0**2
+            self.rzz_jacobian_array = ((self.rhozz_jacobian_array * rhozz_0_array[:, :, None] -
+                                        rhozz_array[:, :, None] * self.rhozz_jacobian_array[:, 0, None, :]) /
+                                       rhozz_0_array[:, :, None]**2)
+
+    def observablesFunc(self):
+        """Returns the names of the tensors computed by runADMR and the list of
+        their components (i, j), sigma_zz is always part of it as rho_zz
+        comes from it. rho needs all the components of sigma."""
+        names = list(self.observables)
+        if self.full_tensor and "rho" not in names:
+            names.append("rho")
+        if len(names) != 0 and "sigma" not in names:
+            names.insert(0, "sigma")
+        if "rho" in names:
+            ij_list = [(i, j) for i in range(3) for j in range(3)]
+        else:
+            ij_list = list(self.observables_ij)
+            if (2, 2) not in ij_list:
+                ij_list.append((2, 2))
+        return names, ij_list
+
+    def runADMRBatch(self, param_names, param_values, batch_size=None):
+        """Computes ADMR for many sets of scattering parameters at once, the
+        trajectories are solved once per angle and shared by all the sets.
+        param_values[n, i] is the value of param_names[i] for the set n,
+        a parameter is shared by all the bands. The time grids are extended
+        for the sets with lower scattering rates, then put back at the end.
+        Returns sigmazz_batch_array[n, phi, theta]
+        """
+        N_sets = np.atleast_2d(param_values).shape[0]
+        sigmazz_batch_array = np.zeros((N_sets, self.Bphi_array.size, self.Btheta_array.size), dtype= np.float64)
+
+        time_grids = {}
+        for (band_name, iniCondObject) in self.initialCondObjectDict.items():
+            time_grids[band_name] = (iniCondObject.time_max, iniCondObject.N_time)
+            iniCondObject.extend_time_grid(param_names, param_values)
+
+        for l, phi in enumerate(tqdm(self.Bphi_array, ncols=80, unit="phi", desc="ADMR batch")):
+            for m, theta in enumerate(self.Btheta_array):
+                for (band_name, iniCondObject) in list(self.initialCondObjectDict.items()):
+                    iniCondObject.Bphi = phi
+                    iniCondObject.Btheta = theta
+                    iniCondObject.runTransport()
+                    sigmazz_batch_array[:, l, m] += iniCondObject.chambersBatchFunc(2, 2, param_names, param_values,
+                                                                                    batch_size=batch_size)
+
+        for (band_name, iniCondObject) in self.initialCondObjectDict.items():
+            iniCondObject.time_max, iniCondObject.N_time = time_grids[band_name]
+
+        self.sigmazz_batch_array = sigmazz_batch_array
+        self.rhozz_batch_array = 1 / sigmazz_batch_array
+        self.rzz_batch_array = self.rhozz_batch_array / self.rhozz_batch_array[:, :, 0, None]
+        return self.sigmazz_batch_array
+
+    #---------------------------------------------------------------------------
+    def metadataFunc(self):
+        """Returns in a dictionary the parameters used to build the file name"""
+        CondObject0 = self.initialCondObjectDict[self.bandNamesList[0]]
+        bandObject0 = CondObject0.bandObject
+
+        metadata = {"file_name": self.fileNameFunc(),
+                    "p": float(self.totalHoleDoping),
+                    "T": float(CondObject0.T),
+                    "Bamp": float(CondObject0.Bamp),
+                    "energy_scale": float(bandObject0.energy_scale),
+                    "band_params": {key: float(value) for (key, value) in sorted(bandObject0._band_params.items())},
+                    "res_xy": bandObject0.res_xy,
+                    "res_z": bandObject0.res_z,
+                    "N_time": CondObject0.N_time,
+                    "time_quadrature": CondObject0.time_quadrature,
+                    "full_tensor": bool(self.full_tensor),
+                    "observables": self.observablesFunc()[0],
+                    "observables_ij": [list(ij) for ij in self.observablesFunc()[1]],
+                    "bands": {}}
+        ## All the scattering and solver parameters of each band, the field is
+        ## set per angle and memory_budget does not change the result
+        for (band_name, iniCondObject) in self.initialCondObjectDict.items():
+            metadata["bands"][band_name] = {}
+            for param_name in inspect.signature(type(iniCondObject).__init__).parameters.keys():
+                if param_name in ["self", "bandObject", "Bamp", "Bphi", "Btheta",
+                                  "memory_budget", "trash"]:
+                    continue
+                metadata["bands"][band_name][param_name] = metadata_value(getattr(iniCondObject, param_name))
+        return metadata
+
     #---------------------------------------------------------------------------
     def fileNameFunc(self):
         # To point to bandstructure parameters, we use just one band
@@ -167,6 +378,18 @@ class ADMR:
                           band_name + "_power\t"
         DataHeader += condHeader
 
+        ## Components of the observables, one column per phi
+        names, ij_list = self.observablesFunc()
+        for name in names:
+            tensor_array = getattr(self, name + "_array")
+            if tensor_array is None:
+                continue
+            for (i, j) in ij_list:
+                for l in range(self.Bphi_array.size):
+                    Data = np.vstack((Data, tensor_array[l, :, i, j]))
+                    DataHeader += (name + "_" + "xyz"[i] + "xyz"[j] + "(phi=" + str(self.Bphi_array[l]) +
+                                   ")[" + observables_units_dict[name] + "]\t")
+
         Data = Data.transpose()
 
         ## Build header ---------------------------------------------------------
@@ -179,6 +402,24 @@ class ADMR:
         np.savetxt(filename, Data, fmt='%.7e',
         header = DataHeader, comments = "#")
 
+    #---------------------------------------------------------------------------
+    def storeADMR(self, folder="", filename=None):
+        """Writes the results of runADMR in a binary ADMRStore (no trajectories),
+        to record the trajectories, give the store directly to runADMR"""
+        if folder != "":
+            folder += "/"
+        if filename == None:
+            filename = folder + "Rzz_" + self.fileNameFunc()
+        else:
+            filename = folder + filename
+        store = ADMRStore(filename)
+        store.open(self)
+        for l in range(self.Bphi_array.size):
+            for m in range(self.Btheta_array.size):
+                store.write_point(l, m, self.rhozz_array[l, m], self.sigma_array[l, m])
+        store.close()
+        return store
+
 
     def figADMR(self, fig_show=True, fig_save=True, folder="", filename=None):
         #///// RC Parameters //////#
@@ -277,3 +518,16 @@ class ADMR:
             file_figures.close()
 
 
+
+
+## Functions >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>#
+
+def metadata_value(value):
+    """Value of a Conductivity parameter as written in metadata.json"""
+    if isinstance(value, str) or value is None:
+        return value
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, (type, np.dtype)):
+        return np.dtype(value).name # trajectories_dtype
+    return float(value)
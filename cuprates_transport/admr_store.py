@@ -0,0 +1,182 @@
+import os
+import json
+import numpy as np
+from numpy.lib.format import open_memmap
+##<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<#
+
+class ADMRStore:
+    """Binary store of the ADMR results, one folder per run:
+
+        metadata.json       run parameters (the ones of ADMR.fileNameFunc and all the
+                            scattering and solver parameters of each band)
+        Bphi.npy            phi angles in degrees
+        Btheta.npy          theta angles in degrees
+        rhozz.npy           rho_zz[phi, theta] in Ohm.m
+        sigma.npy           sigma[phi, theta, i, j] in (Ohm.m)^-1, summed over bands
+        done.npy            True for the (phi, theta) already computed
+        kft_<band>.npy      (optional) kf(t)[phi, theta, xyz, i0, i_t]
+        vft_<band>.npy      (optional) vf(t)[phi, theta, xyz, i0, i_t]
+
+    All arrays are plain .npy files, they are written point by point through a
+    memory map during ADMR.runADMR and read back lazily with mmap_mode="r",
+    so nothing goes into RAM before it is sliced. As every finished angle is
+    flagged in done.npy, an interrupted runADMR can be resumed from the store.
+    """
+    def __init__(self, path, trajectories=False, trajectories_dtype=np.float32):
+        self.path = path
+        self.trajectories = trajectories # if True, kft & vft are written on disk during runADMR
+        self.trajectories_dtype = trajectories_dtype # float32 halves the size on disk
+
+        self._arrays = {} # memory maps already opened, keys are the file names
+        self._metadata = None
+
+
+    ## Properties >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>#
+    def _get_metadata(self):
+        if self._metadata is None:
+            with open(os.path.join(self.path, "metadata.json"), "r") as f:
+                self._metadata = json.load(f)
+        return self._metadata
+    def _set_metadata(self, metadata):
+        print("Cannot access metadata directly, it is written by ADMR.runADMR")
+    metadata = property(_get_metadata, _set_metadata)
+
+    def _get_Bphi_array(self):
+        return self.load("Bphi")
+    Bphi_array = property(_get_Bphi_array)
+
+    def _get_Btheta_array(self):
+        return self.load("Btheta")
+    Btheta_array = property(_get_Btheta_array)
+
+    def _get_rhozz_array(self):
+        return self.load("rhozz")
+    rhozz_array = property(_get_rhozz_array)
+
+    def _get_rzz_array(self):
+        rhozz_array = self.load("rhozz")
+        return rhozz_array / rhozz_array[:, 0, None]
+    rzz_array = property(_get_rzz_array)
+
+    def _get_sigma_array(self):
+        return self.load("sigma")
+    sigma_array = property(_get_sigma_array)
+
+
+    ## Methods >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>#
+    def fileName(self, name):
+        return os.path.join(self.path, name + ".npy")
+
+    def load(self, name):
+        """Returns the memory map of the array 'name', opened only once"""
+        if name not in self._arrays.keys():
+            self._arrays[name] = np.load(self.fileName(name), mmap_mode="r")
+        return self._arrays[name]
+
+    def kft(self, band_name):
+        return self.load("kft_" + band_name)
+
+    def vft(self, band_name):
+        return self.load("vft_" + band_name)
+
+    def open(self, admrObject, resume=False):
+        """Creates the folder, writes the metadata and the angles, and opens
+        the result arrays in write mode before the loops of runADMR.
+        If resume=True and the store holds the same run, the arrays are
+        re-opened as they are to keep the angles already computed."""
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self._arrays = {}
+        metadata = admrObject.metadataFunc()
+        shape = (admrObject.Bphi_array.size, admrObject.Btheta_array.size)
+
+        if resume == True:
+            if self.is_same_run(metadata, admrObject):
+                for name in ["rhozz", "sigma", "done"]:
+                    self._arrays[name] = open_memmap(self.fileName(name), mode="r+")
+                for name in os.listdir(self.path):
+                    if name.startswith("kft_") or name.startswith("vft_"):
+                        name = name[:-len(".npy")]
+                        self._arrays[name] = open_memmap(self.fileName(name), mode="r+")
+                self._metadata = metadata
+                return
+            print("Warning! The store " + self.path + " does not match this run, it starts from scratch")
+
+        self._metadata = metadata
+        with open(os.path.join(self.path, "metadata.json"), "w") as f:
+            json.dump(self._metadata, f, indent=4)
+
+        np.save(self.fileName("Bphi"), admrObject.Bphi_array)
+        np.save(self.fileName("Btheta"), admrObject.Btheta_array)
+        self._arrays["rhozz"] = open_memmap(self.fileName("rhozz"), mode="w+",
+                                            dtype=np.float64, shape=shape)
+        self._arrays["sigma"] = open_memmap(self.fileName("sigma"), mode="w+",
+                                            dtype=np.float64, shape=shape + (3, 3))
+        self._arrays["done"] = open_memmap(self.fileName("done"), mode="w+",
+                                           dtype=np.bool_, shape=shape)
+        self._arrays["rhozz"][:] = np.nan
+        self._arrays["sigma"][:] = np.nan
+        self._arrays["done"][:] = False
+
+    def is_same_run(self, metadata, admrObject):
+        """True if the store on disk was written for the same parameters and angles"""
+        try:
+            with open(os.path.join(self.path, "metadata.json"), "r") as f:
+                metadata_disk = json.load(f)
+            Bphi_array = np.load(self.fileName("Bphi"))
+            Btheta_array = np.load(self.fileName("Btheta"))
+            np.load(self.fileName("done"), mmap_mode="r")
+        except (IOError, ValueError):
+            return False
+        return (metadata_disk == json.loads(json.dumps(metadata)) and
+                np.array_equal(Bphi_array, admrObject.Bphi_array) and
+                np.array_equal(Btheta_array, admrObject.Btheta_array))
+
+    def is_done(self, l, m, ij_list=((2, 2),)):
+        """True if the angle is computed with the components ij_list of sigma"""
+        if not self._arrays["done"][l, m]:
+            return False
+        sigma = self._arrays["sigma"][l, m]
+        return all(np.isfinite(sigma[i, j]) for (i, j) in ij_list)
+
+    def read_point(self, l, m):
+        """Returns (rho_zz, sigma) already stored at (phi, theta)"""
+        return self._arrays["rhozz"][l, m], np.array(self._arrays["sigma"][l, m])
+
+    def write_point(self, l, m, rhozz, sigma):
+        """Writes the result at phi = Bphi_array[l], theta = Btheta_array[m]"""
+        self._arrays["rhozz"][l, m] = rhozz
+        self._arrays["sigma"][l, m] = sigma
+        self._arrays["done"][l, m] = True
+
+    def write_trajectories(self, band_name, l, m, kft, vft, shape):
+        """Writes kft & vft of one band at (phi, theta), the files are created
+        at the first call as their size is known only after runTransport"""
+        for name, array in (("kft_" + band_name, kft), ("vft_" + band_name, vft)):
+            if name not in self._arrays.keys():
+                self._arrays[name] = open_memmap(self.fileName(name), mode="w+",
+                                                 dtype=self.trajectories_dtype,
+                                                 shape=shape + array.shape)
+            self._arrays[name][l, m] = array
+
+    def flush(self):
+        for array in self._arrays.values():
+            if isinstance(array, np.memmap) and array.mode != "r":
+                array.flush()
+
+    def close(self):
+        """Flushes the arrays on disk, they are re-opened read-only when accessed"""
+        self.flush()
+        self._arrays = {}
+
+
+## Functions to reload many runs >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>#
+def load_stores(folder):
+    """Returns a dictionary {file_name: ADMRStore} of all the stores found in
+    folder, only the metadata is read, arrays are loaded when accessed"""
+    stores = {}
+    for name in sorted(os.listdir(folder)):
+        path = os.path.join(folder, name)
+        if os.path.isfile(os.path.join(path, "metadata.json")):
+            stores[name] = ADMRStore(path)
+    return stores
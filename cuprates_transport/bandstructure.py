@@ -7,9 +7,12 @@ from skimage import measure
 from numba import jit
 import matplotlib as mpl
 import matplotlib.pyplot as plt
-from copy import deepcopy
+from copy import copy, deepcopy
 ##<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<#
 
+## Attributes of the discretized Fermi surface
+fermi_surface_attributes = ["kf", "vf", "dkf", "dks", "dkz", "dos_k", "number_of_points_per_kz_list"]
+
 # Constant //////
 hbar = 1  # velocity will be in units of 1 / hbar,
 # this hbar is taken into accound in the constant units_move_eq
@@ -181,6 +184,26 @@ class BandStructure:
         self.doping(printDoping=printDoping)
 
 
+    def snapshot(self):
+        """Shallow copy of the band for the objects that use it (Conductivity):
+        the dispersion (sympy & numba functions) and the Fermi surface are
+        shared by reference, the arrays of the Fermi surface are read-only
+        views, so the construction is O(1) and the memory does not grow with
+        the number of copies. Methods like runBandStructure rebind the
+        attributes of the copy (copy-on-write), the original is not affected."""
+        band = copy(self)
+        band._band_params = dict(self._band_params)
+        for name in fermi_surface_attributes:
+            value = getattr(self, name, None)
+            if isinstance(value, np.ndarray):
+                value = value.view()
+                value.flags.writeable = False
+            elif isinstance(value, list):
+                value = list(value)
+            setattr(band, name, value)
+        return band
+
+
     def erase_Fermi_surface(self):
         self.kf  = None
         self.vf  = None
@@ -236,6 +259,26 @@ class BandStructure:
     def v_3D_func(self, kx, ky, kz):
         return self.v_func(kx, ky, kz, *self.bandParameters())
 
+    def periods_func(self):
+        """Periods of the dispersion along kx, ky and kz: 2pi/a, 2pi/b, 2pi/c
+        or a multiple of them, e.g. 4pi/a, 4pi/b, 4pi/c for the body-centred
+        tz term. Any sum of them is a vector of the reciprocal lattice."""
+        k = np.random.default_rng(0).uniform(-pi, pi, (3, 20)) / np.array([self.a, self.b, self.c])[:, None]
+        energy = self.e_3D_func(k[0], k[1], k[2])
+        periods = np.empty(3)
+        for i, length in enumerate([self.a, self.b, self.c]):
+            for n in [1, 2, 4]:
+                k_shifted = k.copy()
+                k_shifted[i] += n * 2*pi / length
+                if np.allclose(self.e_3D_func(k_shifted[0], k_shifted[1], k_shifted[2]), energy,
+                               rtol=0, atol=1e-9 * self.energy_scale):
+                    break
+            else:
+                print("Warning! No period found along the axis " + "xyz"[i] + ", 8pi/" + "abc"[i] + " is used")
+                n = 4
+            periods[i] = n * 2*pi / length
+        return periods
+
     def mc_func(self):
         """
         The cyclotronic mass in units of m0 (the bare electron mass)
@@ -1,3 +1,5 @@
+import os
+import time
 import numpy as np
 from numpy import cos, sin, pi, exp, sqrt, arctan2, cosh, arccosh
 from scipy.integrate import odeint
@@ -6,7 +8,9 @@ from skimage import measure
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 from matplotlib.collections import LineCollection
-from copy import deepcopy
+
+from cuprates_transport.bandstructure import fermi_surface_attributes
+from cuprates_transport.scattering import gamma_fused_func, gamma_fused_batch_func, fused_terms
 ##<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<#
 
 ## Units ////////
@@ -26,10 +30,139 @@ units_move_eq =  e * Angstrom**2 * picosecond * meV / hbar**2
 ## This coefficient takes into accound all units and constant to prefactor Chambers formula
 units_chambers = 2 * e**2 / (2*pi)**3 * meV * picosecond / Angstrom / hbar**2
 
+## Scattering parameters with an analytic derivative in Conductivity.dgamma_func
+jacobian_params_list = ["gamma_0", "gamma_k", "power", "gamma_dos_max", "factor_arcs",
+                        "a0", "a1", "a2", "a3", "a4", "a5", "gamma_step", "l_path",
+                        "a_epsilon", "a_abs_epsilon", "a_T", "a_epsilon_2", "a_T2"]
+
+
+## Quadratures of the Fermi window >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>#
+fermi_quadrature_dict = {} # keys=(N, rule), values=(x, weights)
+
+def fermi_window_quadrature(N, rule="gauss_fermi"):
+    """Returns (x, weights) with x in units of kB*T such that
+    sum(weights * g(x * kB * T)) ~ integral of -df/dE * g(E) dE"""
+    if (N, rule) in fermi_quadrature_dict.keys():
+        return fermi_quadrature_dict[N, rule]
+    if rule == "gauss_tanh":
+        u, weights_u = np.polynomial.legendre.leggauss(N)
+        x, weights = 2 * np.arctanh(u), weights_u / 2
+    else:
+        ## Stieltjes procedure on a fine grid for the recurrence of the
+        ## orthogonal polynomials of -df/dE, then Golub-Welsch
+        x_grid = np.linspace(-120, 120, 4801)
+        w_grid = (x_grid[1] - x_grid[0]) / (4 * cosh(x_grid / 2)**2)
+        p_previous, p = np.zeros_like(x_grid), np.ones_like(x_grid)
+        a_list, b_list = [], []
+        for k in range(N):
+            norm = np.sum(w_grid * p**2)
+            a_list.append(np.sum(w_grid * x_grid * p**2) / norm)
+            if k == 0:
+                p_next = (x_grid - a_list[-1]) * p
+            else:
+                b_list.append(norm) # norm of the previous p is 1
+                p_next = (x_grid - a_list[-1]) * p - b_list[-1] * p_previous
+            p_previous, p = p / sqrt(norm), p_next / sqrt(norm)
+        jacobi_matrix = np.diag(a_list) + np.diag(sqrt(b_list), 1) + np.diag(sqrt(b_list), -1)
+        x, vectors = np.linalg.eigh(jacobi_matrix)
+        weights = vectors[0, :]**2 * np.sum(w_grid)
+    fermi_quadrature_dict[N, rule] = (x, weights)
+    return x, weights
+
+
+## Quadratures of the Chambers time integral >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>#
+time_quadratures_list = ["rectangle", "trapezoid", "simpson", "exponential"]
+
+def time_weights(N, dtime, rule="rectangle"):
+    """Weights of sum(weights * y) ~ integral of y over N times spaced by dtime
+    rectangle: dtime for all the times
+    trapezoid: dtime / 2 for the first and last time
+    simpson:   composite Simpson, the last segment uses its 3-point formula
+               if N is even"""
+    weights = dtime * np.ones(N, dtype=np.float64)
+    if rule in ["trapezoid", "exponential"] and N > 1:
+        weights[0] /= 2
+        weights[-1] /= 2
+    elif rule == "simpson" and N > 2:
+        N_odd = N - 1 + N % 2
+        weights[N_odd:] = 0
+        weights[:N_odd] = 2 * dtime / 3
+        weights[1:N_odd:2] = 4 * dtime / 3
+        weights[0] = dtime / 3
+        weights[N_odd - 1] = dtime / 3
+        if N_odd < N:
+            weights[-3:] += dtime / 12 * np.array([-1, 8, 5])
+    return weights
+
+def cumulative_time_integral(y, dtime, rule="rectangle"):
+    """Integral of y from the first time to each time along its last axis,
+    with the same rule as time_weights (simpson for exponential)"""
+    N = y.shape[-1]
+    integral = np.zeros(y.shape, dtype=np.float64)
+    if N == 1:
+        return integral
+    if rule == "rectangle":
+        segment = dtime * y[..., 1:]
+    elif rule in ["simpson", "exponential"] and N > 2:
+        ## 3-point formula of each segment, forward for the even segments
+        ## and backward for the odd ones to match composite Simpson
+        forward = dtime / 12 * (5 * y[..., :-2] + 8 * y[..., 1:-1] - y[..., 2:])
+        backward = dtime / 12 * (- y[..., :-2] + 8 * y[..., 1:-1] + 5 * y[..., 2:])
+        segment = np.empty(y.shape[:-1] + (N - 1,), dtype=np.float64)
+        n_even = np.arange(0, N - 2, 2)
+        n_odd = np.arange(1, N - 1, 2)
+        segment[..., n_even] = forward[..., n_even]
+        segment[..., n_odd] = backward[..., n_odd - 1]
+        if N % 2 == 0:
+            segment[..., N - 2] = backward[..., N - 3]
+    else:
+        segment = dtime / 2 * (y[..., :-1] + y[..., 1:])
+    np.cumsum(segment, axis=-1, out=integral[..., 1:])
+    return integral
+
+def exponential_segment_weights(delta):
+    """Returns (A, B, dA, dB) such that the integral over s in [0, 1] of
+    (y_0 * (1 - s) + y_1 * s) * exp(-delta * s) is y_0 * A + y_1 * B, dA and dB
+    are the derivatives with respect to delta. Taylor series for small delta."""
+    small = np.abs(delta) < 0.2
+    d = np.where(small, 1, delta)
+    e_d = exp(-d)
+    A = (d - 1 + e_d) / d**2
+    B = (1 - (1 + d) * e_d) / d**2
+    dA = (1 - e_d) / d**2 - 2 * A / d
+    dB = e_d / d - 2 * B / d
+    if np.any(small):
+        delta_s = delta[small]
+        A_s, B_s = np.zeros_like(delta_s), np.zeros_like(delta_s)
+        dA_s, dB_s = np.zeros_like(delta_s), np.zeros_like(delta_s)
+        term = np.ones_like(delta_s) # (-delta)**k / k!
+        for k in range(9):
+            A_s += term / ((k + 1) * (k + 2))
+            B_s += term / (k + 2)
+            dA_s -= term / ((k + 2) * (k + 3))
+            dB_s -= term / (k + 3)
+            term = term * (- delta_s) / (k + 1)
+        A[small], B[small], dA[small], dB[small] = A_s, B_s, dA_s, dB_s
+    return A, B, dA, dB
+
+
+## Interpolation of the trajectories >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>#
+def hermite_interpolation(k, dk, step, weight):
+    """Cubic Hermite interpolation of k[3, N_t] at the time (step + weight) * dtime,
+    dk[3, N_t] is dk/dt * dtime. Returns k and its derivative with weight"""
+    k_0, k_1, dk_0, dk_1 = k[:, step], k[:, step + 1], dk[:, step], dk[:, step + 1]
+    w2, w3 = weight**2, weight**3
+    k_w = ((2*w3 - 3*w2 + 1) * k_0 + (w3 - 2*w2 + weight) * dk_0 +
+           (3*w2 - 2*w3) * k_1 + (w3 - w2) * dk_1)
+    dk_w = ((6*w2 - 6*weight) * (k_0 - k_1) + (3*w2 - 4*weight + 1) * dk_0 +
+            (3*w2 - 2*weight) * dk_1)
+    return k_w, dk_w
+
 
 class Conductivity:
-    def __init__(self, bandObject, Bamp, Bphi=0, Btheta=0, N_time=500,
-                 T=0, dfdE_cut_percent=0.001, N_epsilon=20,
+    def __init__(self, bandObject, Bamp, Bphi=0, Btheta=0, N_time=500, time_quadrature="rectangle",
+                 rtol=1e-4, atol=1e-4,
+                 T=0, dfdE_cut_percent=0.001, N_epsilon=20, epsilon_quadrature="uniform",
                  gamma_0=15, a_epsilon = 0, a_abs_epsilon = 0, a_epsilon_2 = 0, a_T = 0, a_T2 = 0,
                  a_asym=0, p_asym=0,
                  gamma_dos_max=0,
@@ -38,10 +171,13 @@ class Conductivity:
                  l_path=0,
                  gamma_step=0, phi_step=0,
                  factor_arcs=1,
+                 fused_scattering=True,
+                 memory_budget=None, trajectories_dtype=np.float64,
+                 orbit_dispatch=False, orbit_sharing=False, chambers_engine="direct",
                  **trash):
 
         # Band object
-        self.bandObject = deepcopy(bandObject)
+        self.bandObject = bandObject.snapshot() # shared by reference, read-only
 
         # Magnetic field in degrees
         self._Bamp   = Bamp # in Tesla
@@ -54,10 +190,8 @@ class Conductivity:
         self._T = T # in Kelvin
         self._N_epsilon = N_epsilon
         self._dfdE_cut_percent = dfdE_cut_percent
-        if self._T != 0:
-            self.epsilon_array = np.linspace(-self.energyCutOff(self._dfdE_cut_percent * np.abs(self.dfdE(0))),
-                                              self.energyCutOff(self._dfdE_cut_percent * np.abs(self.dfdE(0))),
-                                              self._N_epsilon)
+        self._epsilon_quadrature = epsilon_quadrature # "uniform", "gauss_tanh" or "gauss_fermi"
+        self.epsilon_array_func()
 
 
         # Scattering rate energy-dependent
@@ -86,6 +220,17 @@ class Conductivity:
         self.a4 = a4
         self.a5 = a5
         self.l_path = l_path # in Angstrom, mean free path for gamma_vF
+        self.fused_scattering = fused_scattering # if True, gamma_tot is computed by the compiled kernel of scattering.py
+        self.memory_budget = memory_budget # in bytes, or "auto", if not None the Fermi surface is run by blocks
+        # and kft, vft & t_o_tau only hold the last block of points (not for the figures of the trajectories)
+        self.trajectories_dtype = trajectories_dtype # float32 halves the memory of kft, vft, t_o_tau & the time weights
+        self.orbit_dispatch = orbit_dispatch # if True, the closed orbits are integrated by periodic sums
+        self.orbit_sharing = orbit_sharing # if True, the points on the same orbit share one integrated trajectory
+        self.chambers_engine = chambers_engine # "direct" or "orbit", see shared_orbit_integral
+        if self.chambers_engine == "orbit" and not (self.orbit_dispatch and self.orbit_sharing):
+            print("Warning! chambers_engine = orbit needs orbit_dispatch and orbit_sharing, they are set to True")
+            self.orbit_dispatch = True
+            self.orbit_sharing = True
 
         # Time parameters
         self.time_max = 8 * self.tau_total_max()  # in picoseconds
@@ -93,10 +238,11 @@ class Conductivity:
         self.dtime = self.time_max / self.N_time
         self.time_array = np.arange(0, self.time_max, self.dtime)
         self.dtime_array = np.append(0, self.dtime * np.ones_like(self.time_array))[:-1] # integrand for tau_function
+        self.time_quadrature = time_quadrature # "rectangle", "trapezoid", "simpson" or "exponential"
 
         ## Precision differential equation solver
-        self.rtol = 1e-4 # default is 1.49012e-8
-        self.atol = 1e-4 # default is 1.49012e-8
+        self.rtol = rtol # default of odeint is 1.49012e-8
+        self.atol = atol # default of odeint is 1.49012e-8
 
         # Time-dependent kf, vf
         self.kft = np.empty(1)
@@ -105,6 +251,12 @@ class Conductivity:
         self.t_o_tau = np.empty(1) # array[i0, i_t] with i0 index of the initial index
         # i_t index of the time from the starting position
 
+        # Orbits of the trajectories, see classify_orbits
+        self.orbits = None
+        self.orbit_representatives = None # index of the point whose trajectory is integrated for each point
+        self.orbit_shifts = None # time shift of each point on the trajectory of its representative, in ps
+        self.orbit_timing = {"classification": 0, "closed": 0, "open": 0, "long": 0} # in seconds, summed over the runs
+
         # Product of [vf x int(vft*exp(-t/tau))]
         self.v_product = np.empty(1)
 
@@ -115,6 +267,11 @@ class Conductivity:
         # Thermal tensor: x, y, z = 0, 1, 2
         self.beta = np.empty((3,3), dtype= np.float64)
 
+        # Table of sigma_ij(epsilon) for the temperature sweeps
+        self.epsilon_table = None
+        self.epsilon_table_cut = None # dfdE_cut of the window of the table
+        self.sigma_epsilon_table = None # array[i_epsilon, i, j]
+
 
 
     ## Properties >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>#
@@ -154,37 +311,77 @@ class Conductivity:
         self.dtime_array = np.append(0, self.dtime * np.ones_like(self.time_array))[:-1]
     N_time = property(_get_N_time, _set_N_time)
 
+    def _get_time_quadrature(self):
+        return self._time_quadrature
+    def _set_time_quadrature(self, time_quadrature):
+        if time_quadrature not in time_quadratures_list:
+            print("Warning! " + str(time_quadrature) + " is not a time quadrature, rectangle is used")
+            time_quadrature = "rectangle"
+        self._time_quadrature = time_quadrature
+    time_quadrature = property(_get_time_quadrature, _set_time_quadrature)
+
     def _get_T(self):
         return self._T
     def _set_T(self, T):
         self._T = T
-        if self._T != 0:
-            self.epsilon_array = np.linspace(-self.energyCutOff(self._dfdE_cut_percent * np.abs(self.dfdE(0))),
-                                              self.energyCutOff(self._dfdE_cut_percent * np.abs(self.dfdE(0))),
-                                              self._N_epsilon)
+        self.epsilon_array_func()
     T = property(_get_T, _set_T)
 
     def _get_N_epsilon(self):
         return self._N_epsilon
     def _set_N_epsilon(self, N_epsilon):
         self._N_epsilon = N_epsilon
-        self.epsilon_array = np.linspace(-self.energyCutOff(self._dfdE_cut_percent * np.abs(self.dfdE(0))),
-                                          self.energyCutOff(self._dfdE_cut_percent * np.abs(self.dfdE(0))),
-                                          self._N_epsilon)
+        self.epsilon_array_func()
     N_epsilon = property(_get_N_epsilon, _set_N_epsilon)
 
     def _get_dfdE_cut_percent(self):
         return self._dfdE_cut_percent
     def _set_dfdE_cut_percent(self, dfdE_cut_percent):
         self._dfdE_cut_percent  = dfdE_cut_percent
-        self.epsilon_array = np.linspace(-self.energyCutOff(self._dfdE_cut_percent * np.abs(self.dfdE(0))),
-                                          self.energyCutOff(self._dfdE_cut_percent * np.abs(self.dfdE(0))),
-                                          self._N_epsilon)
+        self.epsilon_array_func()
     dfdE_cut_percent = property(_get_dfdE_cut_percent, _set_dfdE_cut_percent)
 
+    def _get_epsilon_quadrature(self):
+        return self._epsilon_quadrature
+    def _set_epsilon_quadrature(self, epsilon_quadrature):
+        self._epsilon_quadrature = epsilon_quadrature
+        self.epsilon_array_func()
+    epsilon_quadrature = property(_get_epsilon_quadrature, _set_epsilon_quadrature)
+
 
     ## Methods >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>#
+    def epsilon_array_func(self):
+        """Energies epsilon_array and their weights epsilon_weights such that
+        sum(epsilon_weights * g(epsilon_array)) is the integral of -df/dE * g
+        uniform:     N_epsilon points between +/- energyCutOff, rectangle rule
+        gauss_tanh:  Gauss-Legendre in u = tanh(epsilon / 2kBT), as -df/dE dE = du / 2,
+                     good for sigma, slow to converge for alpha and beta
+        gauss_fermi: Gauss quadrature for the weight -df/dE, with 3 points it
+                     is the Sommerfeld expansion up to (kBT)^4, 3-5 points give
+                     sigma, alpha and beta better than 20 uniform points"""
+        if self._T == 0:
+            return
+        if self._epsilon_quadrature == "uniform":
+            self.epsilon_array = np.linspace(-self.energyCutOff(self._dfdE_cut_percent * np.abs(self.dfdE(0))),
+                                              self.energyCutOff(self._dfdE_cut_percent * np.abs(self.dfdE(0))),
+                                              self._N_epsilon)
+            d_epsilon = self.epsilon_array[1] - self.epsilon_array[0]
+            self.epsilon_weights = d_epsilon * (- self.dfdE(self.epsilon_array))
+        elif self._epsilon_quadrature in ["gauss_tanh", "gauss_fermi"]:
+            x, weights = fermi_window_quadrature(self._N_epsilon, self._epsilon_quadrature)
+            self.epsilon_array = x * kB * self._T
+            self.epsilon_weights = weights
+        else:
+            print("Warning! " + str(self._epsilon_quadrature) + " is not an epsilon quadrature, uniform is used")
+            self._epsilon_quadrature = "uniform"
+            self.epsilon_array_func()
+
+
     def runTransport(self):
+        if self.memory_budget is not None:
+            self.sigma = np.zeros((3, 3), dtype=np.float64)
+            self.alpha = np.zeros((3, 3), dtype=np.float64)
+            self.beta  = np.zeros((3, 3), dtype=np.float64)
         if self._T != 0:
             #!!!! Add a warning if bandObject not already discretized
             self.dos_k_epsilon      = {}
@@ -192,9 +389,15 @@ class Conductivity:
             self.kft_epsilon        = {}
             self.vft_epsilon        = {}
             self.t_o_tau_epsilon = {}
-
-            for epsilon in self.epsilon_array:
-                self.bandObject.runBandStructure(epsilon = epsilon, printDoping=False)
+            self.orbits_epsilon     = {}
+
+            for epsilon, weight in self.epsilon_shells_func():
+                if self.memory_budget is not None:
+                    sigma_epsilon = self.sigma_epsilon_chunked(epsilon)
+                    self.sigma += weight * self.integrand_coeff(epsilon, "sigma") * sigma_epsilon
+                    self.alpha += weight * self.integrand_coeff(epsilon, "alpha") * sigma_epsilon
+                    self.beta  += weight * self.integrand_coeff(epsilon, "beta") * sigma_epsilon
+                    continue
                 self.solveMovementFunc()
                 self.t_o_tau_func(epsilon)
                 self.dos_k_epsilon[epsilon]      = self.bandObject.dos_k
@@ -202,10 +405,11 @@ class Conductivity:
                 self.kft_epsilon[epsilon]        = self.kft
                 self.vft_epsilon[epsilon]        = self.vft
                 self.t_o_tau_epsilon[epsilon]    = self.t_o_tau
+                self.orbits_epsilon[epsilon]     = self.orbits
                 ## !!!!  Do not forget to update scattering rates !!! ##
                 ## Create properties for tmax, etc.
-            self.bandObject.runBandStructure(epsilon = 0, printDoping=False)
-            # this last one is to be sure the bandObject is at the FS at the end
+        elif self.memory_budget is not None:
+            self.sigma = self.sigma_epsilon_chunked()
         else:
             self.solveMovementFunc()
             self.t_o_tau_func()
@@ -214,6 +418,63 @@ class Conductivity:
         self.gamma_tot_min = 1 / self.tau_total_max() # in THz
 
 
+    def epsilon_shells_func(self, epsilon_array=None, epsilon_weights=None):
+        """Yields (epsilon, weight) of the Fermi window, or of epsilon_array,
+        with the Fermi surface of epsilon in bandObject. The Fermi surface at
+        epsilon = 0 is put back at the end."""
+        if epsilon_array is None:
+            epsilon_array, epsilon_weights = self.epsilon_array, self.epsilon_weights
+        ## Fermi surface at epsilon = 0, to put back at the end without
+        ## discretizing it again
+        shell_0 = None
+        if self.bandObject.kf is not None:
+            shell_0 = {name: getattr(self.bandObject, name) for name in fermi_surface_attributes}
+            shell_0["number_of_points_per_kz_list"] = list(shell_0["number_of_points_per_kz_list"]) # appended by discretize_fermi_surface
+
+        for epsilon, weight in zip(epsilon_array, epsilon_weights):
+            self.bandObject.runBandStructure(epsilon = epsilon, printDoping=False)
+            yield epsilon, weight
+
+        if shell_0 is None:
+            self.bandObject.runBandStructure(epsilon = 0, printDoping=False)
+            # this last one is to be sure the bandObject is at the FS at the end
+        else:
+            for name, value in shell_0.items():
+                setattr(self.bandObject, name, value)
+
+
+    def chunk_size_func(self):
+        """Number of points of the Fermi surface in each block so that the
+        arrays of a block fit in memory_budget: kft, vft, t_o_tau and the
+        weights of the time integral in trajectories_dtype (8 arrays of N_time
+        per point) and the float64 temporaries, kft of odeint and the
+        scattering rates (4 arrays). "auto" is half of the memory available."""
+        memory_budget = self.memory_budget
+        if memory_budget == "auto":
+            memory_budget = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / 2
+        itemsize = np.dtype(self.trajectories_dtype).itemsize
+        bytes_per_point = (8 * itemsize + 4 * 8) * self.time_array.shape[0]
+        return max(1, int(memory_budget // bytes_per_point))
+
+    def sigma_epsilon_chunked(self, epsilon=0, ij_list=None):
+        """sigma_epsilon[i, j] for all i, j (or ij_list) computed by blocks of
+        chunk_size_func points of the Fermi surface, each block is reduced as
+        soon as its trajectories are known, so the peak memory does not depend
+        on the number of points. Only the trajectories of the last block are kept."""
+        if ij_list is None:
+            ij_list = [(i, j) for i in range(3) for j in range(3)]
+        kf, vf = self.bandObject.kf, self.bandObject.vf
+        dos_k, dkf = self.bandObject.dos_k, self.bandObject.dkf
+        chunk_size = self.chunk_size_func()
+        sigma_epsilon = np.zeros((3, 3), dtype=np.float64)
+        for start in range(0, kf.shape[1], chunk_size):
+            block = slice(start, start + chunk_size)
+            self.solveMovementFunc(kf[:, block], vf[:, block])
+            self.t_o_tau_func(epsilon)
+            sigma_epsilon += self.sigma_epsilon_tensor(dos_k[block], dkf[block], self.kft,
+                                                       self.vft, self.t_o_tau, ij_list, self.orbits)
+        return sigma_epsilon
+
     def BFunc(self):
         B = self._Bamp * np.array([sin(self._Btheta*pi/180) * cos(self._Bphi*pi/180),
                                    sin(self._Btheta*pi/180) * sin(self._Bphi*pi/180),
@@ -230,29 +491,134 @@ class Conductivity:
         return np.vstack((product_x, product_y, product_z))
 
 
-    def solveMovementFunc(self):
+    def solveMovementFunc(self, kf=None, vf=None):
+        """Trajectories kft & vft of the points kf (default all the Fermi surface)"""
+        if kf is None:
+            kf, vf = self.bandObject.kf, self.bandObject.vf
         len_t = self.time_array.shape[0]
-        len_kf = self.bandObject.kf.shape[1]
+        len_kf = kf.shape[1]
 
         ## Magnetic Field ON
         if self.Bamp != 0:
-            # Flatten to get all the initial kf solved at the same time
-            self.bandObject.kf.shape = (3 * len_kf,)
-            # Sovle differential equation
-            self.kft = odeint(self.diffEqFunc, self.bandObject.kf, self.time_array, rtol = self.rtol, atol = self.atol).transpose()
-            # Reshape arrays
-            self.bandObject.kf.shape = (3, len_kf)
-            self.kft.shape = (3, len_kf, len_t)
-            # Velocity function of time
-            self.vft = np.empty_like(self.kft, dtype = np.float64)
+            if self.orbit_sharing:
+                self.kft = self.shared_trajectories_func(kf, vf)
+            else:
+                # Flatten to get all the initial kf solved at the same time
+                kf = kf.reshape(3 * len_kf)
+                # Sovle differential equation
+                self.kft = odeint(self.diffEqFunc, kf, self.time_array, rtol = self.rtol, atol = self.atol).transpose()
+                # Reshape arrays
+                self.kft.shape = (3, len_kf, len_t)
+            # Velocity function of time, stored directly in trajectories_dtype
+            self.vft = np.empty(self.kft.shape, dtype = self.trajectories_dtype)
             self.vft[0, :, :], self.vft[1, :, :], self.vft[2, :, :] = self.bandObject.v_3D_func(self.kft[0, :, :], self.kft[1, :, :], self.kft[2, :, :])
+            self.orbits = self.classify_orbits(self.kft) if self.orbit_dispatch else None
+            if self.orbits is not None and self.orbit_sharing:
+                self.orbits["representatives"] = self.orbit_representatives
+                self.orbits["shifts"] = self.orbit_shifts
+            if self.trajectories_dtype != np.float64:
+                self.kft = np.ascontiguousarray(self.kft, dtype=self.trajectories_dtype)
         ## Magnetic Field OFF
         else:
             self.kft = np.empty((3, len_kf, 1), dtype = np.float64)
             self.vft = np.empty((3, len_kf, 1), dtype = np.float64)
-            self.kft[0, :, 0], self.kft[1, :, 0], self.kft[2, :, 0] = self.bandObject.kf[0, :], self.bandObject.kf[1, :], self.bandObject.kf[2, :]
-            self.vft[0, :, 0], self.vft[1, :, 0], self.vft[2, :, 0] = self.bandObject.vf[0, :], self.bandObject.vf[1, :], self.bandObject.vf[2, :]
-
+            self.kft[0, :, 0], self.kft[1, :, 0], self.kft[2, :, 0] = kf[0, :], kf[1, :], kf[2, :]
+            self.vft[0, :, 0], self.vft[1, :, 0], self.vft[2, :, 0] = vf[0, :], vf[1, :], vf[2, :]
+            self.orbits = None
+
+
+    def shared_trajectories_func(self, kf, vf):
+        """Trajectories kft of the points kf (velocities vf), integrated once
+        per orbit. The points are grouped by k.B, which is constant on an orbit
+        (for B // z, the kz planes), and the fastest point of each group is
+        integrated, with 100 times lower rtol & atol as its error is shared.
+        If its orbit is periodic (classify_orbits), the points of the group
+        within 2% of a time step of it start at a time shift s on it:
+        k(t) = k_rep(t + s), read on the representative modulo its period
+        (k_rep(t + T) = k_rep(t) + G) by cubic Hermite interpolation between
+        the time steps. The points of the groups on long orbits are
+        integrated on their own, the others not on the orbit of their
+        representative are grouped again in the next pass."""
+        len_kf, len_t = kf.shape[1], self.time_array.shape[0]
+        lattice = self.bandObject.periods_func()[:, None, None]
+        kB = (self._B_vector / np.linalg.norm(self._B_vector)) @ kf
+        speed = sqrt(np.sum(self.crossProductVectorized(vf[0], vf[1], vf[2])**2, axis=0))
+        kft = np.empty((3, len_kf, len_t), dtype=np.float64)
+        self.orbit_representatives = np.arange(len_kf)
+        self.orbit_shifts = np.zeros(len_kf)
+        pending = np.ones(len_kf, dtype=bool)
+        direct = np.zeros(len_kf, dtype=bool) # on a long orbit, integrated on their own
+        while np.any(pending):
+            ## Points on the long orbits, integrated on their own
+            points = np.nonzero(pending & direct)[0]
+            if len(points) > 0:
+                kft[:, points] = odeint(self.diffEqFunc, kf[:, points].reshape(-1), self.time_array,
+                                        rtol = self.rtol, atol = self.atol).transpose().reshape(3, len(points), len_t)
+                pending[points] = False
+            order = np.nonzero(pending)[0]
+            if len(order) == 0:
+                break
+
+            ## Groups of pending points with the same k.B, the fastest first
+            order = order[np.argsort(kB[order], kind="stable")]
+            group = np.cumsum(np.diff(kB[order], prepend=-np.inf) > 1e-8) - 1
+            sort = np.lexsort((-speed[order], group))
+            order, group = order[sort], group[sort]
+            new_group = np.diff(group, prepend=-1) != 0
+            representatives = order[new_group]
+
+            ## Their error is shared by all the points of their orbit,
+            ## they are integrated with 100 times lower tolerances
+            k_rep = odeint(self.diffEqFunc, kf[:, representatives].reshape(-1), self.time_array,
+                           rtol = self.rtol / 100, atol = self.atol / 100).transpose()
+            k_rep = k_rep.reshape(3, len(representatives), len_t)
+            kft[:, representatives] = k_rep
+            pending[representatives] = False
+            orbits = self.classify_orbits(k_rep)
+
+            for n, representative in enumerate(representatives):
+                members = order[(group == n) & (order != representative)]
+                if len(members) == 0:
+                    continue
+                if orbits["labels"][n] == "long":
+                    direct[members] = True
+                    continue
+                index, period = orbits["index"][n], orbits["period"][n]
+                G_period = orbits["G"][:, n][:, None, None]
+                orbit = np.ascontiguousarray(k_rep[:, n, :index + 2])
+                dorbit = - units_move_eq * self.crossProductVectorized(*self.bandObject.v_3D_func(*orbit)) * self.dtime
+                ## Closest segment of the orbit to each member, modulo the lattice
+                dk = kf[:, members][:, :, None] - orbit[:, None, :-1]
+                delta = np.diff(orbit, axis=1)[:, None, :]
+                G = lattice * np.round(dk / lattice)
+                weight = np.clip(np.sum((dk - G) * delta, axis=0) /
+                                 np.maximum(np.sum(delta**2, axis=0), 1e-300), 0, 1)
+                segment = np.argmin(np.sum((dk - G - weight * delta)**2, axis=0), axis=1)
+                rows = np.arange(len(members))
+                weight, G_member = weight[rows, segment], G[:, rows, segment]
+                ## Time on the segment by Newton's method on the interpolation
+                k_member = kf[:, members] - G_member
+                for i in range(3):
+                    k_w, dk_w = hermite_interpolation(orbit, dorbit, segment, weight)
+                    weight = np.clip(weight - np.sum((k_w - k_member) * dk_w, axis=0) /
+                                     np.maximum(np.sum(dk_w**2, axis=0), 1e-300), 0, 1)
+                k_w, dk_w = hermite_interpolation(orbit, dorbit, segment, weight)
+                on_orbit = (sqrt(np.sum((k_w - k_member)**2, axis=0)) <
+                            0.02 * np.mean(sqrt(np.sum(delta**2, axis=0))))
+                members = members[on_orbit]
+                shift = (segment + weight)[on_orbit] * self.dtime
+
+                ## Time shifted trajectories, modulo the period
+                time_shifted = self.time_array[None, :] + shift[:, None]
+                nb_periods = np.floor(time_shifted / period)
+                position = (time_shifted - nb_periods * period) / self.dtime
+                step = np.minimum(np.floor(position).astype(int), index)
+                kft[:, members] = (hermite_interpolation(orbit, dorbit, step, position - step)[0] +
+                                   nb_periods * G_period + G_member[:, on_orbit, None])
+                self.orbit_representatives[members] = representative
+                self.orbit_shifts[members] = shift
+                pending[members] = False
+        return kft
 
     def diffEqFunc(self, k, t):
         len_k = int(k.shape[0]/3)
@@ -263,6 +629,86 @@ class Conductivity:
         return dkdt
 
 
+    def classify_orbits(self, kft):
+        """Labels the orbit of each trajectory of kft[3, N_kf, N_t]:
+            closed: k(T) = k(0) after the period T
+            open:   k(T) = k(0) + G, G a sum of the periods of the dispersion
+                    (BandStructure.periods_func), e.g. along kz near theta = 90
+            long:   no return within time_max
+        The period is the first closest approach to k(0) modulo the lattice,
+        found on a parabola through three time steps, closer than 2% of a time
+        step. Returns a dict of arrays over the points:
+        labels, period (ps, nan if long), index & fraction (T = (index +
+        fraction) * dtime), G, area (of the closed orbits in the plane
+        perpendicular to B, in A^-2, else nan), kB (k.B / |B|) and extremal
+        (True for the closed orbits whose area is a local extremum versus kB)."""
+        t0 = time.time()
+        kft = np.asarray(kft, dtype=np.float64)
+        len_kf, len_t = kft.shape[1], kft.shape[2]
+        lattice = self.bandObject.periods_func()[:, None]
+        B_unit = self._B_vector / np.linalg.norm(self._B_vector)
+
+        dk = kft - kft[:, :, :1]
+        distance = sqrt(np.sum((dk - lattice[:, :, None] * np.round(dk / lattice[:, :, None]))**2, axis=0))
+        step = np.mean(sqrt(np.sum(np.diff(kft, axis=2)**2, axis=0)), axis=1)
+        ## Closest approaches to k(0) modulo the lattice, once it has gone away
+        away = np.maximum.accumulate(distance, axis=1) > 3 * step[:, None]
+        minimum = (distance < step[:, None]) & away
+        minimum[:, 1:-1] &= (distance[:, 1:-1] <= distance[:, :-2]) & (distance[:, 1:-1] < distance[:, 2:])
+        minimum[:, [0, -1]] = False
+        point, m = np.nonzero(minimum)
+
+        ## Parabola through the time steps m - 1, m, m + 1: k(u) = k_m + u * a1 + u**2 * a2,
+        ## its closest point to k(0) + G at m + u by Newton's method
+        G = lattice * np.round(dk[:, point, m] / lattice)
+        d = dk[:, point, m] - G
+        a1 = (kft[:, point, m + 1] - kft[:, point, m - 1]) / 2
+        a2 = (kft[:, point, m + 1] - 2 * kft[:, point, m] + kft[:, point, m - 1]) / 2
+        u = np.clip(- np.sum(d * a1, axis=0) / np.maximum(np.sum(a1**2, axis=0), 1e-300), -1, 1)
+        for n in range(3):
+            k_u, dk_u = d + u * a1 + u**2 * a2, a1 + 2 * u * a2
+            u = np.clip(u - np.sum(k_u * dk_u, axis=0) /
+                        np.maximum(np.sum(dk_u**2 + k_u * 2 * a2, axis=0), 1e-300), -1, 1)
+        residual = sqrt(np.sum((d + u * a1 + u**2 * a2)**2, axis=0))
+
+        ## Period at the first approach closer than 2% of a time step
+        accepted = residual < 0.02 * step[point]
+        periodic_points, first = np.unique(point[accepted], return_index=True)
+        periodic = np.zeros(len_kf, dtype=bool)
+        periodic[periodic_points] = True
+        time_index = np.zeros(len_kf)
+        time_index[periodic_points] = (m + u)[accepted][first]
+        index = np.minimum(np.floor(time_index).astype(int), len_t - 2)
+        fraction = time_index - index
+        G_period = np.zeros((3, len_kf))
+        G_period[:, periodic_points] = G[:, accepted][:, first]
+
+        labels = np.full(len_kf, "long", dtype="<U6")
+        labels[periodic] = "open"
+        closed = periodic & np.all(G_period == 0, axis=0)
+        labels[closed] = "closed"
+        period = np.where(periodic, (index + fraction) * self.dtime, np.nan)
+
+        ## Area of the closed orbits, polygon of the time steps before T
+        cross = np.einsum("i,ikt->kt", B_unit, np.cross(dk[:, :, :-1], dk[:, :, 1:], axis=0))
+        before = np.arange(len_t - 1)[None, :] < index[:, None]
+        area = np.where(closed, np.abs(np.sum(cross * before, axis=1)) / 2, np.nan)
+
+        ## Extremal areas, compared with the closed orbits of the nearest kB
+        kB = B_unit @ kft[:, :, 0]
+        extremal = np.zeros(len_kf, dtype=bool)
+        orbits_kB = np.unique(np.round(kB[closed], 6))
+        area_kB = np.array([np.mean(area[closed][np.round(kB[closed], 6) == value])
+                            for value in orbits_kB])
+        for n in range(1, len(orbits_kB) - 1):
+            if (area_kB[n] - area_kB[n-1]) * (area_kB[n] - area_kB[n+1]) > 0:
+                extremal[closed & (np.round(kB, 6) == orbits_kB[n])] = True
+
+        self.orbit_timing["classification"] += time.time() - t0
+        return {"labels": labels, "period": period, "index": index, "fraction": fraction,
+                "G": G_period, "area": area, "kB": kB, "extremal": extremal}
+
+
     def omegac_tau_func(self):
         dks = self.bandObject.dks / Angstrom # in m^-1
         kf = self.bandObject.kf
@@ -281,7 +727,7 @@ class Conductivity:
 
 
 
-    def factor_arcs_Func(self, kx, ky, kz):
+    def out_FBZ_AF_Func(self, kx, ky, kz):
         # line ky = kx + pi
         d1 = ky * self.bandObject.b - kx * self.bandObject.a - pi  # line ky = kx + pi
         d2 = ky * self.bandObject.b - kx * self.bandObject.a + pi  # line ky = kx - pi
@@ -289,7 +735,10 @@ class Conductivity:
         d4 = ky * self.bandObject.b + kx * self.bandObject.a + pi  # line ky = -kx - pi
 
         is_in_FBZ_AF = np.logical_and((d1 <= 0)*(d2 >= 0), (d3 <= 0)*(d4 >= 0))
-        is_out_FBZ_AF = np.logical_not(is_in_FBZ_AF)
+        return np.logical_not(is_in_FBZ_AF)
+
+    def factor_arcs_Func(self, kx, ky, kz):
+        is_out_FBZ_AF = self.out_FBZ_AF_Func(kx, ky, kz)
         factor_out_of_FBZ_AF = np.ones_like(kx)
         factor_out_of_FBZ_AF[is_out_FBZ_AF] = self.factor_arcs
         return factor_out_of_FBZ_AF
@@ -361,9 +810,17 @@ class Conductivity:
         x = np.where(x == 0, 1.0e-20, x)
         return (self.a_asym * kB * self.T) * ((x + self.p_asym)/2) * np.cosh(x/2) / np.sinh((x + self.p_asym)/2) / np.cosh(self.p_asym/2)
 
+    def gamma_total_func(self, kx, ky, kz, vx, vy, vz, epsilon = 0):
+        """Computes the total scattering rate in THz"""
+        if self.fused_scattering == True:
+            return gamma_fused_func(self, kx, ky, kz, vx, vy, vz, epsilon)
+        return 1 / self.tau_total_func(kx, ky, kz, vx, vy, vz, epsilon)
+
     def tau_total_func(self, kx, ky, kz, vx, vy, vz, epsilon = 0):
         """Computes the total lifetime based on the input model
         for the scattering rate"""
+        if self.fused_scattering == True:
+            return 1 / gamma_fused_func(self, kx, ky, kz, vx, vy, vz, epsilon)
 
         ## Initialize
         gamma_tot = self.gamma_0 * np.ones_like(kx)
@@ -393,27 +850,109 @@ class Conductivity:
         return 1/gamma_tot
 
 
+    def phi_Func(self, kx, ky, kz):
+        ## Make sure kx and ky are in the FBZ to compute Phi.
+        kx = np.remainder(kx + pi / self.bandObject.a, 2*pi / self.bandObject.a) - pi / self.bandObject.a
+        ky = np.remainder(ky + pi / self.bandObject.b, 2*pi / self.bandObject.b) - pi / self.bandObject.b
+        return arctan2(ky, kx)
+
+    def dgamma_func(self, param_name, kx, ky, kz, vx, vy, vz, epsilon = 0):
+        """Computes the derivative of the total scattering rate 1 / tau_total_func
+        with respect to the scattering parameter param_name"""
+        if self.factor_arcs!=1:
+            factor = self.factor_arcs_Func(kx, ky, kz)
+        else:
+            factor = np.ones_like(kx)
+
+        if param_name == "gamma_0":
+            dgamma = np.ones_like(kx)
+        elif param_name == "gamma_k" or param_name == "power":
+            cos_2phi = np.abs(cos(2*self.phi_Func(kx, ky, kz)))
+            dgamma = cos_2phi**self.power
+            if param_name == "power":
+                dgamma = self.gamma_k * dgamma * np.log(np.where(cos_2phi == 0, 1, cos_2phi))
+        elif param_name in ["a0", "a1", "a2", "a3", "a4", "a5"]:
+            phi = self.phi_Func(kx, ky, kz)
+            phi_p = np.abs((np.mod(phi, pi/2)-pi/4))
+            poly = self.a0 + self.a1 * phi_p + self.a2 * phi_p**2 + self.a3 * phi_p**3 + self.a4 * phi_p**4 + self.a5 * phi_p**5
+            dgamma = np.where(poly < 0, -1, 1) * phi_p**int(param_name[1])
+        elif param_name == "gamma_step":
+            phi = self.phi_Func(kx, ky, kz)
+            index_low = (np.mod(phi, pi/2) >= (pi/4 - self.phi_step)) * (np.mod(phi, pi/2) <= (pi/4 + self.phi_step))
+            dgamma = np.logical_not(index_low).astype(np.float64)
+        elif param_name == "gamma_dos_max":
+            dos = 1 / sqrt( vx**2 + vy**2 + vz**2 )
+            dgamma = dos / np.max(self.bandObject.dos_k)
+        elif param_name == "l_path":
+            dgamma = - self.gamma_vF_Func(vx, vy, vz) / self.l_path
+        elif param_name in ["a_epsilon", "a_abs_epsilon", "a_T"]:
+            ## gamma = sqrt(x_epsilon**2 + x_T**2)
+            if param_name == "a_T":
+                dx = kB * meV / hbar * 1e-12 * self.T
+                x = self.a_T * dx
+            else:
+                dx = epsilon if param_name == "a_epsilon" else np.abs(epsilon)
+                x = self.a_epsilon * epsilon + self.a_abs_epsilon * np.abs(epsilon)
+            gamma = self.gamma_skew_marginal_fl(epsilon)
+            if gamma != 0:
+                dgamma = x * dx / gamma * np.ones_like(kx)
+            else:
+                dgamma = np.abs(dx) * np.ones_like(kx)
+        elif param_name == "a_epsilon_2":
+            dgamma = epsilon**2 * np.ones_like(kx)
+        elif param_name == "a_T2":
+            dgamma = (kB * meV / hbar * 1e-12 * self.T)**2 * np.ones_like(kx)
+        elif param_name == "factor_arcs":
+            ## gamma_tot is proportional to factor_arcs outside the AF FBZ
+            gamma_tot = self.gamma_total_func(kx, ky, kz, vx, vy, vz, epsilon)
+            return gamma_tot / factor * self.out_FBZ_AF_Func(kx, ky, kz)
+        else:
+            print("Warning! No derivative of the scattering rate for " + param_name)
+            dgamma = np.zeros_like(kx)
+
+        return dgamma * factor
+
     def t_o_tau_func(self, epsilon = 0):
         ## Integral from 0 to t of dt' / tau( k(t') ) or dt' * gamma( k(t') )
         ## Magnetic Field ON
         if self.Bamp !=0:
-            self.t_o_tau = np.cumsum( self.dtime_array /
-                                     (self.tau_total_func(self.kft[0, :, :],
-                                                          self.kft[1, :, :],
-                                                          self.kft[2, :, :],
-                                                          self.vft[0, :, :],
-                                                          self.vft[1, :, :],
-                                                          self.vft[2, :, :],
-                                                          epsilon)), axis = 1)
+            gamma_t = self.gamma_total_func(self.kft[0, :, :],
+                                            self.kft[1, :, :],
+                                            self.kft[2, :, :],
+                                            self.vft[0, :, :],
+                                            self.vft[1, :, :],
+                                            self.vft[2, :, :],
+                                            epsilon)
+            if self._time_quadrature == "rectangle":
+                gamma_t *= self.dtime_array
+                self.t_o_tau = np.cumsum(gamma_t, axis = 1, out = gamma_t)
+            else:
+                self.t_o_tau = cumulative_time_integral(gamma_t, self.dtime, self._time_quadrature)
+            ## the sum is done in float64, then stored with the trajectories
+            self.t_o_tau = self.t_o_tau.astype(self.trajectories_dtype, copy=False)
+        ## Magnetic Field OFF
+        else:
+            self.t_o_tau = self.gamma_total_func(self.kft[0, :, 0],
+                                                 self.kft[1, :, 0],
+                                                 self.kft[2, :, 0],
+                                                 self.vft[0, :, 0],
+                                                 self.vft[1, :, 0],
+                                                 self.vft[2, :, 0],
+                                                 epsilon)
+
+    def dt_o_tau_func(self, param_name, kft, vft, epsilon = 0):
+        """Derivative of t_o_tau with respect to the scattering parameter param_name"""
+        ## Magnetic Field ON
+        if self.Bamp !=0:
+            return cumulative_time_integral(self.dgamma_func(param_name, kft[0, :, :], kft[1, :, :], kft[2, :, :],
+                                                             vft[0, :, :], vft[1, :, :], vft[2, :, :],
+                                                             epsilon),
+                                            self.dtime, self._time_quadrature)
         ## Magnetic Field OFF
         else:
-            self.t_o_tau = 1 / self.tau_total_func(self.kft[0, :, 0],
-                                                   self.kft[1, :, 0],
-                                                   self.kft[2, :, 0],
-                                                   self.vft[0, :, 0],
-                                                   self.vft[1, :, 0],
-                                                   self.vft[2, :, 0],
-                                                   epsilon)
+            return self.dgamma_func(param_name, kft[0, :, 0], kft[1, :, 0], kft[2, :, 0],
+                                    vft[0, :, 0], vft[1, :, 0], vft[2, :, 0],
+                                    epsilon)
 
     def tau_total_max(self):
         # Compute the tau_max (the longest time between two collisions)
@@ -430,27 +969,271 @@ class Conductivity:
                                           vf[0, :], vf[1, :], vf[2, :]))
 
 
-    def velocity_product(self, kft, vft, t_o_tau, i, j):
+    def time_weights_func(self, t_o_tau):
+        """Weights of the Chambers time integral along the last axis,
+        sum(vft[j] * weights) ~ integral of vft[j] * exp(-t_o_tau) dt.
+        exponential: vft[j] and t_o_tau are linear on each time segment and
+        exp(-t_o_tau) is integrated exactly, so a fast decay over one dtime
+        (large gamma or small N_time) stays accurate"""
+        if self._time_quadrature == "exponential":
+            A, B, dA, dB = exponential_segment_weights(t_o_tau[..., 1:] - t_o_tau[..., :-1])
+            exp_t_o_tau = exp(-t_o_tau[..., :-1]) * self.dtime
+            weights = np.zeros_like(t_o_tau)
+            weights[..., :-1] += exp_t_o_tau * A
+            weights[..., 1:] += exp_t_o_tau * B
+            return weights
+        return exp(-t_o_tau) * time_weights(t_o_tau.shape[-1], self.dtime,
+                                            self._time_quadrature).astype(t_o_tau.dtype)
+
+    def dtime_weights_func(self, t_o_tau, dt_o_tau):
+        """Derivative of time_weights_func for the derivative dt_o_tau of t_o_tau"""
+        if self._time_quadrature == "exponential":
+            A, B, dA, dB = exponential_segment_weights(t_o_tau[..., 1:] - t_o_tau[..., :-1])
+            ddelta = dt_o_tau[..., 1:] - dt_o_tau[..., :-1]
+            exp_t_o_tau = exp(-t_o_tau[..., :-1]) * self.dtime
+            dweights = np.zeros_like(t_o_tau)
+            dweights[..., :-1] += exp_t_o_tau * (dA * ddelta - A * dt_o_tau[..., :-1])
+            dweights[..., 1:] += exp_t_o_tau * (dB * ddelta - B * dt_o_tau[..., :-1])
+            return dweights
+        return - dt_o_tau * self.time_weights_func(t_o_tau)
+
+    def periodic_time_integral(self, vft_j, t_o_tau, orbits, rows):
+        """Integral from 0 to infinity of vft_j * exp(-t_o_tau) for the closed
+        orbits rows: vft_j is periodic and t_o_tau grows by t_o_tau(T) over each
+        period T, so it is the integral over one period (trapezoid rule up to
+        T) divided by 1 - exp(-t_o_tau(T)), with no truncation at time_max"""
+        index, fraction = orbits["index"][rows], orbits["fraction"][rows]
+        n = np.arange(len(rows))
+        t_o_tau = t_o_tau[rows].astype(np.float64)
+        integrand = vft_j[rows] * exp(-t_o_tau)
+        t_o_tau_period = t_o_tau[n, index] + fraction * (t_o_tau[n, index + 1] - t_o_tau[n, index])
+        integrand_period = vft_j[rows, 0] * exp(-t_o_tau_period)
+        before = np.arange(t_o_tau.shape[1])[None, :] <= index[:, None]
+        integral = (self.dtime * (np.sum(integrand * before, axis=1)
+                                  - (integrand[:, 0] + integrand[n, index]) / 2)
+                    + fraction * self.dtime * (integrand[n, index] + integrand_period) / 2)
+        return integral / (- np.expm1(- t_o_tau_period))
+
+    def shared_orbit_integral(self, vft_j, t_o_tau, orbits, rows):
+        """periodic_time_integral of the closed orbits rows, computed for all
+        the points sharing the trajectory of a representative (orbit_sharing)
+        from the cumulative integral F(s) of vft_j * exp(-t_o_tau) along the
+        representative, O(N_time) per orbit instead of per point. A point at
+        the time shift s on a representative of period T gives
+        exp(t_o_tau(s)) * (F(T) / (1 - exp(-t_o_tau(T))) - F(s)).
+        The points whose representative is not closed use periodic_time_integral."""
+        integral = np.empty(len(rows), dtype=np.float64)
+        representatives = orbits["representatives"][rows]
+        shared = orbits["labels"][representatives] == "closed"
+        integral[~shared] = self.periodic_time_integral(vft_j, t_o_tau, orbits, rows[~shared])
+        if not np.any(shared):
+            return integral
+        orbits_r, position = np.unique(representatives[shared], return_inverse=True)
+        n = np.arange(len(orbits_r))
+
+        ## Cumulative integral along the representatives, trapezoid rule
+        index, fraction = orbits["index"][orbits_r], orbits["fraction"][orbits_r]
+        t_o_tau = t_o_tau[orbits_r].astype(np.float64)
+        integrand = vft_j[orbits_r] * exp(-t_o_tau)
+        cumulative = np.zeros_like(integrand)
+        cumulative[:, 1:] = self.dtime * np.cumsum((integrand[:, 1:] + integrand[:, :-1]) / 2, axis=1)
+        t_o_tau_period = t_o_tau[n, index] + fraction * (t_o_tau[n, index + 1] - t_o_tau[n, index])
+        integrand_period = vft_j[orbits_r, 0] * exp(-t_o_tau_period)
+        cumulative_period = (cumulative[n, index] +
+                             fraction * self.dtime * (integrand[n, index] + integrand_period) / 2)
+        total = cumulative_period / (- np.expm1(- t_o_tau_period))
+
+        ## Each point at its time shift, modulo the period
+        period = (index + fraction)[position] * self.dtime
+        step_shift = np.mod(orbits["shifts"][rows[shared]], period) / self.dtime
+        step = np.minimum(np.floor(step_shift).astype(int), index[position])
+        weight = step_shift - step
+        integrand_shift = ((1 - weight) * integrand[position, step] +
+                           weight * integrand[position, step + 1])
+        cumulative_shift = (cumulative[position, step] +
+                            weight * self.dtime * (integrand[position, step] + integrand_shift) / 2)
+        t_o_tau_shift = (1 - weight) * t_o_tau[position, step] + weight * t_o_tau[position, step + 1]
+        integral[shared] = exp(t_o_tau_shift) * (total[position] - cumulative_shift)
+        return integral
+
+    def time_integral_func(self, vft_j, t_o_tau, weights, orbits=None):
+        """Integral of vft_j * exp(-t_o_tau) over time for each point, with the
+        weights of time_weights_func. With the orbits of classify_orbits, the
+        closed ones are summed by periodic_time_integral, or shared_orbit_integral
+        if chambers_engine is "orbit"."""
+        if orbits is None:
+            return np.sum(vft_j * weights, axis=1, dtype=np.float64)
+        integral = np.empty(vft_j.shape[0], dtype=np.float64)
+        for label in ["closed", "open", "long"]:
+            t0 = time.time()
+            rows = np.nonzero(orbits["labels"] == label)[0]
+            if label == "closed" and self.chambers_engine == "orbit" and "representatives" in orbits.keys():
+                integral[rows] = self.shared_orbit_integral(vft_j, t_o_tau, orbits, rows)
+            elif label == "closed":
+                integral[rows] = self.periodic_time_integral(vft_j, t_o_tau, orbits, rows)
+            else:
+                integral[rows] = np.sum(vft_j[rows] * weights[rows], axis=1, dtype=np.float64)
+            self.orbit_timing[label] += time.time() - t0
+        return integral
+
+    def velocity_product(self, kft, vft, t_o_tau, i, j, orbits=None):
         """ Index i and j represent x, y, z = 0, 1, 2
             for example, if i = 0: vif = vxf """
 
         if self.Bamp != 0:
-            self.v_product = vft[i, :, 0] * np.sum(vft[j, :, :]
-                             * exp(-t_o_tau) * self.dtime, axis=1)
+            self.v_product = vft[i, :, 0] * self.time_integral_func(vft[j, :, :], t_o_tau,
+                                                                    self.time_weights_func(t_o_tau), orbits)
         else:
             self.v_product = vft[i, :, 0] * vft[j, :, 0] * (1 / t_o_tau)
         return self.v_product
 
-    def sigma_epsilon(self, dos_k, dkf, kft, vft, t_o_tau, i, j):
+    def dvelocity_product(self, kft, vft, t_o_tau, dt_o_tau, i, j):
+        """Derivative of velocity_product for the derivative dt_o_tau of t_o_tau"""
+        if self.Bamp != 0:
+            return vft[i, :, 0] * np.sum(vft[j, :, :]
+                   * self.dtime_weights_func(t_o_tau, dt_o_tau), axis=1, dtype=np.float64)
+        else:
+            return - vft[i, :, 0] * vft[j, :, 0] * dt_o_tau / t_o_tau**2
+
+    def sigma_epsilon(self, dos_k, dkf, kft, vft, t_o_tau, i, j, orbits=None):
         sigma_epsilon = (units_chambers / self.bandObject.numberOfBZ *
                         np.sum(dkf
                                * dos_k
                                * self.velocity_product(kft, vft, t_o_tau,
-                                                       i=i, j=j)
+                                                       i=i, j=j, orbits=orbits)
                                )
                         )
         return sigma_epsilon
 
+    def sigma_epsilon_tensor(self, dos_k, dkf, kft, vft, t_o_tau, ij_list, orbits=None):
+        """Returns sigma_epsilon[i, j] for all (i, j) in ij_list, exp(-t_o_tau)
+        and the time integral of vft[j] are computed only once"""
+        sigma_epsilon = np.zeros((3, 3), dtype=np.float64)
+        weight_k = units_chambers / self.bandObject.numberOfBZ * dkf * dos_k
+        if self.Bamp != 0:
+            weights = self.time_weights_func(t_o_tau)
+            integral_j = {j: self.time_integral_func(vft[j, :, :], t_o_tau, weights, orbits)
+                          for j in set(j for (i, j) in ij_list)}
+        else:
+            integral_j = {j: vft[j, :, 0] / t_o_tau for j in set(j for (i, j) in ij_list)}
+        for (i, j) in ij_list:
+            sigma_epsilon[i, j] = np.sum(weight_k * vft[i, :, 0] * integral_j[j])
+        return sigma_epsilon
+
+    def chambersTensorsFunc(self, ij_list=None):
+        """Returns (sigma, alpha, beta) for all the components (i, j) of
+        ij_list (default all of them) in one pass over the energies:
+        sigma_ij(epsilon) is computed once and summed with the three weights
+        of integrand_coeff. At T = 0, alpha and beta are 0."""
+        if ij_list is None:
+            ij_list = [(i, j) for i in range(3) for j in range(3)]
+        sigma = np.zeros((3, 3), dtype=np.float64)
+        alpha = np.zeros((3, 3), dtype=np.float64)
+        beta  = np.zeros((3, 3), dtype=np.float64)
+
+        if self.memory_budget is not None:
+            ## already summed by runTransport
+            for (i, j) in ij_list:
+                sigma[i, j], alpha[i, j], beta[i, j] = self.sigma[i, j], self.alpha[i, j], self.beta[i, j]
+        elif self._T == 0:
+            sigma = self.sigma_epsilon_tensor(self.bandObject.dos_k, self.bandObject.dkf,
+                                              self.kft, self.vft, self.t_o_tau, ij_list, self.orbits)
+        else:
+            for epsilon, weight in zip(self.epsilon_array, self.epsilon_weights):
+                sigma_epsilon = self.sigma_epsilon_tensor(self.dos_k_epsilon[epsilon],
+                                                          self.dkf_epsilon[epsilon],
+                                                          self.kft_epsilon[epsilon],
+                                                          self.vft_epsilon[epsilon],
+                                                          self.t_o_tau_epsilon[epsilon],
+                                                          ij_list, self.orbits_epsilon[epsilon])
+                sigma += weight * self.integrand_coeff(epsilon, "sigma") * sigma_epsilon
+                alpha += weight * self.integrand_coeff(epsilon, "alpha") * sigma_epsilon
+                beta  += weight * self.integrand_coeff(epsilon, "beta") * sigma_epsilon
+
+        for (i, j) in ij_list:
+            self.sigma[i, j] = sigma[i, j]
+            self.alpha[i, j] = alpha[i, j]
+            self.beta[i, j]  = beta[i, j]
+        return sigma, alpha, beta
+
+    def is_T_dependent(self):
+        """True if the scattering rate depends explicitly on temperature"""
+        return self.a_T!=0 or self.a_T2!=0 or self.a_asym!=0 or self.p_asym!=0
+
+    def sigmaEpsilonTableFunc(self, T_max, N_epsilon=None, ij_list=None, dfdE_cut=1e-6):
+        """Computes and stores sigma_ij(epsilon) on a fixed energy grid wide
+        enough for the Fermi window of T_max, then chambersTableFunc gives the
+        transport coefficients at any T <= T_max without new trajectories.
+        Accuracy of chambersTableFunc at T:
+        - the window is cut where -df/dE = dfdE_cut * max at T_max, which
+          misses ~1e-4 of beta at T_max for the default 1e-6 (1% for 1e-3);
+        - the quadrature error of the grid d_epsilon is ~exp(-2 pi^2 kB T / d_epsilon),
+          below 1e-8 for kB*T >= d_epsilon;
+        - the default N_epsilon gives d_epsilon = kB*T_max / 4, so T >= T_max / 4,
+          a larger N_epsilon is needed for lower temperatures.
+        The energy shells are sampled at other energies than in runTransport,
+        so the noise of the discretization of the shells (~1% of alpha on
+        coarse Fermi surfaces) is not the same in both.
+        With memory_budget, each energy is computed by blocks of the Fermi
+        surface as in runTransport."""
+        if ij_list is None:
+            ij_list = [(i, j) for i in range(3) for j in range(3)]
+        if self.is_T_dependent():
+            print("Warning! The scattering rate depends on T, chambersTableFunc will compute each T from scratch")
+        epsilon_max = 2*kB*T_max * arccosh(1/sqrt(dfdE_cut))
+        if N_epsilon is None:
+            N_epsilon = 2 * int(np.ceil(epsilon_max / (kB*T_max / 4))) + 1
+        self.epsilon_table = np.linspace(-epsilon_max, epsilon_max, N_epsilon)
+        self.epsilon_table_cut = dfdE_cut
+        self.sigma_epsilon_table = np.zeros((N_epsilon, 3, 3), dtype=np.float64)
+        for n, (epsilon, weight) in enumerate(self.epsilon_shells_func(self.epsilon_table,
+                                                                       np.ones(N_epsilon))):
+            if self.memory_budget is not None:
+                self.sigma_epsilon_table[n] = self.sigma_epsilon_chunked(epsilon, ij_list)
+                continue
+            self.solveMovementFunc()
+            self.t_o_tau_func(epsilon)
+            self.sigma_epsilon_table[n] = self.sigma_epsilon_tensor(self.bandObject.dos_k,
+                                                                    self.bandObject.dkf,
+                                                                    self.kft, self.vft,
+                                                                    self.t_o_tau, ij_list, self.orbits)
+        return self.sigma_epsilon_table
+
+    def chambersTableFunc(self, T):
+        """Returns (sigma, alpha, beta) at temperature T from the table of
+        sigmaEpsilonTableFunc, by quadrature with the Fermi window of T.
+        If the scattering rate depends on T, the table cannot be used and
+        the coefficients are computed with runTransport at T."""
+        if self.is_T_dependent():
+            T_0 = self._T
+            self.T = T
+            self.runTransport()
+            sigma, alpha, beta = self.chambersTensorsFunc()
+            self.T = T_0
+            return sigma, alpha, beta
+
+        epsilon = self.epsilon_table
+        if T == 0:
+            sigma = np.empty((3, 3), dtype=np.float64)
+            for i in range(3):
+                for j in range(3):
+                    sigma[i, j] = np.interp(0, epsilon, self.sigma_epsilon_table[:, i, j])
+            return sigma, np.zeros((3, 3)), np.zeros((3, 3))
+
+        d_epsilon = epsilon[1] - epsilon[0]
+        if 2*kB*T * arccosh(1/sqrt(self.epsilon_table_cut)) > epsilon[-1] * (1 + 1e-9):
+            print("Warning! T = " + str(T) + " K is above the T_max of the table")
+        if kB*T < d_epsilon:
+            print("Warning! The energy grid of the table is too coarse for T = " + str(T) + " K")
+        with np.errstate(over="ignore"):
+            weight = d_epsilon / (4 * kB * T) / cosh(epsilon / (2*kB * T))**2
+        weight_alpha = weight * (epsilon * meV) / T / (-e)
+        weight_beta  = weight * (epsilon * meV)**2 / T / (-e)**2
+        sigma = np.einsum("n,nij->ij", weight, self.sigma_epsilon_table)
+        alpha = np.einsum("n,nij->ij", weight_alpha, self.sigma_epsilon_table)
+        beta  = np.einsum("n,nij->ij", weight_beta, self.sigma_epsilon_table)
+        return sigma, alpha, beta
+
     def integrand_coeff(self, epsilon, coeff_name):
         if coeff_name == "sigma":
             return 1
@@ -467,25 +1250,27 @@ class Conductivity:
 
         #!!! Add a error message if asking for alpha and beta at T != 0
 
-        if self._T == 0:
+        if self.memory_budget is not None:
+            ## already summed by runTransport
+            coeff_tot = getattr(self, coeff_name)[i, j]
+        elif self._T == 0:
             coeff_tot = self.sigma_epsilon(self.bandObject.dos_k,
                                                   self.bandObject.dkf,
                                                   self.kft, self.vft,
                                                   self.t_o_tau,
-                                                  i=i, j=j)
+                                                  i=i, j=j, orbits=self.orbits)
             self.sigma[i, j] = coeff_tot
         else:
             coeff_tot = 0
-            d_epsilon = self.epsilon_array[1] - self.epsilon_array[0]
-            for epsilon in self.epsilon_array:
+            for epsilon, weight in zip(self.epsilon_array, self.epsilon_weights):
                 sigma_epsilon = self.sigma_epsilon(self.dos_k_epsilon[epsilon],
                                                    self.dkf_epsilon[epsilon],
                                                    self.kft_epsilon[epsilon],
                                                    self.vft_epsilon[epsilon],
                                                    self.t_o_tau_epsilon[epsilon],
-                                                   i=i, j=j)
+                                                   i=i, j=j, orbits=self.orbits_epsilon[epsilon])
                 # Sum over the energie
-                coeff_tot += d_epsilon * (- self.dfdE(epsilon)) * \
+                coeff_tot += weight * \
                              self.integrand_coeff(epsilon, coeff_name) * sigma_epsilon
 
             # Send to right transport coefficient
@@ -500,6 +1285,151 @@ class Conductivity:
 
         return coeff_tot
 
+    def chambersJacobianFunc(self, i, j, param_names, coeff_name="sigma"):
+        """Returns (coeff_tot, dcoeff_tot) with coeff_tot = chambersFunc(i, j, coeff_name)
+        and dcoeff_tot[n] its derivative with respect to the scattering
+        parameter param_names[n]. The parameters only enter through t_o_tau, so
+        the derivatives are computed on the same trajectories kft & vft.
+        The time grid is kept fixed, as in the finite differences of a fit.
+        dcoeff_tot is the derivative of the direct sum over the trajectories,
+        so it does not match coeff_tot with orbit_dispatch."""
+        coeff_tot = self.chambersFunc(i, j, coeff_name)
+
+        dcoeff_tot = np.zeros(len(param_names), dtype=np.float64)
+        dos_k_0 = self.bandObject.dos_k
+        for weight, epsilon, dos_k, dkf, kft, vft, t_o_tau, block in self.chambers_terms(coeff_name):
+            self.bandObject.dos_k = dos_k # gamma_DOS_Func is normalized by the dos of epsilon as in runTransport
+            for n, param_name in enumerate(param_names):
+                dt_o_tau = self.dt_o_tau_func(param_name, kft, vft, epsilon)
+                dcoeff_tot[n] += weight * (units_chambers / self.bandObject.numberOfBZ *
+                                           np.sum(dkf[block] * dos_k[block] *
+                                                  self.dvelocity_product(kft, vft, t_o_tau,
+                                                                         dt_o_tau, i=i, j=j)))
+        self.bandObject.dos_k = dos_k_0
+        return coeff_tot, dcoeff_tot
+
+    def chambers_terms(self, coeff_name="sigma"):
+        """Yields (weight, epsilon, dos_k, dkf, kft, vft, t_o_tau, block) of the
+        terms summed in chambersFunc: dos_k & dkf are the ones of the whole
+        Fermi surface at epsilon and kft, vft & t_o_tau the trajectories of
+        its points dos_k[block]. With memory_budget, the trajectories of each
+        block are solved again, as in sigma_epsilon_chunked, and only one
+        block is in memory at a time."""
+        if self.memory_budget is None:
+            if self._T == 0:
+                yield (1, 0, self.bandObject.dos_k, self.bandObject.dkf,
+                       self.kft, self.vft, self.t_o_tau, slice(None))
+                return
+            for epsilon, weight in zip(self.epsilon_array, self.epsilon_weights):
+                yield (weight * self.integrand_coeff(epsilon, coeff_name),
+                       epsilon, self.dos_k_epsilon[epsilon], self.dkf_epsilon[epsilon],
+                       self.kft_epsilon[epsilon], self.vft_epsilon[epsilon],
+                       self.t_o_tau_epsilon[epsilon], slice(None))
+            return
+
+        if self._T == 0:
+            shells = [(0, 1)]
+        else:
+            shells = self.epsilon_shells_func()
+        for epsilon, weight in shells:
+            if self._T != 0:
+                weight = weight * self.integrand_coeff(epsilon, coeff_name)
+            kf, vf = self.bandObject.kf, self.bandObject.vf
+            dos_k, dkf = self.bandObject.dos_k, self.bandObject.dkf
+            chunk_size = self.chunk_size_func()
+            for start in range(0, kf.shape[1], chunk_size):
+                block = slice(start, start + chunk_size)
+                self.solveMovementFunc(kf[:, block], vf[:, block])
+                self.t_o_tau_func(epsilon)
+                yield (weight, epsilon, dos_k, dkf, self.kft, self.vft, self.t_o_tau, block)
+
+    def gamma_batch_func(self, param_names, param_values, kx, ky, kz, vx, vy, vz, epsilon = 0):
+        """Returns gamma_tot[n, ...] = 1 / tau_total_func for the scattering
+        parameters param_names set to param_values[n]. With fused_scattering,
+        all the sets go through one batch kernel (only the scalars of each set
+        are computed here), else tau_total_func is called for each set."""
+        values_0 = [getattr(self, param_name) for param_name in param_names]
+        gamma_tot = np.empty((len(param_values),) + kx.shape, dtype=np.float64)
+        fused_terms_list = []
+        try:
+            for n, values in enumerate(param_values):
+                for param_name, value in zip(param_names, values):
+                    if param_name == "phi_step":
+                        value = np.deg2rad(value)
+                    setattr(self, param_name, value)
+                if self.fused_scattering == True:
+                    fused_terms_list.append(fused_terms(self, epsilon))
+                else:
+                    gamma_tot[n] = self.gamma_total_func(kx, ky, kz, vx, vy, vz, epsilon)
+        finally:
+            for param_name, value in zip(param_names, values_0):
+                setattr(self, param_name, value)
+        if self.fused_scattering == True:
+            gamma_tot = gamma_fused_batch_func(fused_terms_list, kx, ky, kz, vx, vy, vz)
+        return gamma_tot
+
+    def time_max_batch(self, param_names, param_values):
+        """Returns 8 * tau_max of all the sets of scattering parameters"""
+        kf = self.bandObject.kf
+        vf = self.bandObject.vf
+        gamma_min = np.min(self.gamma_batch_func(param_names, np.atleast_2d(param_values),
+                                                 kf[0, :], kf[1, :], kf[2, :],
+                                                 vf[0, :], vf[1, :], vf[2, :]))
+        return 8 / gamma_min
+
+    def extend_time_grid(self, param_names, param_values):
+        """Extends the time grid at constant dtime to reach 8 * tau_max of all
+        the sets of scattering parameters, so chambersBatchFunc gives the same
+        as chambersFunc with each set on this grid. Returns True if extended."""
+        time_max = self.time_max_batch(param_names, param_values)
+        if time_max <= self.time_max * (1 + 1e-9):
+            return False
+        N_time = int(np.ceil(time_max / self.dtime))
+        self.time_max = N_time * self.dtime
+        self.N_time = N_time
+        return True
+
+    def chambersBatchFunc(self, i, j, param_names, param_values, coeff_name="sigma", batch_size=None):
+        """Returns coeff_tot[n] = chambersFunc(i, j, coeff_name) for the scattering
+        parameters param_names set to param_values[n], all computed on the
+        trajectories kft & vft of the last runTransport.
+        The time grid is the one of this object: it must reach 8 * tau_max of
+        all the sets, see extend_time_grid to call before runTransport.
+        batch_size: number of sets in each tensor operation, default is ~256 MB"""
+        param_values = np.atleast_2d(np.asarray(param_values, dtype=np.float64))
+        N_sets = param_values.shape[0]
+        if batch_size is None:
+            batch_size = max(1, int(2**25 / self.kft[0, :, :].size))
+
+        ## Check the time window
+        if self.Bamp != 0 and self.time_max_batch(param_names, param_values) > self.time_max * (1 + 1e-9):
+            print("Warning! The time grid is too short for some scattering sets, call extend_time_grid before runTransport")
+
+        coeff_tot = np.zeros(N_sets, dtype=np.float64)
+        dos_k_0 = self.bandObject.dos_k
+        for weight, epsilon, dos_k, dkf, kft, vft, t_o_tau, block in self.chambers_terms(coeff_name):
+            self.bandObject.dos_k = dos_k # gamma_DOS_Func is normalized by the dos of epsilon as in runTransport
+            for start in range(0, N_sets, batch_size):
+                values = param_values[start:start + batch_size]
+                if self.Bamp != 0:
+                    gamma_tot = self.gamma_batch_func(param_names, values,
+                                                      kft[0, :, :], kft[1, :, :], kft[2, :, :],
+                                                      vft[0, :, :], vft[1, :, :], vft[2, :, :],
+                                                      epsilon)
+                    t_o_tau = cumulative_time_integral(gamma_tot, self.dtime, self._time_quadrature)
+                    v_product = vft[i, :, 0] * np.einsum("kt,nkt->nk", vft[j, :, :],
+                                                         self.time_weights_func(t_o_tau))
+                else:
+                    gamma_tot = self.gamma_batch_func(param_names, values,
+                                                      kft[0, :, 0], kft[1, :, 0], kft[2, :, 0],
+                                                      vft[0, :, 0], vft[1, :, 0], vft[2, :, 0],
+                                                      epsilon)
+                    v_product = vft[i, :, 0] * vft[j, :, 0] / gamma_tot
+                coeff_tot[start:start + batch_size] += weight * (units_chambers / self.bandObject.numberOfBZ *
+                                                                 (v_product @ (dkf[block] * dos_k[block])))
+        self.bandObject.dos_k = dos_k_0
+        return coeff_tot
+
     def dfdE(self, epsilon):
         if self._T == 0:
             return 1
@@ -660,6 +1590,11 @@ class Conductivity:
         fig.subplots_adjust(left = 0.24, right = 0.87, bottom = 0.29, top = 0.91)
 
         fig.text(0.39,0.84, r"$k_{\rm z}$ = 0", ha = "right", fontsize = 16)
+        if self.orbits is not None:
+            label = self.orbits["labels"][index_kf]
+            if label != "long":
+                label += r", $T$ = " + "{:.3g}".format(self.orbits["period"][index_kf]) + " ps"
+            fig.text(0.87, 0.93, label, ha = "right", fontsize = 14)
 
         line = axes.contour(kxx*self.bandObject.a, kyy*self.bandObject.b, self.bandObject.e_3D_func(kxx, kyy, 0), 0, colors = '#FF0000', linewidths = 3)
         line = axes.plot(self.kft[0, index_kf,:]*self.bandObject.a, self.kft[1, index_kf,:]*self.bandObject.b)
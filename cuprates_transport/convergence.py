@@ -0,0 +1,195 @@
+import time
+import numpy as np
+from scipy import optimize
+from cuprates_transport.conductivity import Conductivity
+##<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<#
+
+## Values of each knob, from the cheapest to the most accurate
+knob_ladders_dict = {
+    "res_xy":    [8, 11, 15, 20, 28, 40, 56],
+    "res_z":     [3, 5, 7, 9, 11, 15, 21],
+    "N_time":    [50, 100, 200, 400, 800, 1600, 3200],
+    "ode_tol":   [1e-2, 1e-3, 1e-4, 1e-5, 1e-6], # rtol = atol of odeint
+    "N_epsilon": [3, 5, 7, 10, 14, 20, 28, 40],
+}
+
+
+class ConvergenceTuner:
+    """Finds the cheapest res_xy, res_z, N_time, rtol & atol (ode_tol) and
+    N_epsilon (only if T > 0) for which the quantity at the field angles
+    (Bphi, Btheta) is converged within the relative tolerance tol.
+
+    quantity: "rhozz" for rho_zz, "rzz" for rho_zz / rho_zz at the first angle
+              (as fitted on ADMR data), "sigma" for sigma_xx, sigma_xy & sigma_zz
+
+    All the knobs start at their cheapest value. At each step, every knob
+    is refined by one value of its ladder, and the change of the quantity
+    gives its error by Richardson extrapolation: with a step h (1 / value,
+    or the tolerance for ode_tol) the error goes as h**order, so the error
+    at h_0 is change / (1 - (h_1 / h_0)**order). The order of each knob is
+    estimated from its two last changes. Among the knobs whose error is above
+    tol / number of knobs, the one with the largest change per extra second
+    is refined, until the sum of the errors is below tol.
+    """
+    def __init__(self, bandObject, params, tol=1e-3, quantity="rhozz",
+                 angles=((0, 0), (0, 30), (0, 60), (45, 30), (45, 60)),
+                 ladders_dict=None):
+        self.bandObject = bandObject
+        self.params = dict(params) # keyword arguments of Conductivity
+        self.tol = tol
+        self.quantity = quantity
+        self.angles = [tuple(angle) for angle in angles]
+
+        self.ladders_dict = dict(knob_ladders_dict)
+        if ladders_dict is not None:
+            self.ladders_dict.update(ladders_dict)
+        if self.params.get("T", 0) == 0:
+            self.ladders_dict.pop("N_epsilon")
+        self.knobs = list(self.ladders_dict.keys())
+
+        self.band_dict = {} # keys=(res_xy, res_z), values=(bandObject, time)
+        self.evaluations_dict = {} # keys=config as a tuple, values=(quantity, time)
+        self.config = None # recommended config
+        self.report = None
+
+    ## Methods >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>#
+    def config_from_levels(self, levels):
+        config = {}
+        for knob in self.knobs:
+            value = self.ladders_dict[knob][levels[knob]]
+            if knob == "ode_tol":
+                config["rtol"] = value
+                config["atol"] = value
+            else:
+                config[knob] = value
+        return config
+
+    def step(self, knob, level):
+        """Step h of the knob, the error goes to 0 with h"""
+        value = self.ladders_dict[knob][level]
+        if knob == "ode_tol":
+            return value
+        return 1 / value
+
+    def band(self, res_xy, res_z):
+        """Fermi surface discretized with res_xy & res_z, computed once"""
+        if (res_xy, res_z) not in self.band_dict.keys():
+            t0 = time.time()
+            bandObject = self.bandObject.snapshot()
+            bandObject.res_xy = res_xy
+            bandObject.res_z = res_z
+            bandObject.runBandStructure()
+            self.band_dict[res_xy, res_z] = (bandObject, time.time() - t0)
+        return self.band_dict[res_xy, res_z]
+
+    def evaluate(self, config):
+        """Returns (quantity[angle, component], time) for the config, the
+        time includes the discretization of the Fermi surface"""
+        key = tuple(sorted(config.items()))
+        if key not in self.evaluations_dict.keys():
+            bandObject, time_band = self.band(config.get("res_xy", self.bandObject.res_xy),
+                                              config.get("res_z", self.bandObject.res_z))
+            t0 = time.time()
+            quantity = []
+            for (Bphi, Btheta) in self.angles:
+                kwargs = dict(self.params)
+                kwargs.update(config)
+                kwargs.update({"Bphi": Bphi, "Btheta": Btheta})
+                condObject = Conductivity(bandObject, **kwargs)
+                condObject.runTransport()
+                if self.quantity == "sigma":
+                    sigma, alpha, beta = condObject.chambersTensorsFunc(ij_list=[(0, 0), (0, 1), (2, 2)])
+                    quantity.append([sigma[0, 0], sigma[0, 1], sigma[2, 2]])
+                else:
+                    quantity.append([1 / condObject.chambersFunc(2, 2)])
+            quantity = np.array(quantity)
+            if self.quantity == "rzz":
+                quantity = quantity / quantity[0]
+            self.evaluations_dict[key] = (quantity, time_band + time.time() - t0)
+        return self.evaluations_dict[key]
+
+    def change(self, quantity_1, quantity_0):
+        """Largest relative change, each component relative to its largest value"""
+        scale = np.max(np.abs(quantity_0), axis=0)
+        scale[scale == 0] = 1
+        return np.max(np.abs(quantity_1 - quantity_0) / scale)
+
+    def convergence_order(self, change_0, change_1, order_min=0.5, order_max=4):
+        """Order of convergence from two successive changes (change, h_0, h_1)"""
+        (c_0, h_0, h_1), (c_1, h_1, h_2) = change_0, change_1
+        def ratio(order):
+            return (h_1**order - h_2**order) / (h_0**order - h_1**order)
+        if c_0 == 0 or c_1 / c_0 >= ratio(order_min):
+            return order_min
+        if c_1 / c_0 <= ratio(order_max):
+            return order_max
+        return optimize.brentq(lambda order: ratio(order) - c_1 / c_0, order_min, order_max)
+
+    def runTuner(self):
+        """Returns (config, report): config are the keyword arguments of
+        BandStructure & Conductivity to use, report the cost & accuracy"""
+        levels = {knob: 0 for knob in self.knobs}
+        quantity, duration = self.evaluate(self.config_from_levels(levels))
+        order_dict = {knob: 1 for knob in self.knobs}
+        last_change_dict = {} # (change, h_0, h_1) of the last refinement of each knob
+        history = []
+
+        while True:
+            ## Error of each knob, refined one step from the current config
+            errors_dict, changes_dict, trials_dict = {}, {}, {}
+            for knob in self.knobs:
+                h_0 = self.step(knob, levels[knob])
+                if levels[knob] + 1 < len(self.ladders_dict[knob]):
+                    h_1 = self.step(knob, levels[knob] + 1)
+                    trial_levels = dict(levels)
+                    trial_levels[knob] += 1
+                    trials_dict[knob] = self.evaluate(self.config_from_levels(trial_levels))
+                    changes_dict[knob] = (self.change(trials_dict[knob][0], quantity), h_0, h_1)
+                    if knob in last_change_dict.keys():
+                        order_dict[knob] = self.convergence_order(last_change_dict[knob], changes_dict[knob])
+                    errors_dict[knob] = changes_dict[knob][0] / (1 - (h_1 / h_0)**order_dict[knob])
+                elif knob in last_change_dict.keys():
+                    ## last value of the ladder, error left after the last refinement
+                    change, h_0, h_1 = last_change_dict[knob]
+                    q = (h_1 / h_0)**order_dict[knob]
+                    errors_dict[knob] = change * q / (1 - q)
+                else:
+                    errors_dict[knob] = 0
+            error = sum(errors_dict.values())
+            history.append({"config": self.config_from_levels(levels), "time": duration,
+                            "errors": errors_dict, "error": error})
+
+            if error < self.tol:
+                break
+            candidates = [knob for knob in trials_dict.keys() if errors_dict[knob] > self.tol / len(self.knobs)]
+            if len(candidates) == 0:
+                print("Warning! The tolerance " + str(self.tol) + " is not reached with the largest values of the knobs")
+                break
+            ## Largest change per extra second of computation
+            knob = max(candidates, key=lambda knob: changes_dict[knob][0] /
+                       max(trials_dict[knob][1] - duration, 0.01 * duration))
+            last_change_dict[knob] = changes_dict[knob]
+            levels[knob] += 1
+            quantity, duration = trials_dict[knob]
+
+        self.config = self.config_from_levels(levels)
+        self.report = {"config": self.config,
+                       "time": duration, # in seconds, for one evaluation of all the angles
+                       "errors": errors_dict, # estimated relative error of each knob
+                       "error": error,
+                       "orders": order_dict, # order of convergence of each knob
+                       "tol": self.tol,
+                       "nb_evaluations": len(self.evaluations_dict),
+                       "time_total": sum(evaluation[1] for evaluation in self.evaluations_dict.values()),
+                       "history": history}
+        return self.config, self.report
+
+    def printReport(self):
+        for step in self.report["history"]:
+            print(", ".join(key + "=" + str(value) for (key, value) in step["config"].items()) +
+                  ": error = " + "{:.1e}".format(step["error"]) +
+                  ", time = " + "{:.2f}".format(step["time"]) + " s")
+        print("Errors: " + ", ".join(knob + " " + "{:.1e}".format(error)
+                                     for (knob, error) in self.report["errors"].items()))
+        print("Orders: " + ", ".join(knob + " " + "{:.1f}".format(order)
+                                     for (knob, order) in self.report["orders"].items()))
@@ -0,0 +1,43 @@
+import os
+import hashlib
+import numpy as np
+##<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<#
+
+## Data files already parsed, keys=(absolute path, mtime), values=array
+data_cache_dict = {}
+
+
+def load_data(filename, cache_folder=None):
+    """Returns np.loadtxt(filename, comments="#") parsed only once per
+    version of the file (path and modification time).
+    If cache_folder is given, the parsed array is also saved there in .npy,
+    so that the text is not parsed again in the next Python sessions.
+    The array is read-only as it is shared by all the callers."""
+    path  = os.path.abspath(filename)
+    mtime = os.stat(path).st_mtime_ns
+    key   = (path, mtime)
+    if key in data_cache_dict.keys():
+        return data_cache_dict[key]
+
+    data = None
+    if cache_folder is not None:
+        path_hash = hashlib.sha1(path.encode()).hexdigest()[:16]
+        path_npy  = os.path.join(cache_folder, os.path.basename(path) + "_" +
+                                 path_hash + "_" + str(mtime) + ".npy")
+        if os.path.isfile(path_npy):
+            data = np.load(path_npy)
+
+    if data is None:
+        data = np.loadtxt(path, dtype="float", comments="#")
+        if cache_folder is not None:
+            if not os.path.isdir(cache_folder):
+                os.makedirs(cache_folder)
+            np.save(path_npy, data)
+
+    data.setflags(write=False)
+    data_cache_dict[key] = data
+    return data
+
+
+def clear_data_cache():
+    data_cache_dict.clear()
@@ -0,0 +1,93 @@
+import io
+import json
+import hashlib
+import sqlite3
+import numpy as np
+##<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<#
+
+class EvaluationCache:
+    """On-disk cache (SQLite) of the simulated rzz_array & rhozz_array of
+    the fits, so that a member already computed in a previous fit is not
+    computed again. Once max_entries is reached, the least recently used
+    evaluations are removed."""
+    def __init__(self, path, max_entries=10000):
+        self.path = path
+        self.max_entries = max_entries
+        self.nb_hits = 0
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS evaluations ("
+                                "key TEXT PRIMARY KEY, rzz BLOB, rhozz BLOB, last_used INTEGER)")
+        self.connection.commit()
+
+    ## Special Method >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>#
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM evaluations").fetchone()[0]
+
+    ## Methods >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>#
+    def key(self, member, Bphi_array, Btheta_array, options=None):
+        """Canonical hash of the full member, of the angles of the data and of
+        the options which change the result but are not in the member, like
+        pipi_FSR or the defaults of the solver (see fitting_admr.cache_options).
+        If the doping is fixed, mu is an output of the fit and not a parameter,
+        so it is not part of the key."""
+        member = json.loads(json.dumps(member, default=to_json))
+        if member.get("fixdoping", 2) >=-1 and member.get("fixdoping", 2) <=1:
+            member["band_params"].pop("mu", None)
+        if options is None:
+            options = {}
+        options = json.loads(json.dumps(options, default=to_json))
+        content = json.dumps({"member": member,
+                              "options": options,
+                              "Bphi": np.asarray(Bphi_array, dtype=np.float64).tolist(),
+                              "Btheta": np.asarray(Btheta_array, dtype=np.float64).tolist()},
+                             sort_keys=True)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def get(self, key):
+        """Returns (rzz_array, rhozz_array) or None if key is not in the cache"""
+        row = self.connection.execute("SELECT rzz, rhozz FROM evaluations WHERE key=?",
+                                      (key,)).fetchone()
+        if row is None:
+            return None
+        self.connection.execute("UPDATE evaluations SET last_used=? WHERE key=?",
+                                (self.next_use(), key))
+        self.connection.commit()
+        self.nb_hits += 1
+        return array_from_blob(row[0]), array_from_blob(row[1])
+
+    def put(self, key, rzz_array, rhozz_array):
+        self.connection.execute("INSERT OR REPLACE INTO evaluations VALUES (?, ?, ?, ?)",
+                                (key, blob_from_array(rzz_array),
+                                 blob_from_array(rhozz_array), self.next_use()))
+        ## LRU eviction
+        nb_over = len(self) - self.max_entries
+        if nb_over > 0:
+            self.connection.execute("DELETE FROM evaluations WHERE key IN "
+                                    "(SELECT key FROM evaluations ORDER BY last_used ASC LIMIT ?)",
+                                    (nb_over,))
+        self.connection.commit()
+
+    def next_use(self):
+        """Counter of the uses, more reliable than the clock to order them"""
+        last_used = self.connection.execute("SELECT MAX(last_used) FROM evaluations").fetchone()[0]
+        if last_used is None:
+            return 0
+        return last_used + 1
+
+    def close(self):
+        self.connection.close()
+
+
+## Functions >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>#
+def to_json(value):
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    return str(value)
+
+def blob_from_array(array):
+    f = io.BytesIO()
+    np.save(f, np.asarray(array), allow_pickle=False)
+    return f.getvalue()
+
+def array_from_blob(blob):
+    return np.load(io.BytesIO(blob), allow_pickle=False)
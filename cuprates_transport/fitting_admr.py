@@ -1,8 +1,13 @@
+import os
 import json
+import inspect
+import hashlib
 import numpy as np
 import time
 from copy import deepcopy
+from multiprocessing import get_context
 from lmfit import minimize, Parameters, report_fit
+from scipy.interpolate import RBFInterpolator
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 from matplotlib.ticker import MultipleLocator, FormatStrFormatter
@@ -10,15 +15,35 @@ from matplotlib.backends.backend_pdf import PdfPages
 
 from cuprates_transport.bandstructure import BandStructure, PiPiBandStructure, setMuToDoping, doping
 from cuprates_transport.admr import ADMR
-from cuprates_transport.conductivity import Conductivity
+from cuprates_transport.conductivity import Conductivity, jacobian_params_list
+from cuprates_transport.data_cache import load_data
+from cuprates_transport.evaluation_cache import EvaluationCache, to_json
+from cuprates_transport.transport_observables import resistivity, hall_coefficient
 ##<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
 
+## Options of Conductivity which change the result of a member, part of the
+## key of the evaluation cache
+cache_solver_options = ["time_quadrature", "epsilon_quadrature", "fused_scattering",
+                        "orbit_dispatch", "chambers_engine"]
+conductivity_defaults = {name: parameter.default for name, parameter
+                         in inspect.signature(Conductivity.__init__).parameters.items()}
+
+
 class FittingADMR:
     def __init__(self, init_member, ranges_dict, data_dict, pipi_FSR=False,
                  folder="",
                  method="differential_evolution",
                  population=100, N_generation=20, mutation_s=0.1, crossing_p=0.9,
                  normalized_data=True,
+                 checkpoint=None, checkpoint_every=10,
+                 workers=1,
+                 cache_folder=None,
+                 evaluation_cache=None, evaluation_cache_size=10000,
+                 fidelity_schedule=None, fidelity_method="least_square",
+                 fidelity_promote=5, fidelity_tol=0.1,
+                 surrogate_init=None, surrogate_iter=40, surrogate_polish=20, surrogate_seed=None,
+                 jacobian=True,
+                 transport_data=None,
                  **trash):
         ## Initialize
         self.init_member = deepcopy(init_member)
@@ -28,18 +53,62 @@ class FittingADMR:
         self.folder      = folder
         self.normalized_data = normalized_data
         self.pipi_FSR    = pipi_FSR
+        self.cache_folder = cache_folder # folder for the binary copies of the data files
         self.pars        = Parameters()
         for param_name, param_range in self.ranges_dict.items():
             if param_name in self.init_member.keys():
                 self.pars.add(param_name, value = self.init_member[param_name], min = param_range[0], max = param_range[-1])
             elif param_name in self.init_member["band_params"].keys():
                 self.pars.add(param_name, value = self.init_member["band_params"][param_name], min = param_range[0], max = param_range[-1])
-        self.method      = method # "shgo", "differential_evolution", "leastsq"
+        self.method      = method # "shgo", "differential_evolution", "leastsq", "surrogate"
         ## Differential evolution
-        self.population  = population
+        self.population  = population # with workers > 1, size of the population of each generation
         self.N_generation= N_generation
         self.mutation_s  = mutation_s
         self.crossing_p  = crossing_p
+        self.workers     = workers # number of processes to evaluate each generation
+        ## Analytic jacobian for least square, if all the parameters are scattering parameters
+        self.jacobian = jacobian
+        self.jacobian_active = None # list of the parameters while least square runs
+        self.jacobian_dict = {} # keys=(parameter values), values=jacobian of diff
+        ## Surrogate
+        self.surrogate_init   = surrogate_init # number of initial samples, default 2*(N_params+1)
+        self.surrogate_iter   = surrogate_iter # number of calls proposed by the surrogate
+        self.surrogate_polish = surrogate_polish # max number of calls of the final least square
+        self.surrogate_seed   = surrogate_seed
+        ## Multi-fidelity, list of dictionaries from coarse to fine, for example
+        ## [{"res_xy": 10, "res_z": 3, "N_time": 200}, {"res_xy": 15, "res_z": 5, "N_time": 300}]
+        ## the last stage is always the resolution of init_member
+        self.fidelity_schedule = fidelity_schedule
+        self.fidelity_method   = fidelity_method # method of the stages after the first one
+        self.fidelity_promote  = fidelity_promote # number of best candidates promoted to the next stage
+        self.fidelity_tol      = fidelity_tol # skip a stage if resolution noise < fidelity_tol * residual
+        self.fidelity_noise_list = [] # rms of diff(fine) - diff(coarse) at each promotion
+        ## Cache of the evaluations shared between fits, path of SQLite file
+        self.evaluation_cache = None
+        if evaluation_cache is not None and transport_data is None:
+            self.evaluation_cache = EvaluationCache(evaluation_cache, max_entries=evaluation_cache_size)
+        ## Multi-observable fit, list of datasets fitted together with the ADMR of data_dict
+        ## {"observable": "rhoxx", "rhoyx", "rhozz"... (any rho_ij or sigma_ij of the
+        ##  inverse of sigma, the Hall resistivity B // z is rhoyx) or "RH",
+        ##  "sweep": "Bamp" or "T" (or "Btheta", "Bphi"), the variable of the data,
+        ##  "x_array": values of the sweep where the model is computed,
+        ##  "filename", "col_x", "col_y": columns of the sweep and of the observable,
+        ##  "factor": factor from the units of the file to SI (Ohm.m, m^3/C), default 1,
+        ##  "weight": weight of the dataset in diff, default 1,
+        ##  "T", "Bamp", "Bphi", "Btheta": the fixed conditions, default T and Bamp of
+        ##  the member, Bphi = Btheta = 0}
+        ## sigma is computed once per unique (T, field vector) of all the datasets
+        self.transport_data = transport_data
+        self.transport_data_list = [] # the datasets interpolated on their x_array
+        self.conditions = None # unique (T, Bamp, Bphi, Btheta) of all the datasets
+        self.B_vector_array = None # field of each condition
+        self.admr_index = None # index of the conditions of the ADMR [phi, theta]
+        if transport_data is not None and evaluation_cache is not None:
+            print("Warning! The evaluation cache only stores ADMR, it is not used with transport_data")
+        ## Checkpoint
+        self.checkpoint       = checkpoint # path of the .npz checkpoint file, None for no checkpoint
+        self.checkpoint_every = checkpoint_every # number of calls between two checkpoints
 
         ## Objects
         if pipi_FSR==False:
@@ -51,6 +120,7 @@ class FittingADMR:
 
         ## Empty spaces
         self.nb_calls     = 0
+        self.nb_calls_checkpoint = 0 # nb_calls at the last checkpoint
         self.json_name   = None
         self.rhozz_data_matrix = None
         self.rzz_data_matrix   = None
@@ -59,26 +129,18 @@ class FittingADMR:
         self.Btheta_data_dict = {}
         self.rhozz_data_dict  = {}
         self.rzz_data_dict    = {}
+        self.history_pars = [] # parameter vectors evaluated by compute_diff
+        self.history_diff = [] # their diff vectors
+        self.history_dict = {} # keys=(parameter values), values=diff, to skip calls already done
+        self.last_population = None # last population of differential evolution
+        self.pool = None # pool of processes for differential evolution
+        self.pars_bounds = None # copy of pars to transform lmfit internal values
 
 
     def produce_ADMR_object(self):
-        ## Update bandObject
-        for param_name in self.ranges_dict.keys():
-                if hasattr(self.bandObject, param_name):
-                    setattr(self.bandObject, param_name, self.member[param_name])
-                if param_name in self.bandObject._band_params.keys():
-                    self.bandObject[param_name] = self.member["band_params"][param_name]
-
-        ## Adjust the doping if need be
-        if self.member["fixdoping"] >=-1 and self.member["fixdoping"] <=1:
-            self.bandObject.setMuToDoping(self.member["fixdoping"])
-            self.member["band_params"]["mu"] = self.bandObject["mu"]
-
-        self.bandObject.runBandStructure()
-        self.condObject = Conductivity(self.bandObject, **self.member)
-        self.admrObject = ADMR([self.condObject], **self.member)
-        self.admrObject.Btheta_array = self.Btheta_array
-        self.admrObject.Bphi_array = self.Bphi_array
+        self.condObject, self.admrObject = produce_ADMR_object(self.member, self.bandObject,
+                                                               self.ranges_dict,
+                                                               self.Bphi_array, self.Btheta_array)
 
 
     def load_Bphi_data(self):
@@ -127,7 +189,7 @@ class FittingADMR:
             col_rzz      = self.data_dict[self.member["data_T"], phi][2]
             rhozz_0      = self.data_dict[self.member["data_T"], phi][4]
 
-            data = np.loadtxt(filename, dtype="float", comments="#")
+            data = load_data(filename, self.cache_folder)
             theta = data[:, col_theta]
             rzz   = data[:, col_rzz]
 
@@ -143,6 +205,200 @@ class FittingADMR:
             self.rzz_data_matrix[i, :] = rzz_i
 
 
+    def update_member_angles(self):
+        ## Update Btheta & Bphi function of the data
+        self.member["Bphi_array"]  = list(self.Bphi_array)
+        self.member["Btheta_min"]  = float(np.min(self.Btheta_array)) # float need for JSON
+        self.member["Btheta_max"]  = float(np.max(self.Btheta_array))
+        self.member["Btheta_step"] = float(self.Btheta_array[1] - self.Btheta_array[0])
+
+
+    def load_transport_data(self):
+        """Interpolates the datasets of transport_data on their x_array, and
+        finds the index of each of their points in conditions_func"""
+        self.transport_data_list = []
+        self.conditions = None
+        for dataset in self.transport_data:
+            dataset = dict(dataset)
+            if dataset["sweep"] not in ["T", "Bamp", "Bphi", "Btheta"]:
+                print("Warning! The sweep " + str(dataset["sweep"]) + " is not T, Bamp, Bphi or Btheta, the dataset is ignored")
+                continue
+            data = load_data(dataset["filename"], self.cache_folder)
+            x = data[:, dataset["col_x"]]
+            y = data[:, dataset["col_y"]] * dataset.get("factor", 1)
+            index_order = np.argsort(x)
+            dataset["x_array"] = np.array(dataset["x_array"], dtype=np.float64)
+            dataset["y_array"] = np.interp(dataset["x_array"], x[index_order], y[index_order])
+            dataset["weight"] = dataset.get("weight", 1)
+            self.transport_data_list.append(dataset)
+        self.conditions_func()
+
+
+    def load_all_data(self):
+        """ADMR data interpolated on the angles of the member and datasets of
+        transport_data, once per fit stage"""
+        self.load_and_interp_data()
+        self.update_member_angles()
+        if self.transport_data is not None:
+            self.load_transport_data()
+
+
+    def conditions_func(self):
+        """Returns the list of the unique (T, Bamp, Bphi, Btheta) needed by the
+        ADMR of data_dict and by the datasets of transport_data, the index of
+        each point in this list is stored in the dataset. Two conditions are
+        the same if they have the same T and field vector, as theta = 0 for
+        all phi, or B = 0 for all the angles."""
+        if self.conditions is not None:
+            return self.conditions
+        T = float(self.member["T"])
+        Bamp = float(self.member["Bamp"])
+        conditions = {} # keys=(T, Bx, By, Bz), values=index
+        conditions_list = []
+        B_vector_list = []
+        def index_of(T, Bamp, Bphi, Btheta):
+            ## Field as Conductivity.BFunc
+            B_vector = Bamp * np.array([np.sin(Btheta*np.pi/180) * np.cos(Bphi*np.pi/180),
+                                        np.sin(Btheta*np.pi/180) * np.sin(Bphi*np.pi/180),
+                                        np.cos(Btheta*np.pi/180)])
+            key = tuple(float(value) for value in np.round(np.append(T, B_vector), 9) + 0)
+            if key not in conditions.keys():
+                conditions[key] = len(conditions_list)
+                conditions_list.append((float(T), float(Bamp), float(Bphi), float(Btheta)))
+                B_vector_list.append(B_vector)
+            return conditions[key]
+
+        self.admr_index = np.array([[index_of(T, Bamp, phi, theta) for theta in self.Btheta_array]
+                                    for phi in self.Bphi_array], dtype=int)
+        for dataset in self.transport_data_list:
+            fixed = {"T": T, "Bamp": Bamp, "Bphi": 0, "Btheta": 0}
+            for key in fixed.keys():
+                fixed[key] = float(dataset.get(key, fixed[key]))
+            index = []
+            for x in dataset["x_array"]:
+                fixed[dataset["sweep"]] = x
+                index.append(index_of(fixed["T"], fixed["Bamp"], fixed["Bphi"], fixed["Btheta"]))
+            dataset["index"] = np.array(index, dtype=int)
+        self.conditions = conditions_list
+        self.B_vector_array = np.array(B_vector_list)
+        return self.conditions
+
+
+    def diff_from_sigma(self, sigma_array):
+        """Compute diff = data - sim of the ADMR and of all the datasets of
+        transport_data from sigma_array[condition, i, j], rho of all the
+        conditions comes from a single inversion. The residuals of each dataset
+        are relative to the largest value of its data."""
+        rho_array = resistivity(sigma_array)
+        rhozz_array = rho_array[self.admr_index, 2, 2]
+        diff_list = [self.diff_from_ADMR(rhozz_array / rhozz_array[:, 0, None], rhozz_array)]
+        for dataset in self.transport_data_list:
+            observable = dataset["observable"]
+            if observable == "RH":
+                y_sim = hall_coefficient(rho_array[dataset["index"]], self.B_vector_array[dataset["index"]])
+            else:
+                tensor_array = sigma_array if observable.startswith("sigma") else rho_array
+                i, j = ["xyz".index(axis) for axis in observable[-2:]]
+                y_sim = tensor_array[dataset["index"], i, j]
+            y_data = dataset["y_array"]
+            diff_list.append(dataset["weight"] * (y_data - y_sim) / np.max(np.abs(y_data)))
+        return np.concatenate(diff_list)
+
+
+    def member_from_pars(self, pars_values):
+        """Returns a new member with the values of the fit parameters"""
+        member = deepcopy(self.member)
+        for param_name, value in zip(self.ranges_dict.keys(), pars_values):
+            if param_name in self.init_member.keys():
+                member[param_name] = value
+            elif param_name in self.init_member["band_params"].keys():
+                member["band_params"][param_name] = value
+        return member
+
+
+    def cache_options(self, member):
+        """Options of the evaluation cache key, see cache_options"""
+        return cache_options(member, self.pipi_FSR)
+
+
+    def diff_from_ADMR(self, rzz_array, rhozz_array):
+        """Compute diff = sim - data matrix"""
+        diff_matrix = np.zeros_like(self.rzz_data_matrix)
+        for i in range(self.Bphi_array.size):
+            if self.normalized_data==True:
+                diff_matrix[i, :] = self.rzz_data_matrix[i, :] - rzz_array[i, :]
+            else:
+                diff_matrix[i, :] = (self.rhozz_data_matrix[i, :] - rhozz_array[i, :])*1e5
+        return diff_matrix.flatten()
+
+
+    def jacobian_from_ADMR(self, rzz_jacobian_array, rhozz_jacobian_array):
+        """Jacobian of diff = data - sim, array[residual, parameter]"""
+        N_params = rzz_jacobian_array.shape[-1]
+        if self.normalized_data==True:
+            return - rzz_jacobian_array.reshape(-1, N_params)
+        else:
+            return - rhozz_jacobian_array.reshape(-1, N_params) * 1e5
+
+
+    def compute_jacobian(self, pars):
+        """Dfun of least square, the jacobian is usually already computed
+        by compute_diff at the same parameters"""
+        pars_values = tuple(float(pars[param_name].value) for param_name in self.ranges_dict.keys())
+        if pars_values not in self.jacobian_dict.keys():
+            condObject, admrObject = produce_ADMR_object(self.member_from_pars(pars_values), self.bandObject,
+                                                         self.ranges_dict, self.Bphi_array, self.Btheta_array)
+            admrObject.runADMR(jacobian_params=self.jacobian_active)
+            self.jacobian_dict[pars_values] = self.jacobian_from_ADMR(admrObject.rzz_jacobian_array,
+                                                                      admrObject.rhozz_jacobian_array)
+        return self.jacobian_dict[pars_values]
+
+
+    def jacobian_params(self):
+        """Returns the fit parameters if they all have an analytic derivative, else None"""
+        if self.jacobian == False:
+            return None
+        if self.transport_data is not None:
+            print("Warning! No analytic jacobian with transport_data, finite differences are used")
+            return None
+        ## chambersJacobianFunc derives the direct sum, not the periodic sums of the orbits
+        if (self.member.get("orbit_dispatch", conductivity_defaults["orbit_dispatch"]) or
+            self.member.get("chambers_engine", conductivity_defaults["chambers_engine"]) == "orbit"):
+            print("Warning! No analytic jacobian with orbit_dispatch, finite differences are used")
+            return None
+        for param_name in self.ranges_dict.keys():
+            if param_name not in jacobian_params_list or param_name not in self.init_member.keys():
+                print("Warning! No analytic jacobian for " + param_name + ", finite differences are used")
+                return None
+        return list(self.ranges_dict.keys())
+
+
+    def minimize_least_square(self, **kws):
+        """Least square of lmfit, with the analytic jacobian if possible,
+        which replaces the extra calls of the finite differences"""
+        jacobian_params = self.jacobian_params()
+        if jacobian_params is None:
+            return minimize(self.compute_diff, self.pars, **kws)
+        self.jacobian_active = jacobian_params
+        self.jacobian_dict = {}
+        try:
+            return minimize(self.compute_diff, self.pars, Dfun=self.compute_jacobian, **kws)
+        finally:
+            self.jacobian_active = None
+
+
+    def record_call(self, pars_values, diff):
+        ## Record for the checkpoint
+        self.history_pars.append(pars_values)
+        self.history_diff.append(diff)
+        self.history_dict[pars_values] = diff
+        ## only once new calls were computed, not at each hit of the caches
+        if (self.checkpoint is not None and
+            self.nb_calls - self.nb_calls_checkpoint >= self.checkpoint_every):
+            self.save_checkpoint()
+            self.nb_calls_checkpoint = self.nb_calls
+
+
     def compute_diff(self, pars):
         """Compute diff = sim - data matrix"""
 
@@ -150,61 +406,431 @@ class FittingADMR:
 
         start_total_time = time.time()
 
-        ## Load data
-        self.load_and_interp_data()
-
-        ## Update Btheta & Bphi function of the data
-        self.member["Bphi_array"]  = list(self.Bphi_array)
-        self.member["Btheta_min"]  = float(np.min(self.Btheta_array)) # float need for JSON
-        self.member["Btheta_max"]  = float(np.max(self.Btheta_array))
-        self.member["Btheta_step"] = float(self.Btheta_array[1] - self.Btheta_array[0])
+        ## Load data, only once per fit
+        if self.rzz_data_matrix is None:
+            self.load_all_data()
 
         ## Update member with fit parameters
+        ## the member of the call is local, self.member stays the one of the fit
+        pars_values = tuple(float(self.pars[param_name].value) for param_name in self.ranges_dict.keys())
+        member = self.member_from_pars(pars_values)
         for param_name in self.ranges_dict.keys():
-            if param_name in self.init_member.keys():
-                self.member[param_name] = self.pars[param_name].value
-            elif param_name in self.init_member["band_params"].keys():
-                self.member["band_params"][param_name] = self.pars[param_name].value
             print(param_name + " : " + "{0:g}".format(self.pars[param_name].value))
 
+        ## Skip the parameters already computed before the checkpoint
+        if pars_values in self.history_dict.keys():
+            print("---- call already in checkpoint ----")
+            return self.history_dict[pars_values]
+
+        ## Skip the members already computed in previous fits
+        if self.evaluation_cache is not None:
+            cache_key = self.evaluation_cache.key(member, self.Bphi_array, self.Btheta_array,
+                                                  self.cache_options(member))
+            cache_value = self.evaluation_cache.get(cache_key)
+            if cache_value is not None:
+                print("---- call already in evaluation cache ----")
+                diff = self.diff_from_ADMR(*cache_value)
+                self.record_call(pars_values, diff)
+                return diff
+
+        ## Compute all the datasets from the same sigma ----------------------------
+        if self.transport_data is not None:
+            sigma_array = transport_sigma(member, self.bandObject, self.ranges_dict,
+                                          self.conditions_func())
+            self.nb_calls += 1
+            print("---- call #" + str(self.nb_calls) + " in %.6s seconds ----" % (time.time() - start_total_time))
+            diff = self.diff_from_sigma(sigma_array)
+            self.record_call(pars_values, diff)
+            return diff
+
         ## Compute ADMR ------------------------------------------------------------
-        self.produce_ADMR_object()
-        self.admrObject.runADMR()
+        condObject, admrObject = produce_ADMR_object(member, self.bandObject, self.ranges_dict,
+                                                     self.Bphi_array, self.Btheta_array)
+        admrObject.runADMR(jacobian_params=self.jacobian_active)
+        if self.jacobian_active is not None:
+            self.jacobian_dict[pars_values] = self.jacobian_from_ADMR(admrObject.rzz_jacobian_array,
+                                                                      admrObject.rhozz_jacobian_array)
 
         self.nb_calls += 1
         print("---- call #" + str(self.nb_calls) + " in %.6s seconds ----" % (time.time() - start_total_time))
 
+        if self.evaluation_cache is not None:
+            self.evaluation_cache.put(cache_key, admrObject.rzz_array, admrObject.rhozz_array)
+
         ## Compute diff
-        diff_matrix = np.zeros_like(self.rzz_data_matrix)
-        for i in range(self.Bphi_array.size):
-            if self.normalized_data==True:
-                diff_matrix[i, :] = self.rzz_data_matrix[i, :] - self.admrObject.rzz_array[i, :]
-            else:
-                diff_matrix[i, :] = (self.rhozz_data_matrix[i, :] - self.admrObject.rhozz_array[i, :])*1e5
+        diff = self.diff_from_ADMR(admrObject.rzz_array, admrObject.rhozz_array)
+        self.record_call(pars_values, diff)
+        return diff
 
-        return diff_matrix.flatten()
 
+    def map_population(self, func, population):
+        """Replaces the map of differential evolution to evaluate a whole
+        generation in the pool of workers. 'func' is lmfit's penalty, it is not
+        used as the population is directly sent to the workers, the penalty
+        is then the same sum of squares as lmfit's."""
+        start_total_time = time.time()
 
-    def runFit(self):
+        if self.rzz_data_matrix is None:
+            self.load_all_data()
+
+        ## From lmfit internal values to parameters values
+        pars_values_list = []
+        for x in population:
+            pars_values_list.append(tuple(float(self.pars_bounds[param_name].from_internal(value))
+                                          for param_name, value in zip(self.ranges_dict.keys(), x)))
+
+        ## Evaluate in the pool only what is not already computed
+        pars_values_new = []
+        members = []
+        cache_keys = []
+        for pars_values in dict.fromkeys(pars_values_list):
+            if pars_values in self.history_dict.keys():
+                continue
+            member = self.member_from_pars(pars_values)
+            if self.evaluation_cache is not None:
+                cache_key = self.evaluation_cache.key(member, self.Bphi_array, self.Btheta_array,
+                                                      self.cache_options(member))
+                cache_value = self.evaluation_cache.get(cache_key)
+                if cache_value is not None:
+                    self.record_call(pars_values, self.diff_from_ADMR(*cache_value))
+                    continue
+                cache_keys.append(cache_key)
+            pars_values_new.append(pars_values)
+            members.append(member)
+        if self.transport_data is not None:
+            results = self.pool.map(evaluate_member_sigma, [(member, self.ranges_dict, self.conditions_func())
+                                                            for member in members])
+            for pars_values, sigma_array in zip(pars_values_new, results):
+                self.nb_calls += 1
+                self.record_call(pars_values, self.diff_from_sigma(sigma_array))
+            print("---- generation of " + str(len(members)) + " calls in %.6s seconds ----" % (time.time() - start_total_time))
+            return [np.sum(self.history_dict[pars_values]**2) for pars_values in pars_values_list]
+
+        results = self.pool.map(evaluate_member, [(member, self.ranges_dict, self.Bphi_array, self.Btheta_array)
+                                                  for member in members])
+        for i, (pars_values, (rzz_array, rhozz_array)) in enumerate(zip(pars_values_new, results)):
+            self.nb_calls += 1
+            if self.evaluation_cache is not None:
+                self.evaluation_cache.put(cache_keys[i], rzz_array, rhozz_array)
+            self.record_call(pars_values, self.diff_from_ADMR(rzz_array, rhozz_array))
+
+        print("---- generation of " + str(len(members)) + " calls in %.6s seconds ----" % (time.time() - start_total_time))
+        return [np.sum(self.history_dict[pars_values]**2) for pars_values in pars_values_list]
+
+
+    def callback_population(self, intermediate_result):
+        """Called by differential evolution at each generation"""
+        self.last_population = np.array(intermediate_result.population)
+        if self.checkpoint is not None:
+            self.save_checkpoint()
+
+
+    def save_checkpoint(self):
+        """Save the evaluated parameters, their diff and the last population of
+        differential evolution, the file is replaced only once fully written"""
+        if self.last_population is None:
+            population = np.empty((0, len(self.ranges_dict)))
+        else:
+            population = self.last_population
+        path_tmp = self.checkpoint + ".tmp"
+        with open(path_tmp, "wb") as f:
+            np.savez(f, param_names=np.array(list(self.ranges_dict.keys())),
+                        history_pars=np.array(self.history_pars, dtype=np.float64),
+                        history_diff=np.array(self.history_diff, dtype=np.float64),
+                        population=population,
+                        run_hash=np.array(self.run_hash()))
+        os.replace(path_tmp, self.checkpoint)
+
+
+    def run_hash(self):
+        """Hash of all that the diff of a call depends on, but the fit
+        parameters: the member, the options of cache_options and the data as
+        interpolated, so that a checkpoint is only resumed for the same run,
+        as ADMRStore.is_same_run"""
+        if self.rzz_data_matrix is None:
+            self.load_all_data()
+        member = json.loads(json.dumps(self.member, default=to_json))
+        for param_name in self.ranges_dict.keys():
+            member.pop(param_name, None)
+            member["band_params"].pop(param_name, None)
+        if member.get("fixdoping", 2) >=-1 and member.get("fixdoping", 2) <=1:
+            member["band_params"].pop("mu", None) # output of the fit
+        content = json.dumps({"member": member,
+                              "options": self.cache_options(self.member),
+                              "param_names": list(self.ranges_dict.keys()),
+                              "normalized_data": bool(self.normalized_data)},
+                             sort_keys=True, default=to_json)
+        run_hash = hashlib.sha256(content.encode())
+        data_list = [self.Bphi_array, self.Btheta_array, self.rzz_data_matrix, self.rhozz_data_matrix]
+        for dataset in self.transport_data_list:
+            data_list += [dataset["x_array"], dataset["y_array"], [dataset["weight"]]]
+        for data in data_list:
+            run_hash.update(np.ascontiguousarray(data, dtype=np.float64).tobytes())
+        return run_hash.hexdigest()
+
+
+    def load_checkpoint(self):
+        if not os.path.isfile(self.checkpoint):
+            print("No checkpoint found at " + self.checkpoint + ", the fit starts from scratch")
+            return
+        data = np.load(self.checkpoint)
+        if list(data["param_names"]) != list(self.ranges_dict.keys()):
+            print("Warning! The checkpoint does not fit the same parameters, it is not used")
+            return
+        if "run_hash" not in data.files or str(data["run_hash"]) != self.run_hash():
+            print("Warning! The checkpoint was written for another member or other data, it is not used")
+            return
+        self.history_pars = [tuple(pars_values) for pars_values in data["history_pars"]]
+        self.history_diff = list(data["history_diff"])
+        self.history_dict = dict(zip(self.history_pars, self.history_diff))
+        if data["population"].shape[0] != 0:
+            self.last_population = data["population"]
+        print("Checkpoint loaded: " + str(len(self.history_pars)) + " calls already done")
+
+
+    def best_from_history(self):
+        """Returns the parameter values of the lowest chi2 in the history"""
+        chi2_list = [np.sum(diff**2) for diff in self.history_diff]
+        return self.history_pars[int(np.argmin(chi2_list))]
+
+
+    def fit_stage(self, method, resume=False):
         ## Initialize parameters
 
         self.nb_calls = 0
+        self.nb_calls_checkpoint = 0
+        self.rzz_data_matrix = None # data interpolated again at the first call
+
+        ## Resume from checkpoint
+        init_population = 'latinhypercube'
+        if resume == True and self.checkpoint is not None:
+            self.load_checkpoint()
+            if len(self.history_pars) != 0:
+                for param_name, value in zip(self.ranges_dict.keys(), self.best_from_history()):
+                    self.pars[param_name].value = value
+            if self.last_population is not None and self.last_population.shape[0] >= 5:
+                init_population = self.last_population
 
         ## Run fit algorithm
-        if self.method=="least_square":
-            out = minimize(self.compute_diff, self.pars)
-        if self.method=="shgo":
+        out = None
+        if method=="least_square":
+            out = self.minimize_least_square()
+        elif method=="shgo":
             out = minimize(self.compute_diff, self.pars,
                            method='shgo', sampling_method='sobol', options={"f_tol": 1e-16}, n = 100, iters=20)
-        if self.method=="differential_evolution":
+        elif method=="differential_evolution" and self.workers > 1:
+            self.start_pool()
+            try:
+                out = minimize(self.compute_diff, self.pars,
+                               method='differential_evolution', popsize=self.popsize_func(),
+                               init=init_population, callback=self.callback_population,
+                               workers=self.map_population, updating='deferred')
+            finally:
+                self.close_pool()
+        elif method=="differential_evolution":
+            ## default popsize of lmfit, population only sizes the pool of workers
             out = minimize(self.compute_diff, self.pars,
-                           method='differential_evolution')
-        if self.method=="ampgo":
+                           method='differential_evolution',
+                           init=init_population, callback=self.callback_population)
+        elif method=="surrogate":
+            out = self.fit_surrogate()
+        elif method=="ampgo":
             out = minimize(self.compute_diff, self.pars,
                            method='ampgo')
         else:
             print("This method does not exist in the class")
 
+        if self.checkpoint is not None:
+            self.save_checkpoint()
+        return out
+
+
+    def start_pool(self):
+        """Pool of workers for map_population. The workers are spawned, not
+        forked: the threads of numba in this process are not fork-safe."""
+        self.pars_bounds = deepcopy(self.pars)
+        for param in self.pars_bounds.values():
+            param.setup_bounds() # defines from_internal as lmfit does
+        self.pool = get_context("spawn").Pool(self.workers, initializer=init_worker,
+                                              initargs=(self.member, self.pipi_FSR))
+
+
+    def close_pool(self):
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+
+
+    def popsize_func(self):
+        """popsize of differential evolution, which multiplies the number of
+        parameters, for a population of about self.population members"""
+        return max(1, int(np.ceil(self.population / len(self.ranges_dict))))
+
+
+    def fit_surrogate(self):
+        """Fit with a RBF surrogate of the diff vector over the fit parameters.
+        The true model is only computed at the points proposed by the surrogate:
+        candidates are drawn around the best point and uniformly in the bounds,
+        and the one minimizing a weighted sum of the predicted chi2 and of the
+        closeness to the points already computed is chosen (the weight cycles
+        from exploration to exploitation). Each new call is added to the
+        surrogate, the best point is then polished by a short least square."""
+        rng = np.random.default_rng(self.surrogate_seed)
+        param_names = list(self.ranges_dict.keys())
+        N_params = len(param_names)
+        lower = np.array([self.pars[param_name].min for param_name in param_names])
+        upper = np.array([self.pars[param_name].max for param_name in param_names])
+        weight_cycle = [0.3, 0.5, 0.8, 0.95]
+
+        def compute_diff_at(x):
+            for param_name, value in zip(param_names, lower + x * (upper - lower)):
+                self.pars[param_name].value = value
+            return self.compute_diff(self.pars)
+
+        ## Initial samples, the calls of the checkpoint are used as well
+        N_init = self.surrogate_init
+        if N_init is None:
+            N_init = 2 * (N_params + 1)
+        N_init = max(N_init - len(self.history_pars), 0)
+        if len(self.history_pars) < N_params + 1:
+            N_init = max(N_init, N_params + 1 - len(self.history_pars))
+        x_init = (np.argsort(rng.random((N_init, N_params)), axis=0) +
+                  rng.random((N_init, N_params))) / max(N_init, 1) # latin hypercube
+        for x in x_init:
+            compute_diff_at(x)
+
+        for i in range(self.surrogate_iter):
+            ## Fit the surrogate on all the calls within bounds
+            x_samples = (np.array(self.history_pars) - lower) / (upper - lower)
+            diff_samples = np.array(self.history_diff)
+            inside = np.all((x_samples >= 0) * (x_samples <= 1), axis=1)
+            x_samples, index_unique = np.unique(x_samples[inside], axis=0, return_index=True)
+            diff_samples = diff_samples[inside][index_unique]
+            surrogate = RBFInterpolator(x_samples, diff_samples, kernel="thin_plate_spline")
+
+            ## Candidates around the best point and uniform
+            x_best = x_samples[np.argmin(np.sum(diff_samples**2, axis=1))]
+            N_candidates = 100 * N_params
+            x_candidates = np.vstack((np.clip(x_best + 0.1 * rng.standard_normal((N_candidates, N_params)), 0, 1),
+                                      rng.random((N_candidates, N_params))))
+            chi2_candidates = np.sum(surrogate(x_candidates)**2, axis=1)
+            distance = np.min(np.linalg.norm(x_candidates[:, None, :] - x_samples[None, :, :], axis=2), axis=1)
+
+            ## Score of the candidates, both terms in [0, 1]
+            score_chi2 = (chi2_candidates - np.min(chi2_candidates)) / (np.ptp(chi2_candidates) + 1e-300)
+            score_distance = 1 - (distance - np.min(distance)) / (np.ptp(distance) + 1e-300)
+            weight = weight_cycle[i % len(weight_cycle)]
+            score = weight * score_chi2 + (1 - weight) * score_distance
+            score[distance < 1e-6] = np.inf # already computed
+            if np.all(np.isinf(score)):
+                break
+            compute_diff_at(x_candidates[np.argmin(score)])
+
+        ## Polish the best point
+        for param_name, value in zip(param_names, self.best_from_history()):
+            self.pars[param_name].value = value
+        return self.minimize_least_square(max_nfev=self.surrogate_polish)
+
+
+    def fit_fidelity_schedule(self, resume=False):
+        """Runs the fit at the coarse resolutions of fidelity_schedule first,
+        the best candidates of each stage are evaluated again at the next
+        resolution and the best of them starts the fit of this stage.
+        If the change of resolution moves the diff by less than
+        fidelity_tol times the diff itself, the coarse optimum is trusted and
+        the fit of the stage is skipped, the last stage is always fitted."""
+        stage_list = self.fidelity_stage_list()
+        checkpoint = self.checkpoint
+        self.fidelity_noise_list = []
+
+        for i, stage in enumerate(stage_list):
+            last_stage = (i == len(stage_list) - 1)
+            self.member.update(stage)
+            if checkpoint is not None and not last_stage:
+                self.checkpoint = checkpoint + ".stage" + str(i)
+            else:
+                self.checkpoint = checkpoint
+            print("==== Fidelity stage #" + str(i) + " " + str(stage) + " ====")
+
+            ## First stage with the global method
+            if i == 0:
+                self.reset_history()
+                out = self.fit_stage(self.method, resume=resume)
+                continue
+
+            ## Promote the best candidates of the previous stage
+            history_pars, history_diff = self.history_pars, self.history_diff
+            chi2_list = [np.sum(diff**2) for diff in history_diff]
+            index_best = np.argsort(chi2_list)[:self.fidelity_promote]
+            self.reset_history()
+            self.rzz_data_matrix = None
+            noise_list = []
+            for index in index_best:
+                for param_name, value in zip(self.ranges_dict.keys(), history_pars[index]):
+                    self.pars[param_name].value = value
+                diff = self.compute_diff(self.pars)
+                noise_list.append(np.sqrt(np.mean((diff - history_diff[index])**2)))
+            pars_best = self.best_from_history()
+            for param_name, value in zip(self.ranges_dict.keys(), pars_best):
+                self.pars[param_name].value = value
+
+            ## Resolution noise compared to the diff of the best candidate
+            noise = np.max(noise_list)
+            diff_best = np.sqrt(np.mean(self.history_dict[pars_best]**2))
+            self.fidelity_noise_list.append(noise)
+            print("==== Resolution noise " + "{0:.3g}".format(noise) +
+                  " for diff " + "{0:.3g}".format(diff_best) + " ====")
+            if noise < self.fidelity_tol * diff_best and not last_stage:
+                continue
+
+            out = self.fit_stage(self.fidelity_method, resume=resume)
+
+        self.checkpoint = checkpoint
+        return out
+
+
+    def fidelity_stage_list(self):
+        """Stages of fidelity_schedule followed by the resolution of
+        init_member, each stage sets all the keys of the schedule: a key
+        missing in a stage takes the value of init_member, or else the
+        default of the class, as bandObject keeps the last value it was given"""
+        keys = []
+        for stage in self.fidelity_schedule:
+            keys += [key for key in stage.keys() if key not in keys]
+        stage_list = []
+        for stage in list(self.fidelity_schedule) + [{}]:
+            stage_list.append({key: stage.get(key, self.init_member.get(key, self.default_value(key)))
+                               for key in keys})
+        return stage_list
+
+
+    def default_value(self, key):
+        """Default of key in the classes built from the member"""
+        if self.pipi_FSR==False:
+            band_class = BandStructure
+        else:
+            band_class = PiPiBandStructure
+        for cls in [band_class, BandStructure, Conductivity, ADMR]:
+            parameters = inspect.signature(cls.__init__).parameters
+            if key in parameters.keys() and parameters[key].default is not inspect.Parameter.empty:
+                return parameters[key].default
+        return None
+
+
+    def reset_history(self):
+        self.history_pars = []
+        self.history_diff = []
+        self.history_dict = {}
+        self.last_population = None
+
+
+    def runFit(self, resume=False):
+        """resume: if True, the fit starts again from the last checkpoint"""
+        if self.fidelity_schedule is None:
+            out = self.fit_stage(self.method, resume=resume)
+        else:
+            out = self.fit_fidelity_schedule(resume=resume)
+
         ## Display fit report
         report_fit(out)
 
@@ -251,7 +877,7 @@ class FittingADMR:
             col_rzz      = self.data_dict[self.member["data_T"], phi][2]
             rhozz_0      = self.data_dict[self.member["data_T"], phi][4]
 
-            data  = np.loadtxt(filename, dtype="float", comments="#")
+            data  = load_data(filename, self.cache_folder)
             theta = data[:, col_theta]
             rzz   = data[:, col_rzz]
 
@@ -362,6 +988,95 @@ class FittingADMR:
 
 
 
+## Stateless evaluation of one member >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>#
+def cache_options(member, pipi_FSR):
+    """Options of the evaluation cache key which change the result but are
+    not always in the member: pipi_FSR and the options of the solver,
+    with the default of Conductivity if the member does not set them"""
+    options = {"pipi_FSR": pipi_FSR}
+    for option_name in cache_solver_options:
+        options[option_name] = member.get(option_name,
+                                          conductivity_defaults[option_name])
+    return options
+
+
+def produce_ADMR_object(member, bandObject, ranges_dict, Bphi_array, Btheta_array):
+    """Returns (condObject, admrObject) for member, only bandObject is modified"""
+    ## Discretization of the member, it changes with the fidelity stages
+    if "res_xy" in member.keys():
+        bandObject.res_xy = member["res_xy"]
+    if "res_z" in member.keys():
+        bandObject.res_z = member["res_z"] + 1 - member["res_z"] % 2 # odd number
+
+    ## Update bandObject
+    for param_name in ranges_dict.keys():
+            if hasattr(bandObject, param_name):
+                setattr(bandObject, param_name, member[param_name])
+            if param_name in bandObject._band_params.keys():
+                bandObject[param_name] = member["band_params"][param_name]
+
+    ## Adjust the doping if need be
+    if member["fixdoping"] >=-1 and member["fixdoping"] <=1:
+        bandObject.setMuToDoping(member["fixdoping"])
+        member["band_params"]["mu"] = bandObject["mu"]
+
+    bandObject.runBandStructure()
+    condObject = Conductivity(bandObject, **member)
+    admrObject = ADMR([condObject], **member)
+    admrObject.Btheta_array = Btheta_array
+    admrObject.Bphi_array = Bphi_array
+    return condObject, admrObject
+
+
+def transport_sigma(member, bandObject, ranges_dict, conditions):
+    """Returns sigma[n, i, j] of member for the conditions[n] = (T, Bamp, Bphi, Btheta),
+    the trajectories of each condition are computed only once for all its components"""
+    condObject, admrObject = produce_ADMR_object(member, bandObject, ranges_dict,
+                                                 np.array([0.]), np.array([0.]))
+    sigma_array = np.empty((len(conditions), 3, 3), dtype=np.float64)
+    for n, (T, Bamp, Bphi, Btheta) in enumerate(conditions):
+        if condObject.T != T:
+            condObject.T = T
+        condObject.Bamp = Bamp
+        condObject.Bphi = Bphi
+        condObject.Btheta = Btheta
+        condObject.runTransport()
+        sigma_array[n] = condObject.chambersTensorsFunc()[0]
+    return sigma_array
+
+
+## Each process of the pool keeps its own band object
+worker_bandObject = None
+
+def init_worker(member, pipi_FSR):
+    """Build the band object of the worker and compile its numba functions
+    once, before the first generation: the ones of the band and the fused
+    scattering kernel of the member, for the dtype of its trajectories"""
+    global worker_bandObject
+    if pipi_FSR==False:
+        worker_bandObject = BandStructure(**member)
+    else:
+        worker_bandObject = PiPiBandStructure(**member)
+    worker_bandObject.runBandStructure()
+    condObject = Conductivity(worker_bandObject, **member)
+    kf = worker_bandObject.kf.astype(condObject.trajectories_dtype)
+    vf = worker_bandObject.vf.astype(condObject.trajectories_dtype)
+    condObject.gamma_total_func(kf[0, :], kf[1, :], kf[2, :], vf[0, :], vf[1, :], vf[2, :])
+
+def evaluate_member(args):
+    """Returns (rzz_array, rhozz_array) for (member, ranges_dict, Bphi_array, Btheta_array)"""
+    member, ranges_dict, Bphi_array, Btheta_array = args
+    condObject, admrObject = produce_ADMR_object(member, worker_bandObject, ranges_dict,
+                                                 Bphi_array, Btheta_array)
+    admrObject.runADMR()
+    return admrObject.rzz_array, admrObject.rhozz_array
+
+def evaluate_member_sigma(args):
+    """Returns transport_sigma for (member, ranges_dict, conditions)"""
+    member, ranges_dict, conditions = args
+    return transport_sigma(member, worker_bandObject, ranges_dict, conditions)
+
+
 
 
 
@@ -11,6 +11,9 @@ from matplotlib.backends.backend_pdf import PdfPages
 from cuprates_transport.bandstructure import BandStructure, PiPiBandStructure, setMuToDoping, doping
 from cuprates_transport.admr import ADMR
 from cuprates_transport.conductivity import Conductivity
+from cuprates_transport.data_cache import load_data
+from cuprates_transport.evaluation_cache import EvaluationCache
+from cuprates_transport.fitting_admr import cache_options
 ##<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
 
 class FittingADMR:
@@ -19,6 +22,8 @@ class FittingADMR:
                  method="differential_evolution",
                  population=100, N_generation=20, mutation_s=0.1, crossing_p=0.9,
                  normalized_data=True,
+                 cache_folder=None,
+                 evaluation_cache=None, evaluation_cache_size=10000,
                  **trash):
         ## Initialize
         self.init_member = deepcopy(init_member)
@@ -28,6 +33,7 @@ class FittingADMR:
         self.folder      = folder
         self.normalized_data = normalized_data
         self.pipi_FSR    = pipi_FSR
+        self.cache_folder = cache_folder # folder for the binary copies of the data files
         self.weight_rhozz = 0
         self.pars        = Parameters()
         for param_name, param_range in self.ranges_dict.items():
@@ -39,6 +45,10 @@ class FittingADMR:
             elif param_name in self.init_member["band_params"].keys():
                 self.pars.add(param_name, value = self.init_member["band_params"][param_name], min = param_range[0], max = param_range[-1])
         self.method      = method # "shgo", "differential_evolution", "leastsq"
+        ## Cache of the evaluations shared between fits, path of SQLite file
+        self.evaluation_cache = None
+        if evaluation_cache is not None:
+            self.evaluation_cache = EvaluationCache(evaluation_cache, max_entries=evaluation_cache_size)
 
         ## Create a dictionnary member that contains dictionnaries for each temperatures
         self.member_dict = {}
@@ -148,7 +158,7 @@ class FittingADMR:
                 Btheta_cut   = self.data_dict[T, phi][3]
                 rhozz_0      = self.data_dict[T, phi][4] # Ohm.m
 
-                data = np.loadtxt(filename, dtype="float", comments="#")
+                data = load_data(filename, self.cache_folder)
                 theta = data[:, col_theta]
                 rzz   = data[:, col_rzz]
 
@@ -178,8 +188,9 @@ class FittingADMR:
 
         start_total_time = time.time()
 
-        ## Load data
-        self.load_and_interp_data()
+        ## Load data, only once per fit
+        if len(self.rzz_data_i_dict) == 0:
+            self.load_and_interp_data()
 
         ## Update Btheta & Bphi function of the data
         for T in self.data_T_list:
@@ -208,24 +219,45 @@ class FittingADMR:
             elif param_name in self.init_member["band_params"].keys():
                         print(param_name + " : " + "{0:g}".format(self.pars[param_name].value))
 
-        ## Compute ADMR ------------------------------------------------------------
-        self.produce_ADMR_object()
-        for T in self.data_T_list:
-            self.admrObject_dict[T].runADMR()
+        ## Look for the temperatures already computed in previous fits
+        rzz_dict   = {}
+        rhozz_dict = {}
+        cache_key_dict = {}
+        if self.evaluation_cache is not None:
+            for T in self.data_T_list:
+                cache_key_dict[T] = self.evaluation_cache.key(self.member_dict[T], self.Bphi_dict[T], self.Btheta_dict[T],
+                                                           cache_options(self.member_dict[T], self.pipi_FSR))
+                cache_value = self.evaluation_cache.get(cache_key_dict[T])
+                if cache_value is not None:
+                    rzz_dict[T], rhozz_dict[T] = cache_value
 
-        self.nb_calls += 1
-        print("---- call #" + str(self.nb_calls) + " in %.6s seconds ----" % (time.time() - start_total_time))
+        ## Compute ADMR ------------------------------------------------------------
+        if len(rzz_dict) != len(self.data_T_list):
+            self.produce_ADMR_object()
+            for T in self.data_T_list:
+                if T in rzz_dict.keys():
+                    continue
+                self.admrObject_dict[T].runADMR()
+                rzz_dict[T]   = self.admrObject_dict[T].rzz_array
+                rhozz_dict[T] = self.admrObject_dict[T].rhozz_array
+                if self.evaluation_cache is not None:
+                    self.evaluation_cache.put(cache_key_dict[T], rzz_dict[T], rhozz_dict[T])
+
+            self.nb_calls += 1
+            print("---- call #" + str(self.nb_calls) + " in %.6s seconds ----" % (time.time() - start_total_time))
+        else:
+            print("---- call already in evaluation cache ----")
 
         diff = np.array([])
         for T in self.data_T_list:
             diff_matrix = np.zeros_like(self.rzz_data_i_dict[T])
             for i, phi in enumerate(self.Bphi_dict[T]):
-                diff_matrix[i, :] = self.rzz_data_i_dict[T][i, :] - self.admrObject_dict[T].rzz_array[i, :]
+                diff_matrix[i, :] = self.rzz_data_i_dict[T][i, :] - rzz_dict[T][i, :]
             diff = np.append(diff, diff_matrix.flatten())
 
             if self.normalized_data==False:
                 for i, phi in enumerate(self.Bphi_dict[T]):
-                    rhozz_0_fit  = np.interp(0, self.admrObject_dict[T].Btheta_array, self.admrObject_dict[T].rhozz_array[i, :])
+                    rhozz_0_fit  = np.interp(0, self.Btheta_dict[T], rhozz_dict[T][i, :])
                     rhozz_0_data = self.rhozz_0_data_dict[T, phi]
                     diff_rhozz_0 = self.weight_rhozz * (rhozz_0_data - rhozz_0_fit) * 1e5 # mOhm.cm
                     diff = np.append(diff, diff_rhozz_0)
@@ -236,6 +268,7 @@ class FittingADMR:
         ## Initialize parameters
 
         self.nb_calls = 0
+        self.rzz_data_i_dict = {} # data interpolated again at the first call
 
         ## Run fit algorithm
         if self.method=="least_square":
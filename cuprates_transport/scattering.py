@@ -0,0 +1,269 @@
+import numpy as np
+from numpy import pi
+from scipy.constants import hbar, physical_constants
+from numba import njit, prange
+import math
+##<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<#
+
+## Units ////////
+meV = physical_constants["electron volt"][0] * 1e-3 # 1 meV in Joule
+
+
+class ScatteringTerm:
+    """A term of the total scattering rate of Conductivity.
+
+    name:       key of the term in the registry
+    active:     function(condObject) -> True if the term is part of gamma_tot
+    code:       numba code of the term, it adds to (or multiplies) gamma_n,
+                it can use the inputs and the values below by their name
+    inputs:     geometric inputs of the code, computed once per point for all
+                the terms: "phi" (angle in the FBZ), "cos_2phi" (cos(2 phi)
+                without trigonometric functions), "v" (v_norm, norm of the
+                velocity), "dos" (1 / v_norm), "af_mask" (out_af, True outside
+                the AF FBZ)
+    values:     names of the scalars of the code, attributes of condObject
+                or keys of scattering_values_dict
+    energy_func: function(condObject, epsilon) for the terms which only depend
+                on energy, they are added once to gamma_0 instead of a code
+    multiplicative: if True, the code is applied after all the additive terms
+    """
+    def __init__(self, name, active, code="", inputs=(), values=(),
+                 energy_func=None, multiplicative=False):
+        self.name = name
+        self.active = active
+        self.code = code
+        self.inputs = tuple(inputs)
+        self.values = tuple(values)
+        self.energy_func = energy_func
+        self.multiplicative = multiplicative
+
+
+## Registry >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>#
+scattering_terms_list = [] # in the order they are summed
+scattering_kernels_dict = {} # compiled kernels, keys=names of the active terms
+
+## Scalars of the codes which are not attributes of Conductivity
+scattering_values_dict = {
+    "a": lambda condObject: condObject.bandObject.a,
+    "b": lambda condObject: condObject.bandObject.b,
+    "dos_max": lambda condObject: np.max(condObject.bandObject.dos_k),
+    "vF_units": lambda condObject: 1e-12 / (hbar / meV), # Angstrom.meV to Angstrom / ps
+}
+
+## Code of the geometric inputs, computed once per point
+inputs_code_dict = {
+    "k_FBZ": ["kx_n = kx[n] + pi / a",
+              "kx_n = kx_n - math.floor(kx_n / (2*pi / a)) * (2*pi / a) - pi / a",
+              "ky_n = ky[n] + pi / b",
+              "ky_n = ky_n - math.floor(ky_n / (2*pi / b)) * (2*pi / b) - pi / b"],
+    "phi": ["phi = math.atan2(ky_n, kx_n)"],
+    "cos_2phi": ["k2_n = kx_n**2 + ky_n**2",
+                 "cos_2phi = (kx_n**2 - ky_n**2) / k2_n if k2_n != 0 else 1.0"],
+    "v": ["v_norm = math.sqrt(vx[n]**2 + vy[n]**2 + vz[n]**2)"],
+    "dos": ["dos = 1 / v_norm"],
+    "af_mask": ["d1 = ky[n] * b - kx[n] * a - pi",
+                "d2 = ky[n] * b - kx[n] * a + pi",
+                "d3 = ky[n] * b + kx[n] * a - pi",
+                "d4 = ky[n] * b + kx[n] * a + pi",
+                "out_af = not ((d1 <= 0) and (d2 >= 0) and (d3 <= 0) and (d4 >= 0))"],
+}
+inputs_values_dict = {"k_FBZ": ("a", "b"), "af_mask": ("a", "b")}
+inputs_order = ["k_FBZ", "phi", "cos_2phi", "v", "dos", "af_mask"]
+
+
+def register_scattering_term(term, replace=False):
+    """Adds a ScatteringTerm to the registry, the kernels are compiled again"""
+    names = [registered.name for registered in scattering_terms_list]
+    if term.name in names:
+        if replace == False:
+            print("Warning! The scattering term " + term.name + " already exists, use replace=True")
+            return
+        scattering_terms_list[names.index(term.name)] = term
+    else:
+        scattering_terms_list.append(term)
+    scattering_kernels_dict.clear()
+
+
+def active_terms(condObject):
+    return [term for term in scattering_terms_list if term.active(condObject)]
+
+
+def scattering_value(condObject, name):
+    if name in scattering_values_dict.keys():
+        return scattering_values_dict[name](condObject)
+    return getattr(condObject, name)
+
+
+def kernel_values(terms):
+    """Names of the scalars needed by the codes of terms"""
+    names = []
+    for term in terms:
+        inputs = term.inputs + (("k_FBZ",) if "phi" in term.inputs or "cos_2phi" in term.inputs else ())
+        for name in term.values + sum((inputs_values_dict.get(key, ()) for key in inputs), ()):
+            if name not in names:
+                names.append(name)
+    return names
+
+
+def compile_kernel(terms, batch=False):
+    """Writes and compiles with numba the fused kernel of terms, it computes
+    the inputs once per point and writes gamma in place. With batch=True,
+    gamma_base[s] & values[s, :] are given for each set s of scattering
+    parameters and gamma[s, n] is computed for all sets at each point."""
+    inputs = set(sum((term.inputs for term in terms), ()))
+    if "dos" in inputs:
+        inputs.add("v")
+    if "phi" in inputs or "cos_2phi" in inputs:
+        inputs.add("k_FBZ")
+    indent = "            " if batch else "        "
+    ## the values of the inputs (a, b) are the same for all sets
+    inputs_values = sum((inputs_values_dict.get(key, ()) for key in inputs), ())
+    lines = ["def kernel(kx, ky, kz, vx, vy, vz, gamma_base, values, gamma):"]
+    set_lines = []
+    for i, name in enumerate(kernel_values(terms)):
+        if batch == False:
+            lines.append("    " + name + " = values[" + str(i) + "]")
+        elif name in inputs_values:
+            lines.append("    " + name + " = values[0, " + str(i) + "]")
+        else:
+            set_lines.append(indent + name + " = values[s, " + str(i) + "]")
+    lines.append("    for n in prange(kx.shape[0]):")
+    for key in inputs_order:
+        if key in inputs:
+            lines += ["        " + line for line in inputs_code_dict[key]]
+    if batch:
+        lines.append("        for s in range(gamma_base.shape[0]):")
+        lines += set_lines
+        lines.append(indent + "gamma_n = gamma_base[s]")
+    else:
+        lines.append(indent + "gamma_n = gamma_base")
+    for term in ([term for term in terms if not term.multiplicative] +
+                 [term for term in terms if term.multiplicative]):
+        lines += [indent + line for line in term.code.strip().splitlines()]
+    lines.append(indent + ("gamma[s, n] = gamma_n" if batch else "gamma[n] = gamma_n"))
+
+    namespace = {"math": math, "pi": pi, "prange": prange}
+    exec("\n".join(lines), namespace)
+    return njit(namespace["kernel"], parallel=True)
+
+
+def fused_terms(condObject, epsilon=0):
+    """Returns (terms, gamma_base, values) of the fused kernel of condObject:
+    the terms of the kernel, gamma_0 plus the terms which only depend on
+    energy, and the scalars of the codes"""
+    terms = active_terms(condObject)
+    gamma_base = float(condObject.gamma_0)
+    for term in terms:
+        if term.energy_func is not None:
+            gamma_base += term.energy_func(condObject, epsilon)
+    terms = [term for term in terms if term.energy_func is None]
+    values = np.array([scattering_value(condObject, name) for name in kernel_values(terms)],
+                      dtype=np.float64)
+    return terms, gamma_base, values
+
+
+def fused_arrays(kx, ky, kz, vx, vy, vz):
+    """Flat contiguous inputs of the kernels, float32 trajectories are read
+    as they are, numba compiles a kernel for them"""
+    shape = np.shape(kx)
+    dtype = np.float32 if np.result_type(kx, ky, kz, vx, vy, vz) == np.float32 else np.float64
+    arrays = [np.ascontiguousarray(np.broadcast_to(array, shape), dtype=dtype).ravel()
+              for array in (kx, ky, kz, vx, vy, vz)]
+    return shape, arrays
+
+
+def gamma_fused_func(condObject, kx, ky, kz, vx, vy, vz, epsilon=0):
+    """Total scattering rate of condObject in THz, computed by the fused
+    kernel of its active terms"""
+    terms, gamma_base, values = fused_terms(condObject, epsilon)
+    key = tuple(term.name for term in terms)
+    if key not in scattering_kernels_dict.keys():
+        scattering_kernels_dict[key] = compile_kernel(terms)
+    kernel = scattering_kernels_dict[key]
+
+    shape, arrays = fused_arrays(kx, ky, kz, vx, vy, vz)
+    gamma = np.empty(arrays[0].size, dtype=np.float64)
+    kernel(*arrays, gamma_base, values, gamma)
+    return gamma.reshape(shape)
+
+
+def gamma_fused_batch_func(fused_terms_list, kx, ky, kz, vx, vy, vz):
+    """gamma[s, ...] in THz for each (terms, gamma_base, values) of
+    fused_terms_list, see fused_terms. The sets with the same active terms
+    go through one batch kernel, which computes the inputs of each point
+    once for all of them."""
+    shape, arrays = fused_arrays(kx, ky, kz, vx, vy, vz)
+    gamma = np.empty((len(fused_terms_list), arrays[0].size), dtype=np.float64)
+    groups = {} # keys=names of the active terms, values=index of the sets
+    for s, (terms, gamma_base, values) in enumerate(fused_terms_list):
+        groups.setdefault(tuple(term.name for term in terms), []).append(s)
+    for key, index in groups.items():
+        terms = fused_terms_list[index[0]][0]
+        if ("batch",) + key not in scattering_kernels_dict.keys():
+            scattering_kernels_dict[("batch",) + key] = compile_kernel(terms, batch=True)
+        kernel = scattering_kernels_dict[("batch",) + key]
+        gamma_base = np.array([fused_terms_list[s][1] for s in index], dtype=np.float64)
+        values = np.array([fused_terms_list[s][2] for s in index], dtype=np.float64)
+        gamma_group = np.empty((len(index), arrays[0].size), dtype=np.float64)
+        kernel(*arrays, gamma_base, values, gamma_group)
+        gamma[index] = gamma_group
+    return gamma.reshape((len(fused_terms_list),) + shape)
+
+
+## Terms of Conductivity.tau_total_func >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>#
+register_scattering_term(ScatteringTerm("skew_marginal_fl",
+    active=lambda c: c.a_epsilon!=0 or c.a_abs_epsilon!=0 or c.a_T!=0,
+    energy_func=lambda c, epsilon: c.gamma_skew_marginal_fl(epsilon)))
+
+register_scattering_term(ScatteringTerm("fl",
+    active=lambda c: c.a_epsilon_2!=0 or c.a_T2!=0,
+    energy_func=lambda c, epsilon: c.gamma_fl(epsilon)))
+
+register_scattering_term(ScatteringTerm("skew_planckian",
+    active=lambda c: c.a_asym!=0 or c.p_asym!=0,
+    energy_func=lambda c, epsilon: c.gamma_skew_planckian(epsilon)))
+
+register_scattering_term(ScatteringTerm("poly",
+    active=lambda c: c.a0!=0 or c.a1!=0 or c.a2!=0 or c.a3!=0 or c.a4!=0 or c.a5!=0,
+    code="""
+phi_p = abs(phi % (pi/2) - pi/4)
+gamma_n += abs(a0 + a1 * phi_p + a2 * phi_p**2 + a3 * phi_p**3 + a4 * phi_p**4 + a5 * phi_p**5)
+""",
+    inputs=["phi"], values=["a0", "a1", "a2", "a3", "a4", "a5"]))
+
+register_scattering_term(ScatteringTerm("gamma_k",
+    active=lambda c: c.gamma_k!=0,
+    code="""
+if power == int(power):
+    gamma_n += gamma_k * abs(cos_2phi)**int(power)
+else:
+    gamma_n += gamma_k * abs(cos_2phi)**power
+""",
+    inputs=["cos_2phi"], values=["gamma_k", "power"]))
+
+register_scattering_term(ScatteringTerm("step",
+    active=lambda c: c.gamma_step!=0,
+    code="""
+phi_mod = phi % (pi/2)
+if not ((phi_mod >= pi/4 - phi_step) and (phi_mod <= pi/4 + phi_step)):
+    gamma_n += gamma_step
+""",
+    inputs=["phi"], values=["gamma_step", "phi_step"]))
+
+register_scattering_term(ScatteringTerm("dos",
+    active=lambda c: c.gamma_dos_max!=0,
+    code="gamma_n += gamma_dos_max * dos / dos_max",
+    inputs=["dos"], values=["gamma_dos_max", "dos_max"]))
+
+register_scattering_term(ScatteringTerm("vF",
+    active=lambda c: c.l_path!=0,
+    code="gamma_n += v_norm * vF_units / l_path",
+    inputs=["v"], values=["l_path", "vF_units"]))
+
+register_scattering_term(ScatteringTerm("factor_arcs",
+    active=lambda c: c.factor_arcs!=1,
+    code="""
+if out_af:
+    gamma_n *= factor_arcs
+""",
+    inputs=["af_mask"], values=["factor_arcs"], multiplicative=True))
@@ -0,0 +1,77 @@
+import numpy as np
+##<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<#
+
+## All the functions take batched tensors tensor[..., i, j] (i, j = x, y, z),
+## as Conductivity.sigma, or ADMR.sigma_array[phi, theta, i, j], and work on
+## all the leading dimensions at once.
+
+## Levi-Civita symbol epsilon[i, j, k]
+levi_civita = np.zeros((3, 3, 3), dtype=np.float64)
+levi_civita[0, 1, 2] = levi_civita[1, 2, 0] = levi_civita[2, 0, 1] = 1
+levi_civita[0, 2, 1] = levi_civita[2, 1, 0] = levi_civita[1, 0, 2] = -1
+
+
+## Tensors >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>#
+def resistivity(sigma):
+    """rho[..., i, j] in Ohm.m, full inverse of sigma[..., i, j] in (Ohm.m)^-1.
+    Exact for any field direction, unlike 1 / sigma_zz or the 2x2 formula
+    rho_xx = sigma_xx / (sigma_xx**2 + sigma_xy**2)"""
+    return np.linalg.inv(sigma)
+
+def thermopower(rho, alpha):
+    """S[..., i, j] = rho @ alpha in V / K, the Seebeck coefficients are the
+    diagonal and the Nernst signals the off-diagonal components"""
+    return np.matmul(rho, alpha)
+
+def hall_vector(tensor):
+    """Antisymmetric part of tensor[..., i, j] as a vector h[..., k] with
+    (tensor_ji - tensor_ij) / 2 = epsilon_ijk h_k, so h_z = (rho_yx - rho_xy) / 2"""
+    return 0.5 * np.einsum("ijk,...ji->...k", levi_civita, tensor)
+
+
+## Coefficients >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>#
+def hall_coefficient(rho, B_vector):
+    """R_H in m^3 / C, projection of the Hall vector of rho on the field
+    B_vector[..., 3] in Tesla: R_H = rho_yx / B for B // z"""
+    B_vector = np.asarray(B_vector, dtype=np.float64)
+    return np.sum(hall_vector(rho) * B_vector, axis=-1) / np.sum(B_vector**2, axis=-1)
+
+def nernst_coefficient(S, B_vector):
+    """nu in V / K / T, projection of the Hall vector of the thermopower S on
+    the field B_vector[..., 3] in Tesla: nu = S_yx / B for B // z"""
+    return hall_coefficient(S, B_vector)
+
+def magnetoresistance(rho, rho_0):
+    """(rho_ii - rho_0_ii) / rho_0_ii for i = x, y, z as MR[..., i],
+    with rho_0 the resistivity at zero field, broadcast against rho"""
+    rho_ii = np.diagonal(rho, axis1=-2, axis2=-1)
+    rho_0_ii = np.diagonal(rho_0, axis1=-2, axis2=-1)
+    return (rho_ii - rho_0_ii) / rho_0_ii
+
+
+## All together >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>#
+def transport_observables(sigma, B_vector=None, alpha=None, sigma_0=None):
+    """Returns a dictionary with the observables of sigma[..., i, j]:
+        "rho":  resistivity tensor in Ohm.m
+        "RH":   Hall coefficient in m^3 / C, if B_vector is given
+        "MR":   magnetoresistance MR[..., i] of rho_ii, if sigma_0 (zero field) is given
+        "S":    thermopower tensor in V / K, if alpha is given
+        "nu":   Nernst coefficient in V / K / T, if alpha and B_vector are given
+    sigma and sigma_0 are inverted by a single np.linalg.inv call"""
+    sigma = np.asarray(sigma, dtype=np.float64)
+    if sigma_0 is None:
+        rho = resistivity(sigma)
+    else:
+        sigma_0 = np.broadcast_to(np.asarray(sigma_0, dtype=np.float64), sigma.shape)
+        rho, rho_0 = resistivity(np.stack((sigma, sigma_0)))
+
+    observables = {"rho": rho}
+    if B_vector is not None:
+        observables["RH"] = hall_coefficient(rho, B_vector)
+    if sigma_0 is not None:
+        observables["MR"] = magnetoresistance(rho, rho_0)
+    if alpha is not None:
+        observables["S"] = thermopower(rho, alpha)
+        if B_vector is not None:
+            observables["nu"] = nernst_coefficient(observables["S"], B_vector)
+    return observables
@@ -0,0 +1,67 @@
+import time
+import numpy as np
+
+from cuprates_transport.bandstructure import BandStructure
+from cuprates_transport.conductivity import Conductivity
+##<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<#
+
+## N_time needed by each quadrature of the Chambers time integral for
+## sigma_xx, sigma_xy and sigma_zz within a relative tolerance
+
+tolerance = 1e-3
+N_time_list = [25, 50, 100, 200, 400, 800, 1600]
+N_time_ref = 6400
+time_quadratures = ["rectangle", "trapezoid", "simpson", "exponential"]
+ij_list = [(0, 0), (0, 1), (2, 2)]
+
+## ONE BAND Horio et al. ///////////////////////////////////////////////////////
+params = {
+    "band_name": "LargePocket",
+    "a": 3.74767,
+    "b": 3.74767,
+    "c": 13.2,
+    "energy_scale": 190,
+    "band_params":{"mu":-0.826, "t": 1, "tp":-0.14, "tpp":0.07, "tz":0.07},
+    "fixdoping": 0.24,
+    "res_xy": 20,
+    "res_z": 7,
+    "T" : 0,
+    "Bamp": 45,
+    "Btheta": 30,
+    "Bphi": 15,
+    "gamma_0": 15.1,
+    "gamma_k": 66,
+    "gamma_dos_max": 0,
+    "power": 12,
+    "factor_arcs": 1,
+}
+
+## BandObject ------------------------
+bandObject = BandStructure(**params)
+bandObject.runBandStructure()
+
+## Conductivity Object ---------------
+condObject = Conductivity(bandObject, **params)
+
+def sigma_func(N_time, time_quadrature):
+    condObject.N_time = N_time
+    condObject.time_quadrature = time_quadrature
+    condObject.runTransport()
+    sigma, alpha, beta = condObject.chambersTensorsFunc(ij_list=ij_list)
+    return np.array([sigma[i, j] for (i, j) in ij_list])
+
+sigma_ref = sigma_func(N_time_ref, "simpson")
+
+print("N_time for a relative error < " + str(tolerance) + " on sigma_xx, sigma_xy, sigma_zz")
+for time_quadrature in time_quadratures:
+    N_time_needed = None
+    for N_time in N_time_list:
+        t0 = time.time()
+        error = np.max(np.abs(sigma_func(N_time, time_quadrature) / sigma_ref - 1))
+        duration = time.time() - t0
+        print("  " + time_quadrature + ", N_time = " + str(N_time) +
+              ", error = " + "{:.1e}".format(error) + ", " + "{:.2f}".format(duration) + " s")
+        if error < tolerance:
+            N_time_needed = N_time
+            break
+    print(time_quadrature + ": N_time = " + str(N_time_needed))
@@ -1,9 +1,18 @@
+import os
 import unittest
+import tempfile
 from copy import deepcopy
 import numpy as np
-from cuprates_transport.bandstructure import BandStructure, Pocket, setMuToDoping, doping
+from cuprates_transport.bandstructure import BandStructure, setMuToDoping, doping
 from cuprates_transport.admr import ADMR
+from cuprates_transport.admr_store import ADMRStore
 from cuprates_transport.conductivity import Conductivity
+from cuprates_transport.convergence import ConvergenceTuner
+from cuprates_transport.data_cache import load_data, clear_data_cache
+from cuprates_transport.evaluation_cache import EvaluationCache
+from cuprates_transport.fitting_admr import FittingADMR
+from cuprates_transport.fitting_admr_multi_T import FittingADMR as FittingADMRMultiT
+from cuprates_transport.transport_observables import transport_observables
 ##<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<#
 
 class TestTransport(unittest.TestCase):
@@ -37,6 +46,34 @@ class TestTransport(unittest.TestCase):
         bandObject.doping()
         self.assertEqual(np.round(bandObject.p,3), 0.239)
 
+    def test_band_snapshot(self):
+        """The snapshot of a band keeps its Fermi surface when the band changes,
+        and its arrays are read-only"""
+
+        params = deepcopy(TestTransport.params)
+        params.update({"res_xy": 10, "res_z": 3})
+        bandObject = BandStructure(**params)
+        bandObject.runBandStructure()
+        snapshot = bandObject.snapshot()
+        fermi_surface = {name: np.array(getattr(snapshot, name)) for name in ["kf", "vf", "dos_k"]}
+
+        bandObject["mu"] = -0.9
+        bandObject.runBandStructure()
+        self.assertFalse(np.array_equal(bandObject.kf, fermi_surface["kf"]))
+        bandObject.runBandStructure(epsilon=5, printDoping=False)
+        for name, value in fermi_surface.items():
+            self.assertTrue(np.array_equal(getattr(snapshot, name), value))
+        self.assertEqual(snapshot["mu"], params["band_params"]["mu"])
+
+        for name in ["kf", "vf", "dos_k"]:
+            with self.assertRaises(ValueError):
+                getattr(snapshot, name)[0] = 0
+
+        ## runBandStructure of the snapshot does not change the band
+        kf = np.array(bandObject.kf)
+        snapshot.runBandStructure(epsilon=-5, printDoping=False)
+        self.assertTrue(np.array_equal(bandObject.kf, kf))
+
     def test_conductivity_T_0_B_0(self):
         """T = 0 & B = 0"""
 
@@ -44,7 +81,7 @@ class TestTransport(unittest.TestCase):
 
         ## Discretize
         bandObject.doping()
-        bandObject.discretize_FS()
+        bandObject.discretize_fermi_surface()
         bandObject.dos_k_func()
 
         ## Conductivity
@@ -63,7 +100,7 @@ class TestTransport(unittest.TestCase):
 
         ## Discretize
         bandObject.doping()
-        bandObject.discretize_FS()
+        bandObject.discretize_fermi_surface()
         bandObject.dos_k_func()
 
         ## Conductivity
@@ -84,7 +121,7 @@ class TestTransport(unittest.TestCase):
 
         ## Discretize
         bandObject.doping()
-        bandObject.discretize_FS()
+        bandObject.discretize_fermi_surface()
         bandObject.dos_k_func()
 
         ## Conductivity
@@ -94,5 +131,801 @@ class TestTransport(unittest.TestCase):
 
         self.assertEqual(np.round(condObject.sigma[2,2],3), 17946.592)
 
+    def test_chambers_tensors(self):
+        """chambersTensorsFunc against chambersFunc for each component, at T = 0 and T > 0"""
+
+        for T in [0, 25]:
+            params = deepcopy(TestTransport.params)
+            params.update({"res_xy": 10, "res_z": 3, "Btheta": 30, "T": T, "N_epsilon": 6})
+            bandObject = BandStructure(**params)
+            bandObject.runBandStructure()
+            condObject = Conductivity(bandObject, **params)
+            condObject.runTransport()
+
+            tensors = condObject.chambersTensorsFunc()
+            for coeff_name, tensor in zip(["sigma", "alpha", "beta"], tensors):
+                for i in range(3):
+                    for j in range(3):
+                        if T == 0 and coeff_name != "sigma":
+                            self.assertEqual(tensor[i, j], 0)
+                            continue
+                        coeff = condObject.chambersFunc(i, j, coeff_name)
+                        self.assertAlmostEqual(tensor[i, j] / coeff, 1, places=10)
+
+            ## Only the components of ij_list
+            sigma, alpha, beta = condObject.chambersTensorsFunc(ij_list=[(0, 1)])
+            self.assertEqual(sigma[0, 1], tensors[0][0, 1])
+            self.assertEqual(sigma[0, 0], 0)
+
+    def test_chambers_jacobian(self):
+        """Analytic derivatives of sigma_zz against finite differences"""
+
+        params = deepcopy(TestTransport.params)
+        params["res_xy"] = 10
+        params["res_z"] = 3
+        params["Btheta"] = 30
+
+        bandObject = BandStructure(**params)
+        bandObject.runBandStructure()
+        condObject = Conductivity(bandObject, **params)
+        condObject.runTransport()
+        param_names = ["gamma_0", "gamma_k", "power"]
+        sigma_zz, dsigma_zz = condObject.chambersJacobianFunc(2, 2, param_names)
+
+        for n, param_name in enumerate(param_names):
+            value = getattr(condObject, param_name)
+            h = 1e-5 * value
+            setattr(condObject, param_name, value + h)
+            condObject.runTransport()
+            sigma_plus = condObject.chambersFunc(2, 2)
+            setattr(condObject, param_name, value - h)
+            condObject.runTransport()
+            sigma_minus = condObject.chambersFunc(2, 2)
+            setattr(condObject, param_name, value)
+            self.assertAlmostEqual(dsigma_zz[n] / ((sigma_plus - sigma_minus) / (2*h)), 1, places=5)
+
+        ## the fit falls back to finite differences when the orbits are dispatched
+        ranges_dict = {"gamma_0": [10, 20], "gamma_k": [50, 80]}
+        self.assertEqual(FittingADMR(params, ranges_dict, {}).jacobian_params(), list(ranges_dict.keys()))
+        for options in [{"orbit_dispatch": True}, {"chambers_engine": "orbit"}]:
+            fitObject = FittingADMR(dict(params, **options), ranges_dict, {})
+            self.assertIsNone(fitObject.jacobian_params())
+
+    def test_fused_scattering(self):
+        """Compiled kernel of the scattering registry against tau_total_func"""
+
+        params = deepcopy(TestTransport.params)
+        params.update({"res_xy": 10, "res_z": 3, "Btheta": 30, "a0": 2, "a2": -5,
+                       "gamma_step": 4, "phi_step": 10, "gamma_dos_max": 3,
+                       "l_path": 500, "factor_arcs": 1.4})
+
+        bandObject = BandStructure(**params)
+        bandObject.runBandStructure()
+        condObject = Conductivity(bandObject, **params)
+        condObject.solveMovementFunc()
+        gamma_fused = condObject.gamma_total_func(*condObject.kft, *condObject.vft)
+        condObject.fused_scattering = False
+        gamma_numpy = condObject.gamma_total_func(*condObject.kft, *condObject.vft)
+
+        self.assertTrue(np.allclose(gamma_fused, gamma_numpy, rtol=1e-12, atol=0))
+
+        ## Batch kernel of the sets, with other active terms in some sets
+        param_names = ["gamma_k", "l_path", "phi_step", "a_T"]
+        param_values = [[66, 500, 10, 0], [0, 0, 20, 0.5], [30, 0, 10, 0], [66, 300, 5, 1]]
+        condObject.fused_scattering = True
+        gamma_batch = condObject.gamma_batch_func(param_names, param_values, *condObject.kft, *condObject.vft)
+        condObject.fused_scattering = False
+        gamma_batch_numpy = condObject.gamma_batch_func(param_names, param_values, *condObject.kft, *condObject.vft)
+        self.assertEqual(gamma_batch.shape, (4,) + condObject.kft[0].shape)
+        self.assertTrue(np.allclose(gamma_batch, gamma_batch_numpy, rtol=1e-12, atol=0))
+
+    def test_epsilon_quadrature(self):
+        """Gauss quadrature of the Fermi window with 5 energies against the uniform rule"""
+
+        params = deepcopy(TestTransport.params)
+        params.update({"res_xy": 10, "res_z": 3, "Btheta": 30, "T": 25})
+        bandObject = BandStructure(**params)
+        bandObject.runBandStructure()
+
+        tensors = {}
+        for name, epsilon_quadrature, N_epsilon, dfdE_cut_percent in [("reference", "uniform", 40, 1e-9),
+                                                                       ("uniform", "uniform", 20, 0.001),
+                                                                       ("gauss", "gauss_fermi", 5, 0.001)]:
+            condObject = Conductivity(bandObject, **params, epsilon_quadrature=epsilon_quadrature,
+                                      N_epsilon=N_epsilon, dfdE_cut_percent=dfdE_cut_percent)
+            condObject.runTransport()
+            tensors[name] = condObject.chambersTensorsFunc(ij_list=[(0, 0), (2, 2)])
+
+        sigma, alpha, beta = tensors["gauss"]
+        sigma_ref, alpha_ref, beta_ref = tensors["reference"]
+        self.assertAlmostEqual(sigma[2, 2] / sigma_ref[2, 2], 1, delta=1e-2)
+        self.assertAlmostEqual(alpha[0, 0] / alpha_ref[0, 0], 1, delta=1e-2)
+        self.assertLess(abs(beta[0, 0] / beta_ref[0, 0] - 1),
+                        abs(tensors["uniform"][2][0, 0] / beta_ref[0, 0] - 1))
+
+    def test_sigma_epsilon_table(self):
+        """Temperatures of a sigma(epsilon) table against runTransport, at B = 0
+        as the table only changes the integral over the energies"""
+
+        params = deepcopy(TestTransport.params)
+        params.update({"res_xy": 10, "res_z": 3, "Bamp": 0})
+        bandObject = BandStructure(**params)
+        bandObject.runBandStructure()
+        ij_list = [(0, 0), (2, 2)]
+
+        condObject = Conductivity(bandObject, **params)
+        condObject.sigmaEpsilonTableFunc(T_max=50, ij_list=ij_list)
+        for T in [25, 50]:
+            condObject_T = Conductivity(bandObject, **dict(params, T=T), N_epsilon=80, dfdE_cut_percent=1e-6)
+            condObject_T.runTransport()
+            sigma_ref, alpha_ref, beta_ref = condObject_T.chambersTensorsFunc(ij_list=ij_list)
+            sigma, alpha, beta = condObject.chambersTableFunc(T)
+            for i, j in ij_list:
+                self.assertAlmostEqual(sigma[i, j] / sigma_ref[i, j], 1, delta=2e-3)
+                self.assertAlmostEqual(beta[i, j] / beta_ref[i, j], 1, delta=2e-3)
+                ## noise of the discretization of the energy shells
+                self.assertAlmostEqual(alpha[i, j] / alpha_ref[i, j], 1, delta=1e-2)
+
+        ## With memory_budget the table is computed by blocks of the Fermi surface
+        params.update({"Bamp": 45, "Btheta": 30})
+        tables = []
+        for memory_budget in [None, 2e6]:
+            condObject = Conductivity(bandObject, **params, memory_budget=memory_budget)
+            tables.append(condObject.sigmaEpsilonTableFunc(T_max=25, N_epsilon=5))
+        self.assertLess(condObject.chunk_size_func(), bandObject.kf.shape[1])
+        self.assertLess(condObject.kft.shape[1], bandObject.kf.shape[1])
+        ## odeint adapts its steps to each block, as in test_memory_budget
+        self.assertTrue(np.allclose(tables[1], tables[0], rtol=1e-4, atol=1e-4 * np.max(np.abs(tables[0]))))
+
+    def test_time_quadrature(self):
+        """Simpson and exponential time integrals with N_time = 60 against the default rectangle rule"""
+
+        params = deepcopy(TestTransport.params)
+        params.update({"res_xy": 10, "res_z": 3, "Btheta": 30})
+        bandObject = BandStructure(**params)
+        bandObject.runBandStructure()
+
+        sigma_zz = {}
+        for time_quadrature, N_time in [("simpson", 2000), ("rectangle", 500),
+                                        ("simpson", 60), ("exponential", 60)]:
+            condObject = Conductivity(bandObject, **params, N_time=N_time, time_quadrature=time_quadrature)
+            condObject.runTransport()
+            sigma_zz[time_quadrature, N_time] = condObject.chambersFunc(2, 2)
+
+        sigma_ref = sigma_zz["simpson", 2000]
+        error_rectangle = abs(sigma_zz["rectangle", 500] / sigma_ref - 1)
+        self.assertLess(abs(sigma_zz["simpson", 60] / sigma_ref - 1), error_rectangle)
+        self.assertLess(abs(sigma_zz["exponential", 60] / sigma_ref - 1), error_rectangle)
+
+    def test_convergence_tuner(self):
+        """Config recommended for rzz within 5e-3 against a finely resolved one"""
+
+        bandObject = BandStructure(**TestTransport.params)
+        bandObject.runBandStructure()
+        tuner = ConvergenceTuner(bandObject, TestTransport.params, tol=5e-3, quantity="rzz",
+                                 angles=[(0, 0), (0, 60), (45, 60)])
+        config, report = tuner.runTuner()
+        self.assertLess(report["error"], 5e-3)
+
+        rzz, time = tuner.evaluate(config)
+        rzz_fine, time_fine = tuner.evaluate({"res_xy": 40, "res_z": 11, "N_time": 1600,
+                                              "rtol": 1e-5, "atol": 1e-5})
+        self.assertLess(tuner.change(rzz, rzz_fine), 5e-3)
+
+    def test_memory_budget(self):
+        """Fermi surface run by blocks of points against all the points at once"""
+
+        params = deepcopy(TestTransport.params)
+        params.update({"res_xy": 10, "res_z": 3, "Btheta": 30})
+        bandObject = BandStructure(**params)
+        bandObject.runBandStructure()
+
+        condObject = Conductivity(bandObject, **params)
+        condObject.runTransport()
+        sigma, alpha, beta = condObject.chambersTensorsFunc()
+        condObject_chunked = Conductivity(bandObject, **params, memory_budget=1e6)
+        condObject_chunked.runTransport()
+        sigma_chunked, alpha_chunked, beta_chunked = condObject_chunked.chambersTensorsFunc()
+
+        self.assertLess(condObject_chunked.chunk_size_func(), bandObject.kf.shape[1])
+        self.assertTrue(np.allclose(sigma_chunked, sigma, rtol=1e-4, atol=1e-4 * np.max(np.abs(sigma))))
+        self.assertEqual(condObject_chunked.chambersFunc(2, 2), sigma_chunked[2, 2])
+
+    def test_memory_budget_jacobian_batch(self):
+        """Jacobian and batch of scattering sets computed by blocks of points"""
+
+        params = deepcopy(TestTransport.params)
+        params.update({"res_xy": 10, "res_z": 3, "Btheta": 30, "Btheta_step": 45, "Bphi_array": [0]})
+        bandObject = BandStructure(**params)
+        bandObject.runBandStructure()
+
+        condObject = Conductivity(bandObject, **params)
+        condObject.runTransport()
+        condObject_chunked = Conductivity(bandObject, **params, memory_budget=1e6)
+        condObject_chunked.runTransport()
+        self.assertLess(condObject_chunked.chunk_size_func(), bandObject.kf.shape[1])
+
+        _, dsigma = condObject.chambersJacobianFunc(2, 2, ["gamma_0", "gamma_k"])
+        _, dsigma_chunked = condObject_chunked.chambersJacobianFunc(2, 2, ["gamma_0", "gamma_k"])
+        self.assertTrue(np.allclose(dsigma_chunked, dsigma, rtol=1e-4))
+
+        param_values = [[15.1, 66], [16, 60]]
+        sigma_batch = condObject.chambersBatchFunc(2, 2, ["gamma_0", "gamma_k"], param_values)
+        sigma_batch_chunked = condObject_chunked.chambersBatchFunc(2, 2, ["gamma_0", "gamma_k"], param_values)
+        self.assertTrue(np.allclose(sigma_batch_chunked, sigma_batch, rtol=1e-4))
+
+        admrObject = ADMR([condObject_chunked], **params)
+        admrObject.runADMR(jacobian_params=["gamma_0"])
+        self.assertEqual(len(admrObject.kftDict), 0)
+
+    def test_batch_scattering_sets(self):
+        """Batch of scattering sets against serial chambersFunc and runADMR, with
+        a set whose scattering rates are below the ones of the time grid"""
+
+        params = deepcopy(TestTransport.params)
+        params.update({"res_xy": 10, "res_z": 3, "Btheta": 30, "Btheta_step": 45, "Bphi_array": [0]})
+        bandObject = BandStructure(**params)
+        bandObject.runBandStructure()
+        param_names = ["gamma_0", "gamma_k"]
+        param_values = [[15.1, 66], [16, 60], [8, 30]]
+
+        condObject = Conductivity(bandObject, **params)
+        time_max = condObject.time_max
+        self.assertTrue(condObject.extend_time_grid(param_names, param_values))
+        self.assertGreater(condObject.time_max, time_max)
+        condObject.runTransport()
+        sigma_batch = condObject.chambersBatchFunc(2, 2, param_names, param_values)
+        for n, values in enumerate(param_values):
+            for param_name, value in zip(param_names, values):
+                setattr(condObject, param_name, value)
+            condObject.runTransport()
+            self.assertAlmostEqual(sigma_batch[n] / condObject.chambersFunc(2, 2), 1, places=10)
+
+        admrObject = ADMR([Conductivity(bandObject, **params)], **params)
+        sigmazz_batch = admrObject.runADMRBatch(param_names, param_values)
+        self.assertEqual(list(admrObject.initialCondObjectDict.values())[0].time_max, time_max)
+        for n, values in enumerate(param_values):
+            condObject_n = Conductivity(bandObject, **dict(params, **dict(zip(param_names, values))))
+            condObject_n.time_max, condObject_n.N_time = condObject.time_max, condObject.N_time
+            admrObject_n = ADMR([condObject_n], **params)
+            admrObject_n.runADMR()
+            np.testing.assert_allclose(sigmazz_batch[n], admrObject_n.sigma_array[:, :, 2, 2], rtol=1e-10)
+
+    def test_float32_trajectories(self):
+        """Trajectories stored in float32 against float64, at T = 0 and T > 0"""
+
+        for T in [0, 25]:
+            params = deepcopy(TestTransport.params)
+            params.update({"res_xy": 10, "res_z": 3, "Btheta": 30, "T": T})
+            bandObject = BandStructure(**params)
+            bandObject.runBandStructure()
+
+            tensors = {}
+            for trajectories_dtype in [np.float64, np.float32]:
+                condObject = Conductivity(bandObject, **params, trajectories_dtype=trajectories_dtype)
+                condObject.runTransport()
+                tensors[trajectories_dtype] = condObject.chambersTensorsFunc()
+            self.assertEqual(condObject.kft.dtype, np.float32)
+            self.assertEqual(condObject.vft.dtype, np.float32)
+            for coeff_64, coeff_32 in zip(tensors[np.float64], tensors[np.float32]):
+                self.assertTrue(np.allclose(coeff_32, coeff_64, rtol=0, atol=1e-5 * np.max(np.abs(coeff_64))))
+
+        ## The blocks of memory_budget are larger in float32
+        chunk_size = {}
+        for trajectories_dtype in [np.float64, np.float32]:
+            condObject = Conductivity(bandObject, **params, memory_budget=1e8,
+                                      trajectories_dtype=trajectories_dtype)
+            chunk_size[trajectories_dtype] = condObject.chunk_size_func()
+        self.assertAlmostEqual(chunk_size[np.float32] / chunk_size[np.float64], 1.5, delta=0.05)
+
+    def test_orbit_dispatch(self):
+        """Closed orbits summed over their period against a fine time grid"""
+
+        params = deepcopy(TestTransport.params)
+        params.update({"res_xy": 10, "res_z": 3, "gamma_0": 0.5, "gamma_k": 0, "Btheta": 30})
+        bandObject = BandStructure(**params)
+        bandObject.runBandStructure()
+
+        condObject = Conductivity(bandObject, **dict(params, N_time=8000))
+        condObject.runTransport()
+        sigma_ref = condObject.chambersTensorsFunc()[0]
+        errors = []
+        for orbit_dispatch in [False, True]:
+            condObject = Conductivity(bandObject, **dict(params, N_time=200), orbit_dispatch=orbit_dispatch)
+            condObject.runTransport()
+            errors.append(np.max(np.abs(condObject.chambersTensorsFunc()[0] - sigma_ref)))
+        labels = condObject.orbits["labels"]
+        self.assertTrue(np.any(labels == "closed") and np.any(labels == "open"))
+        self.assertTrue(np.all(np.isnan(condObject.orbits["period"][labels == "long"])))
+        self.assertTrue(errors[1] < errors[0] / 2)
+
+    def test_orbit_sharing(self):
+        """One trajectory per orbit at B // z against one per point"""
+
+        params = deepcopy(TestTransport.params)
+        params.update({"res_xy": 10, "res_z": 3, "gamma_0": 0.5, "gamma_k": 0, "Btheta": 0})
+        bandObject = BandStructure(**params)
+        bandObject.runBandStructure()
+
+        ## the trajectories of the representatives are more precise, hence the reference with low tolerances
+        sigma = {}
+        for orbit_sharing, tol in [(False, 1e-8), (True, 1e-4)]:
+            condObject = Conductivity(bandObject, **params, orbit_sharing=orbit_sharing, rtol=tol, atol=tol)
+            condObject.runTransport()
+            sigma[orbit_sharing] = condObject.chambersTensorsFunc()[0]
+        self.assertTrue(len(np.unique(condObject.orbit_representatives)) < bandObject.kf.shape[1] / 4)
+        self.assertTrue(np.allclose(sigma[True], sigma[False], rtol=0, atol=1e-3 * np.max(np.abs(sigma[False]))))
+
+    def test_chambers_engine(self):
+        """Closed orbits summed once per representative against once per point"""
+
+        params = deepcopy(TestTransport.params)
+        params.update({"res_xy": 10, "res_z": 3, "gamma_0": 0.5, "gamma_k": 0, "Btheta": 0})
+        bandObject = BandStructure(**params)
+        bandObject.runBandStructure()
+
+        sigma = {}
+        for chambers_engine in ["direct", "orbit"]:
+            condObject = Conductivity(bandObject, **params, orbit_dispatch=True, orbit_sharing=True,
+                                      chambers_engine=chambers_engine)
+            condObject.runTransport()
+            sigma[chambers_engine] = condObject.chambersTensorsFunc()[0]
+        self.assertTrue(np.all(condObject.orbits["labels"] == "closed"))
+        self.assertTrue(np.allclose(sigma["orbit"], sigma["direct"], rtol=0, atol=1e-4 * np.max(np.abs(sigma["direct"]))))
+
+    def test_transport_observables(self):
+        """Hall coefficient of the full inverse, rho_zz exact for tilted fields"""
+
+        params = deepcopy(TestTransport.params)
+        params.update({"res_xy": 10, "res_z": 3, "Btheta_step": 30, "Bphi_array": [0]})
+        bandObject = BandStructure(**params)
+        bandObject.runBandStructure()
+
+        condObject = Conductivity(bandObject, **params)
+        condObject.runTransport()
+        sigma = condObject.chambersTensorsFunc()[0]
+        observables = transport_observables(sigma, condObject.B_vector)
+        sigma_xx, sigma_xy = sigma[0, 0], sigma[0, 1]
+        RH = sigma_xy / (sigma_xx**2 + sigma_xy**2) / condObject.Bamp
+        self.assertTrue(np.isclose(observables["RH"], RH, rtol=1e-6))
+
+        admrObject = ADMR([condObject], **params, full_tensor=True)
+        admrObject.runADMR()
+        rho_array = np.linalg.inv(admrObject.sigma_array)
+        self.assertTrue(np.allclose(admrObject.rhozz_array, rho_array[..., 2, 2]))
+        self.assertFalse(np.allclose(admrObject.rhozz_array[:, 1:], 1 / admrObject.sigma_array[:, 1:, 2, 2], rtol=1e-6))
+
+    def test_admr_observables(self):
+        """In-plane components of sigma from the trajectories of runADMR, exported by fileADMR"""
+
+        params = deepcopy(TestTransport.params)
+        params.update({"res_xy": 10, "res_z": 3, "Btheta_step": 30, "Bphi_array": [0, 45]})
+        bandObject = BandStructure(**params)
+        bandObject.runBandStructure()
+        condObject = Conductivity(bandObject, **params)
+
+        admrObject = ADMR([condObject], **params, observables=["sigma"], observables_ij=[(0, 0), (0, 1)])
+        admrObject.runADMR()
+        self.assertEqual(admrObject.sigma_array.shape, (2, 4, 3, 3))
+        self.assertTrue(np.all(np.isnan(admrObject.sigma_array[..., 1, 1])))
+        self.assertTrue(np.allclose(admrObject.rhozz_array, 1 / admrObject.sigma_array[..., 2, 2]))
+
+        condObject.Bphi, condObject.Btheta = 45, 60
+        condObject.runTransport()
+        self.assertTrue(np.isclose(admrObject.sigma_array[1, 2, 0, 1], condObject.chambersFunc(0, 1)))
+
+        with tempfile.TemporaryDirectory() as folder:
+            admrObject.fileADMR(folder=folder, filename="admr.dat")
+            with open(folder + "/admr.dat") as f:
+                header = f.readline()
+            data = np.loadtxt(folder + "/admr.dat")
+        self.assertIn("sigma_xy(phi=45)", header)
+        self.assertTrue(np.allclose(data[:, -1], admrObject.sigma_array[1, :, 2, 2]))
+
+    def test_multi_observable_fit(self):
+        """ADMR and rho(B) fitted from the sigma of the union of the fields"""
+
+        member = deepcopy(TestTransport.params)
+        member.update({"res_xy": 10, "res_z": 3, "fixdoping": 2, "Btheta_max": 60, "Btheta_step": 30,
+                       "Bphi_array": [0, 45], "data_T": 25, "data_p": 0.24})
+        bandObject = BandStructure(**member)
+        bandObject.runBandStructure()
+        condObject = Conductivity(bandObject, **member)
+        admrObject = ADMR([condObject], **member, full_tensor=True)
+        admrObject.runADMR()
+
+        with tempfile.TemporaryDirectory() as folder:
+            data_dict = {}
+            for l, phi in enumerate(admrObject.Bphi_array):
+                filename = folder + "/admr_phi" + str(phi) + ".dat"
+                np.savetxt(filename, np.vstack((admrObject.Btheta_array, admrObject.rzz_array[l])).T)
+                data_dict[25, phi] = [filename, 0, 1, 90, admrObject.rhozz_array[l, 0]]
+            B_array = np.array([0, 15, 30, 45])
+            rho_list = []
+            for Bamp in B_array:
+                condObject.Bamp, condObject.Btheta = Bamp, 0
+                condObject.runTransport()
+                rho = np.linalg.inv(condObject.chambersTensorsFunc()[0])
+                rho_list.append([Bamp, rho[0, 0] * 1e8, rho[1, 0] * 1e8])
+            np.savetxt(folder + "/rho_B.dat", np.array(rho_list))
+            transport_data = [{"observable": "rhoxx", "sweep": "Bamp", "x_array": B_array,
+                               "filename": folder + "/rho_B.dat", "col_x": 0, "col_y": 1, "factor": 1e-8},
+                              {"observable": "rhoyx", "sweep": "Bamp", "x_array": B_array[1:],
+                               "filename": folder + "/rho_B.dat", "col_x": 0, "col_y": 2, "factor": 1e-8}]
+
+            fitObject = FittingADMR(member, {"gamma_0": [10, 20]}, data_dict, transport_data=transport_data)
+            diff = fitObject.compute_diff(fitObject.pars)
+        ## 6 angles (theta = 0 once) + 3 fields below 45 T
+        self.assertEqual(len(fitObject.conditions), 8)
+        self.assertEqual(diff.size, 6 + 4 + 3)
+        self.assertTrue(np.max(np.abs(diff)) < 1e-10)
+
+    def test_map_population_workers(self):
+        """Generation evaluated by a pool of 2 workers against serial compute_diff"""
+
+        member = deepcopy(TestTransport.params)
+        member.update({"res_xy": 10, "res_z": 3, "fixdoping": 2, "Btheta_max": 60, "Btheta_step": 30,
+                       "Bphi_array": [0, 45], "data_T": 25, "data_p": 0.24})
+        bandObject = BandStructure(**member)
+        bandObject.runBandStructure()
+        admrObject = ADMR([Conductivity(bandObject, **member)], **member)
+        admrObject.runADMR()
+
+        with tempfile.TemporaryDirectory() as folder:
+            data_dict = {}
+            for l, phi in enumerate(admrObject.Bphi_array):
+                filename = folder + "/admr_phi" + str(phi) + ".dat"
+                np.savetxt(filename, np.vstack((admrObject.Btheta_array, admrObject.rzz_array[l])).T)
+                data_dict[25, phi] = [filename, 0, 1, 90, admrObject.rhozz_array[l, 0]]
+            ranges_dict = {"gamma_0": [10, 20]}
+            gamma_0_list = [12, 15.1, 18]
+
+            ## Serial, the member of the fit is not modified by the calls
+            fitObject = FittingADMR(member, ranges_dict, data_dict)
+            chi2_list = []
+            for gamma_0 in gamma_0_list:
+                fitObject.pars["gamma_0"].value = gamma_0
+                chi2_list.append(np.sum(fitObject.compute_diff(fitObject.pars)**2))
+            self.assertEqual(fitObject.member["gamma_0"], member["gamma_0"])
+            self.assertIsNone(fitObject.admrObject)
+            self.assertEqual(fitObject.popsize_func(), 100)
+
+            ## Pool of workers, as in fit_stage
+            fitObject = FittingADMR(member, ranges_dict, data_dict, workers=2)
+            fitObject.start_pool()
+            population = []
+            for gamma_0 in gamma_0_list:
+                fitObject.pars_bounds["gamma_0"].value = gamma_0
+                population.append([fitObject.pars_bounds["gamma_0"].setup_bounds()])
+            try:
+                chi2_pool_list = fitObject.map_population(None, np.array(population))
+            finally:
+                fitObject.close_pool()
+        self.assertEqual(fitObject.nb_calls, 3)
+        np.testing.assert_allclose(chi2_pool_list, chi2_list, rtol=1e-10)
+
+    def test_fit_checkpoint_resume(self):
+        """Checkpoint resumed only for the same member and data"""
+
+        member = deepcopy(TestTransport.params)
+        member.update({"res_xy": 10, "res_z": 3, "fixdoping": 2, "Btheta_max": 60, "Btheta_step": 30,
+                       "Bphi_array": [0], "data_T": 25, "data_p": 0.24})
+        bandObject = BandStructure(**member)
+        bandObject.runBandStructure()
+        admrObject = ADMR([Conductivity(bandObject, **member)], **member)
+        admrObject.runADMR()
+
+        with tempfile.TemporaryDirectory() as folder:
+            filename = folder + "/admr_phi0.dat"
+            np.savetxt(filename, np.vstack((admrObject.Btheta_array, admrObject.rzz_array[0])).T)
+            data_dict = {(25, 0): [filename, 0, 1, 90, admrObject.rhozz_array[0, 0]]}
+            ranges_dict = {"gamma_0": [10, 20]}
+            checkpoint = folder + "/fit.npz"
+
+            fitObject = FittingADMR(member, ranges_dict, data_dict, checkpoint=checkpoint, checkpoint_every=1)
+            for gamma_0 in [12, 18]:
+                fitObject.pars["gamma_0"].value = gamma_0
+                fitObject.compute_diff(fitObject.pars)
+            self.assertEqual(fitObject.nb_calls, 2)
+            self.assertEqual(len(np.load(checkpoint)["history_pars"]), 2)
+
+            ## Same run, the calls are not computed again
+            fitObject = FittingADMR(member, ranges_dict, data_dict, checkpoint=checkpoint)
+            fitObject.load_checkpoint()
+            self.assertEqual(len(fitObject.history_pars), 2)
+            fitObject.pars["gamma_0"].value = 18
+            fitObject.compute_diff(fitObject.pars)
+            self.assertEqual(fitObject.nb_calls, 0)
+
+            ## Other member or other data, the checkpoint is refused
+            fitObject = FittingADMR(dict(member, gamma_k=50), ranges_dict, data_dict, checkpoint=checkpoint)
+            fitObject.load_checkpoint()
+            self.assertEqual(len(fitObject.history_pars), 0)
+            np.savetxt(filename, np.vstack((admrObject.Btheta_array, admrObject.rzz_array[0]**1.1)).T)
+            fitObject = FittingADMR(member, ranges_dict, data_dict, checkpoint=checkpoint)
+            fitObject.load_checkpoint()
+            self.assertEqual(len(fitObject.history_pars), 0)
+
+            ## The hits of the evaluation cache are not new calls, no checkpoint is written
+            evaluation_cache = folder + "/cache.sqlite"
+            FittingADMR(member, ranges_dict, data_dict, evaluation_cache=evaluation_cache).compute_diff(fitObject.pars)
+            fitObject = FittingADMR(member, ranges_dict, data_dict, evaluation_cache=evaluation_cache,
+                                    checkpoint=folder + "/fit_cache.npz", checkpoint_every=1)
+            fitObject.compute_diff(fitObject.pars)
+            self.assertEqual(fitObject.evaluation_cache.nb_hits, 1)
+            self.assertFalse(os.path.isfile(folder + "/fit_cache.npz"))
+
+    def test_fidelity_stage_list(self):
+        """The last fidelity stage runs at the full resolution, also for the keys
+        of the schedule that init_member does not set"""
+
+        member = deepcopy(TestTransport.params)
+        member.update({"res_z": 3, "fixdoping": 2, "Btheta_max": 60, "Btheta_step": 30,
+                       "Bphi_array": [0], "data_T": 25, "data_p": 0.24})
+        del member["res_xy"] # default of BandStructure
+        bandObject = BandStructure(**member)
+        bandObject.runBandStructure()
+        admrObject = ADMR([Conductivity(bandObject, **member)], **member)
+        admrObject.runADMR()
+
+        with tempfile.TemporaryDirectory() as folder:
+            filename = folder + "/admr_phi0.dat"
+            np.savetxt(filename, np.vstack((admrObject.Btheta_array, admrObject.rzz_array[0])).T)
+            data_dict = {(25, 0): [filename, 0, 1, 90, admrObject.rhozz_array[0, 0]]}
+            fitObject = FittingADMR(member, {"gamma_0": [10, 20]}, data_dict,
+                                    fidelity_schedule=[{"res_xy": 8}, {"res_xy": 12, "N_time": 200}])
+            stage_list = fitObject.fidelity_stage_list()
+            self.assertEqual(stage_list, [{"res_xy": 8, "N_time": 500},
+                                          {"res_xy": 12, "N_time": 200},
+                                          {"res_xy": 20, "N_time": 500}])
+            for stage in stage_list:
+                fitObject.member.update(stage)
+                fitObject.reset_history()
+                diff = fitObject.compute_diff(fitObject.pars)
+        self.assertEqual(fitObject.bandObject.res_xy, bandObject.res_xy)
+        self.assertEqual(fitObject.bandObject.kf.shape, bandObject.kf.shape)
+        self.assertTrue(np.max(np.abs(diff)) < 1e-10)
+
+    def test_fit_fidelity_schedule(self):
+        """The best candidates of the coarse stage seed the fit at full resolution"""
+
+        member = deepcopy(TestTransport.params)
+        member.update({"res_xy": 10, "res_z": 3, "fixdoping": 2, "Btheta_max": 60, "Btheta_step": 30,
+                       "Bphi_array": [0], "data_T": 25, "data_p": 0.24})
+        bandObject = BandStructure(**member)
+        bandObject.runBandStructure()
+        admrObject = ADMR([Conductivity(bandObject, **member)], **member)
+        admrObject.runADMR()
+
+        with tempfile.TemporaryDirectory() as folder:
+            filename = folder + "/admr_phi0.dat"
+            np.savetxt(filename, np.vstack((admrObject.Btheta_array, admrObject.rzz_array[0])).T)
+            data_dict = {(25, 0): [filename, 0, 1, 90, admrObject.rhozz_array[0, 0]]}
+            fitObject = FittingADMR(dict(member, gamma_0=12), {"gamma_0": [10, 20]}, data_dict,
+                                    method="least_square", checkpoint=folder + "/fit.npz",
+                                    fidelity_schedule=[{"res_xy": 8}], fidelity_promote=2)
+            fitObject.runFit()
+            checkpoint_0 = np.load(folder + "/fit.npz.stage0")
+            history_pars_0 = [tuple(pars_values) for pars_values in checkpoint_0["history_pars"]]
+            chi2_list_0 = [np.sum(diff**2) for diff in checkpoint_0["history_diff"]]
+
+        ## The 2 best of the coarse stage are evaluated first, the best starts the last fit
+        index_best = np.argsort(chi2_list_0)[:2]
+        self.assertEqual(fitObject.history_pars[:2], [history_pars_0[index] for index in index_best])
+        self.assertGreater(len(fitObject.history_pars), 2)
+        self.assertEqual(len(fitObject.fidelity_noise_list), 1)
+        self.assertEqual(fitObject.bandObject.res_xy, 10)
+        self.assertAlmostEqual(fitObject.member["gamma_0"], 15.1, delta=1e-2)
+
+    def test_data_cache(self):
+        """Data files parsed once per version, a new mtime invalidates the cache"""
+
+        with tempfile.TemporaryDirectory() as folder:
+            filename = folder + "/data.dat"
+            np.savetxt(filename, np.ones((3, 2)))
+            data = load_data(filename, cache_folder=folder + "/cache")
+            self.assertIs(load_data(filename, cache_folder=folder + "/cache"), data)
+            with self.assertRaises(ValueError):
+                data[0, 0] = 0
+
+            ## New content with a new mtime, also read again from the .npy copies
+            np.savetxt(filename, 2 * np.ones((3, 2)))
+            mtime = os.stat(filename).st_mtime_ns
+            os.utime(filename, ns=(mtime + 10**9, mtime + 10**9))
+            data_new = load_data(filename, cache_folder=folder + "/cache")
+            self.assertTrue(np.array_equal(data_new, 2 * np.ones((3, 2))))
+            clear_data_cache()
+            self.assertTrue(np.array_equal(load_data(filename, cache_folder=folder + "/cache"), data_new))
+
+    def test_fit_surrogate(self):
+        """The points proposed by the RBF surrogate stay inside the bounds"""
+
+        member = deepcopy(TestTransport.params)
+        member.update({"res_xy": 10, "res_z": 3, "fixdoping": 2, "Btheta_max": 60, "Btheta_step": 30,
+                       "Bphi_array": [0], "data_T": 25, "data_p": 0.24})
+        bandObject = BandStructure(**member)
+        bandObject.runBandStructure()
+        admrObject = ADMR([Conductivity(bandObject, **member)], **member)
+        admrObject.runADMR()
+
+        with tempfile.TemporaryDirectory() as folder:
+            filename = folder + "/admr_phi0.dat"
+            np.savetxt(filename, np.vstack((admrObject.Btheta_array, admrObject.rzz_array[0])).T)
+            data_dict = {(25, 0): [filename, 0, 1, 90, admrObject.rhozz_array[0, 0]]}
+            ranges_dict = {"gamma_0": [10, 20], "gamma_k": [40, 80]}
+            fitObject = FittingADMR(member, ranges_dict, data_dict, method="surrogate",
+                                    surrogate_iter=4, surrogate_polish=2, surrogate_seed=0)
+            fitObject.fit_stage("surrogate")
+        history_pars = np.array(fitObject.history_pars)
+        self.assertGreaterEqual(len(history_pars), 6 + 4)
+        for n, param_range in enumerate(ranges_dict.values()):
+            self.assertTrue(np.all(history_pars[:, n] >= param_range[0]))
+            self.assertTrue(np.all(history_pars[:, n] <= param_range[-1]))
+
+    def test_admr_store(self):
+        """ADMR written in and reloaded from an ADMRStore"""
+
+        params = deepcopy(TestTransport.params)
+        params["Btheta_step"] = 30
+        params["Bphi_array"] = [0, 45]
+
+        bandObject = BandStructure(**params)
+        bandObject.runBandStructure()
+        condObject = Conductivity(bandObject, **params)
+        admrObject = ADMR([condObject], **params)
+
+        with tempfile.TemporaryDirectory() as folder:
+            store = ADMRStore(folder + "/run", trajectories=True)
+            admrObject.runADMR(store=store)
+
+            self.assertTrue(np.array_equal(store.rhozz_array, admrObject.rhozz_array))
+            self.assertTrue(np.allclose(store.rzz_array, admrObject.rzz_array))
+            self.assertEqual(store.kft(bandObject.band_name).shape[:3], (2, 4, 3))
+            self.assertEqual(store.metadata["file_name"], admrObject.fileNameFunc())
+
+    def test_admr_store_resume_mode(self):
+        """A store written with 1 / sigma_zz is not resumed by a full tensor run"""
+
+        params = deepcopy(TestTransport.params)
+        params.update({"res_xy": 10, "res_z": 3, "Btheta_step": 45, "Bphi_array": [0]})
+        bandObject = BandStructure(**params)
+        bandObject.runBandStructure()
+        condObject = Conductivity(bandObject, **params)
+
+        with tempfile.TemporaryDirectory() as folder:
+            store = ADMRStore(folder + "/run")
+            ADMR([condObject], **params).runADMR(store=store)
+            self.assertFalse(store.is_same_run(ADMR([condObject], **params, full_tensor=True).metadataFunc(),
+                                               ADMR([condObject], **params, full_tensor=True)))
+
+            admrObject = ADMR([condObject], **params, full_tensor=True)
+            admrObject.runADMR(store=store, resume=True)
+            self.assertTrue(np.all(np.isfinite(admrObject.rhozz_array)))
+            self.assertTrue(np.all(np.isfinite(store.sigma_array)))
+
+            ## A point flagged done without the components of the run is computed again
+            store.open(admrObject, resume=True)
+            store._arrays["sigma"][0, 1, 0, 0] = np.nan
+            self.assertFalse(store.is_done(0, 1, [(0, 0), (2, 2)]))
+            self.assertTrue(store.is_done(0, 1))
+            store.close()
+
+    def test_admr_store_resume_params(self):
+        """A store written with other scattering or solver parameters is not resumed"""
+
+        params = deepcopy(TestTransport.params)
+        params.update({"res_xy": 10, "res_z": 3, "Btheta_step": 45, "Bphi_array": [0]})
+        bandObject = BandStructure(**params)
+        bandObject.runBandStructure()
+
+        with tempfile.TemporaryDirectory() as folder:
+            admrObject = ADMR([Conductivity(bandObject, **params)], **params)
+            admrObject.runADMR(store=ADMRStore(folder + "/run"))
+            for param_name, value in [("a_T", 0.5), ("rtol", 1e-6), ("a0", 1),
+                                      ("trajectories_dtype", np.float32)]:
+                condObject = Conductivity(bandObject, **dict(params, **{param_name: value}))
+                self.assertFalse(ADMRStore(folder + "/run").is_same_run(ADMR([condObject], **params).metadataFunc(),
+                                                                        ADMR([condObject], **params)))
+            admrObject_a0 = ADMR([Conductivity(bandObject, **dict(params, a0=1))], **params)
+            admrObject_a0.runADMR(store=ADMRStore(folder + "/run"), resume=True)
+            self.assertFalse(np.allclose(admrObject_a0.rhozz_array, admrObject.rhozz_array))
+
+            ## Same parameters, the store is resumed
+            admrObject_resumed = ADMR([Conductivity(bandObject, **dict(params, a0=1))], **params)
+            self.assertTrue(ADMRStore(folder + "/run").is_same_run(admrObject_resumed.metadataFunc(),
+                                                                   admrObject_resumed))
+
+    def test_admr_store_resume_observables(self):
+        """rho rebuilt from a store written with other observables is computed again"""
+
+        params = deepcopy(TestTransport.params)
+        params.update({"res_xy": 10, "res_z": 3, "Btheta_step": 45, "Bphi_array": [0]})
+        bandObject = BandStructure(**params)
+        bandObject.runBandStructure()
+        condObject = Conductivity(bandObject, **params)
+
+        with tempfile.TemporaryDirectory() as folder:
+            admrObject = ADMR([condObject], **params, observables=["sigma"], observables_ij=[(0, 0)])
+            admrObject.runADMR()
+            admrObject.storeADMR(folder=folder, filename="run")
+
+            admrObject = ADMR([condObject], **params, observables=["rho"])
+            admrObject.runADMR(store=ADMRStore(folder + "/run"), resume=True)
+            self.assertTrue(np.all(np.isfinite(admrObject.rho_array)))
+            self.assertTrue(np.allclose(admrObject.rho_array, np.linalg.inv(admrObject.sigma_array)))
+
+            ## Same observables, the angles are read back from the store
+            admrObject_resumed = ADMR([condObject], **params, observables=["rho"])
+            admrObject_resumed.runADMR(store=ADMRStore(folder + "/run"), resume=True)
+            self.assertEqual(len(admrObject_resumed.condObjectDict), 0)
+            self.assertTrue(np.array_equal(admrObject_resumed.rho_array, admrObject.rho_array))
+
+    def test_evaluation_cache(self):
+        """Keys ignore mu when the doping is fixed, LRU eviction"""
+
+        member = deepcopy(TestTransport.params)
+        member["fixdoping"] = 0.24
+
+        with tempfile.TemporaryDirectory() as folder:
+            cache = EvaluationCache(folder + "/cache.sqlite", max_entries=2)
+            key_0 = cache.key(member, [0, 45], [0, 30, 60])
+            member["band_params"]["mu"] = -0.8
+            self.assertEqual(cache.key(member, [0, 45], [0, 30, 60]), key_0)
+            member["gamma_0"] = 12
+            key_1 = cache.key(member, [0, 45], [0, 30, 60])
+            key_2 = cache.key(member, [0, 45], [0, 30])
+            self.assertNotEqual(key_1, key_0)
+            self.assertNotEqual(key_2, key_1)
+
+            ## pipi_FSR and the solver options not set in the member are in the key
+            fitObject = FittingADMR(member, {"gamma_0": [10, 20]}, {})
+            options = fitObject.cache_options(member)
+            self.assertEqual(options["time_quadrature"], "rectangle")
+            self.assertEqual(options["pipi_FSR"], False)
+            keys = {cache.key(member, [0, 45], [0, 30, 60], options)}
+            for option_name, value in [("pipi_FSR", True), ("time_quadrature", "simpson"),
+                                       ("epsilon_quadrature", "gauss_fermi"),
+                                       ("fused_scattering", False), ("orbit_dispatch", True),
+                                       ("chambers_engine", "orbit")]:
+                keys.add(cache.key(member, [0, 45], [0, 30, 60], dict(options, **{option_name: value})))
+            self.assertEqual(len(keys), 7)
+            member["chambers_engine"] = "direct"
+            self.assertEqual(fitObject.cache_options(member), options)
+
+            cache.put(key_0, np.ones((2, 3)), 2*np.ones((2, 3)))
+            cache.put(key_1, np.ones((2, 3)), 2*np.ones((2, 3)))
+            cache.get(key_0) # key_1 becomes the least recently used
+            cache.put(key_2, np.ones((2, 2)), 2*np.ones((2, 2)))
+            self.assertEqual(len(cache), 2)
+            self.assertIsNone(cache.get(key_1))
+            rzz_array, rhozz_array = cache.get(key_0)
+            self.assertTrue(np.array_equal(rhozz_array, 2*np.ones((2, 3))))
+            cache.close()
+
+    def test_evaluation_cache_multi_T(self):
+        """The cache of the multi-T fit is not shared between fits with another pipi_FSR"""
+
+        member = deepcopy(TestTransport.params)
+        member.update({"res_xy": 10, "res_z": 3, "fixdoping": 2, "Btheta_max": 60, "Btheta_step": 30,
+                       "Bphi_array": [0], "data_p": 0.24})
+        bandObject = BandStructure(**member)
+        bandObject.runBandStructure()
+        admrObject = ADMR([Conductivity(bandObject, **member)], **member)
+        admrObject.runADMR()
+        member["data_T"] = [25]
+
+        with tempfile.TemporaryDirectory() as folder:
+            filename = folder + "/admr_phi0.dat"
+            np.savetxt(filename, np.vstack((admrObject.Btheta_array, admrObject.rzz_array[0])).T)
+            data_dict = {(25, 0): [filename, 0, 1, 90, admrObject.rhozz_array[0, 0]]}
+            nb_calls_list = []
+            for pipi_FSR in [False, False, True]:
+                fitObject = FittingADMRMultiT(member, {"gamma_0": [10, 20]}, data_dict, pipi_FSR=pipi_FSR,
+                                              evaluation_cache=folder + "/cache.sqlite")
+                fitObject.compute_diff(fitObject.pars)
+                nb_calls_list.append(fitObject.nb_calls)
+                fitObject.evaluation_cache.close()
+        self.assertEqual(nb_calls_list, [1, 0, 1])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file